@@ -1,22 +1,46 @@
 from typing import Optional
 
 import os
+import math
+import time
+import queue
 import pprint
+import shutil
+import asyncio
+import hashlib
 import zipfile
+import functools
 import tempfile
+import threading
+import weakref
+import unittest
 import wasmtime
+import collections
 import dataclasses
+import concurrent.futures
+
+# Where every run sees the wheel cache.
+WHEELS = '/wheels'
+
+# Epoch deadlines are relative, so a run with no timeout is given one
+# too far off to ever be reached.
+NO_DEADLINE = 1 << 40
 
 @dataclasses.dataclass(frozen=True)
 class Result:
   """The result of a Python computation. Includes standard output,
   standard error, and various metrics related to space and time usage.
+  `queue_time` is the seconds from the call to the start of the run,
+  spent waiting for a free worker and a set up run, and `run_time` the
+  seconds the run itself took.
   """
   stdout: str
   stderr: str
   data_len: int
   memory_size: int
   fuel_consumed: int
+  queue_time: float = 0.0
+  run_time: float = 0.0
 
   def __str__(self) -> str:
     data = {
@@ -25,14 +49,171 @@ class Result:
       'data_len': self.data_len,
       'memory_size': self.memory_size,
       'fuel_consumed': self.fuel_consumed,
+      'queue_time': self.queue_time,
+      'run_time': self.run_time,
     }
-    return pprint.pprint(data)
+    return pprint.pformat(data)
+
+class Timeout(Exception):
+  seconds: float
+
+  def __init__(self, seconds: float):
+    self.seconds = seconds
+
+  def __str__(self) -> str:
+    return f'''
+Context: the run was interrupted after {self.seconds} seconds
+'''.strip()
+
+class WheelCache:
+  """Wheels extracted into `directory`, each once, under the SHA-256 of
+  its contents, and made read-only. Once the entries add up to more than
+  `max_bytes`, those used least recently are removed, except those in
+  use by a run.
+  """
+  directory: str
+  max_bytes: int
+
+  def __init__(self, directory: str, max_bytes: int = 1 << 30):
+    os.makedirs(directory, exist_ok=True)
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    # The digests of wheels by path, size and modification time, so an
+    # unchanged wheel is only hashed once.
+    self.digests = {}
+    # The size of each entry, least recently used first.
+    self.sizes = {}
+    self.users = collections.Counter()
+    # Futures of the sizes of entries being extracted, so each wheel is
+    # extracted once, and without holding up the other wheels.
+    self.pending = {}
+    for digest in sorted(
+      os.listdir(directory),
+      key=lambda name: os.path.getmtime(os.path.join(directory, name)),
+    ):
+      path = os.path.join(directory, digest)
+      if digest.startswith('.'):
+        _remove(path)
+      elif _is_digest(digest):
+        # Anything else isn't an entry, and is left alone.
+        self.sizes[digest] = _size(path)
+
+  def acquire(self, wheel: str) -> str:
+    """The digest of `wheel`, extracting it if it's not cached yet. The
+    entry is kept until it's released."""
+    digest = self._digest(wheel)
+    with self.lock:
+      # Counted as a user first, so the entry isn't evicted before it's
+      # handed over.
+      self.users[digest] += 1
+      if digest in self.sizes:
+        self.sizes[digest] = self.sizes.pop(digest)
+        return digest
+      future = self.pending.get(digest)
+      extract = future is None
+      if extract:
+        future = concurrent.futures.Future()
+        self.pending[digest] = future
+    if extract:
+      try:
+        size = self._extract(wheel, digest)
+      except BaseException as error:
+        with self.lock:
+          del self.pending[digest]
+        future.set_exception(error)
+      else:
+        with self.lock:
+          del self.pending[digest]
+          self.sizes[digest] = size
+          self._evict()
+        future.set_result(size)
+    try:
+      future.result()
+    except BaseException:
+      self.release(digest)
+      raise
+    return digest
+
+  def release(self, digest: str):
+    with self.lock:
+      self.users[digest] -= 1
+      if self.users[digest] == 0:
+        del self.users[digest]
+      self._evict()
+
+  def _digest(self, wheel: str) -> str:
+    stat = os.stat(wheel)
+    key = (os.path.abspath(wheel), stat.st_size, stat.st_mtime_ns)
+    digest = self.digests.get(key)
+    if digest is None:
+      hash = hashlib.sha256()
+      with open(wheel, 'rb') as file:
+        while True:
+          chunk = file.read(1 << 20)
+          if len(chunk) == 0:
+            break
+          hash.update(chunk)
+      digest = hash.hexdigest()
+      self.digests[key] = digest
+    return digest
+
+  def _extract(self, wheel: str, digest: str) -> int:
+    # Extract next to the entry and rename it into place, so an entry
+    # is never seen half extracted.
+    staging = tempfile.mkdtemp(prefix='.', dir=self.directory)
+    try:
+      with zipfile.ZipFile(wheel, 'r') as package:
+        package.extractall(staging)
+      for root, dirs, files in os.walk(staging):
+        for name in files:
+          os.chmod(os.path.join(root, name), 0o444)
+      for root, dirs, files in os.walk(staging, topdown=False):
+        os.chmod(root, 0o555)
+      os.rename(staging, os.path.join(self.directory, digest))
+    except BaseException:
+      _remove(staging)
+      raise
+    return _size(os.path.join(self.directory, digest))
+
+  def _evict(self):
+    total = sum(self.sizes.values())
+    for digest in list(self.sizes):
+      if total <= self.max_bytes:
+        return
+      if self.users[digest] > 0:
+        continue
+      total -= self.sizes.pop(digest)
+      _remove(os.path.join(self.directory, digest))
+
+def _is_digest(name: str) -> bool:
+  return len(name) == 64 and all(char in '0123456789abcdef' for char in name)
+
+def _size(path: str) -> int:
+  total = 0
+  for root, dirs, files in os.walk(path):
+    for name in files:
+      total += os.path.getsize(os.path.join(root, name))
+  return total
+
+def _remove(path: str):
+  # The entries are read-only, and a directory's entries can't be
+  # removed unless it's writable.
+  for root, dirs, files in os.walk(path):
+    os.chmod(root, 0o755)
+  shutil.rmtree(path)
 
 class Context:
   """Evaluate Python code within a sandbox using Wasmtime. This
   class behaves like a function-as-a-service platform, like AWS Lambda,
   in that it's stateless and re-evaluates the code it's given every time
   it's called.
+
+  With `pool_size`, a thread keeps that many runs instantiated ahead of
+  time, each used for one call; a call that finds the pool empty sets
+  up its own. A call with a `timeout` raises `Timeout` once that many
+  seconds pass, and `serialize` saves the compiled module to load as
+  `serialized_path` next time.
   """
   python_wasm_path: str
   engine: wasmtime.Engine
@@ -40,79 +221,739 @@ class Context:
   # todo: i guess if we want to load packages, we'll need
   # more modules?
   module: wasmtime.Module
+  entry: str
+  pool_size: int
+  tick: float
+  max_concurrency: int
+  max_output: int
+  wheel_cache: WheelCache
 
   def __init__(
     self,
-    python_wasm_path: str,
+    python_wasm_path: Optional[str] = None,
+    serialized_path: Optional[str] = None,
+    entry: str = '_start',
+    pool_size: int = 0,
+    tick: float = 0.01,
+    max_concurrency: Optional[int] = None,
+    max_output: int = 1 << 20,
+    wheel_cache: Optional[WheelCache] = None,
   ):
     self.python_wasm_path = python_wasm_path
     self.engine_config = wasmtime.Config()
     self.engine_config.consume_fuel = True
     self.engine_config.cache = True
+    self.engine_config.epoch_interruption = True
 
     self.engine = wasmtime.Engine(self.engine_config)
     self.linker = wasmtime.Linker(self.engine)
     self.linker.define_wasi()
 
-    self.module = wasmtime.Module.from_file(
-      self.engine,
-      self.python_wasm_path,
+    if serialized_path is not None:
+      self.module = wasmtime.Module.deserialize_file(
+        self.engine,
+        serialized_path,
+      )
+    elif python_wasm_path is not None:
+      self.module = wasmtime.Module.from_file(
+        self.engine,
+        self.python_wasm_path,
+      )
+    else:
+      raise ValueError(f'''
+Context: you must provide either a module path or a serialized module path
+'''.strip())
+    self.entry = entry
+
+    self.max_output = max_output
+    self.cache_directory = None
+    if wheel_cache is None:
+      self.cache_directory = tempfile.mkdtemp()
+      wheel_cache = WheelCache(self.cache_directory)
+    self.wheel_cache = wheel_cache
+
+    if max_concurrency is None:
+      max_concurrency = os.cpu_count() or 1
+    self.tick = tick
+    self.max_concurrency = max_concurrency
+    self.slots = threading.BoundedSemaphore(max_concurrency)
+    self.executor = None
+    self.executor_lock = threading.Lock()
+
+    self.pool_size = pool_size
+    self.pool = None
+    self.closed = threading.Event()
+    # The threads don't hold on to the context, so one that's never
+    # closed can still be collected, which stops them.
+    self.ticker = threading.Thread(
+      target=_tick,
+      args=(self.engine, self.closed, tick),
+      daemon=True,
+    )
+    self.ticker.start()
+    self.filler = None
+    if pool_size > 0:
+      self.pool = queue.Queue(pool_size)
+      self.filler = threading.Thread(
+        target=_fill,
+        args=(weakref.ref(self), self.pool, self.closed),
+        daemon=True,
+      )
+      self.filler.start()
+    self.finalizer = weakref.finalize(
+      self,
+      _release,
+      self.closed,
+      self.pool,
+      self.cache_directory,
     )
 
+  def serialize(self, path: str) -> str:
+    """Save the compiled module to `path`, for `serialized_path`."""
+    with open(path, 'wb') as file:
+      file.write(self.module.serialize())
+    return path
+
+  def close(self):
+    """Stop refilling the pool and remove the runs set up in it, after
+    the calls already submitted have finished."""
+    self.closed.set()
+    with self.executor_lock:
+      executor, self.executor = self.executor, None
+    if executor is not None:
+      executor.shutdown(wait=True)
+    self.ticker.join()
+    if self.pool is not None:
+      _drain(self.pool)
+      self.filler.join()
+    self.finalizer()
+
+  def __enter__(self) -> 'Context':
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
   def __call__(
     self,
     source: Optional[str] = None,
     wheel: Optional[str] = None,
     module: Optional[str] = None,
     fuel: int = 500_000_000,
+    timeout: Optional[float] = None,
   ) -> Result:
-    with tempfile.TemporaryDirectory() as chroot:
-      stdout_file = os.path.join(chroot, 'stdout')
-      stderr_file = os.path.join(chroot, 'stderr')
+    return self._call(
+      time.perf_counter(),
+      source,
+      wheel,
+      module,
+      fuel,
+      timeout,
+    )
 
-      wasi_config = wasmtime.WasiConfig()
-      wasi_config.stdout_file = stdout_file
-      wasi_config.stderr_file = stderr_file
-      wasi_config.preopen_dir(chroot, '/')
-
-      if source is not None:
-        assert wheel is None
-        assert module is None
-        wasi_config.argv = ('python', '-c', source)
-      elif wheel is not None:
-        assert source is None
-        assert module is not None:
-        with zipfile.ZipFile(wheel, 'r') as package:
-          package.extractall(chroot)
-          wasi_config.argv = ('python', '-m', module)
-      else:
+  def submit(
+    self,
+    source: Optional[str] = None,
+    wheel: Optional[str] = None,
+    module: Optional[str] = None,
+    fuel: int = 500_000_000,
+    timeout: Optional[float] = None,
+  ) -> concurrent.futures.Future:
+    """Run a call on the context's thread pool, returning a future of
+    its `Result`."""
+    return self._executor().submit(
+      self._call,
+      time.perf_counter(),
+      source,
+      wheel,
+      module,
+      fuel,
+      timeout,
+    )
+
+  async def run(
+    self,
+    source: Optional[str] = None,
+    wheel: Optional[str] = None,
+    module: Optional[str] = None,
+    fuel: int = 500_000_000,
+    timeout: Optional[float] = None,
+  ) -> Result:
+    """Run a call on the context's thread pool, without blocking the
+    event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+      self._executor(),
+      functools.partial(
+        self._call,
+        time.perf_counter(),
+        source,
+        wheel,
+        module,
+        fuel,
+        timeout,
+      ),
+    )
+
+  def _executor(self) -> concurrent.futures.ThreadPoolExecutor:
+    with self.executor_lock:
+      if self.closed.is_set():
         raise ValueError(f'''
+Context: the context has been closed
+'''.strip())
+      if self.executor is None:
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+          self.max_concurrency,
+          thread_name_prefix='sandbox',
+        )
+      return self.executor
+
+  def _call(
+    self,
+    submitted: float,
+    source: Optional[str],
+    wheel: Optional[str],
+    module: Optional[str],
+    fuel: int,
+    timeout: Optional[float],
+  ) -> Result:
+    if source is not None:
+      assert wheel is None
+      assert module is None
+    elif wheel is not None:
+      assert source is None
+      assert module is not None
+    else:
+      raise ValueError(f'''
 Context: you must provide either source code or a wheel path
 '''.strip())
 
-      store = wasmtime.Store(self.engine)
-      store.add_fuel(fuel)
-      store.set_wasi(wasi_config)
+    deadline = NO_DEADLINE
+    if timeout is not None:
+      deadline = max(1, math.ceil(timeout / self.tick))
 
-      instance = self.linker.instantiate(store, self.module)
-      # why doesn't this get assigned in the instance constructor?
-      # why should i need to pass it again here?
-      exports = instance.exports(store)
-      start   = exports['_start']
-      memory  = exports['memory']
+    with self.slots:
+      digest = None
+      if wheel is not None:
+        digest = self.wheel_cache.acquire(wheel)
+      try:
+        script = source
+        if digest is not None:
+          script = f'''
+import sys
+import runpy
+sys.path.insert(0, {f'{WHEELS}/{digest}'!r})
+runpy.run_module({module!r}, run_name='__main__', alter_sys=True)
+'''.lstrip()
+        run = self._take()
+        try:
+          started = time.perf_counter()
+          try:
+            result = run.run(self.entry, fuel, deadline, script.encode())
+          except wasmtime.Trap as error:
+            if error.trap_code == wasmtime.TrapCode.INTERRUPT:
+              raise Timeout(timeout) from error
+            raise
+          finished = time.perf_counter()
+        finally:
+          run.close()
+      finally:
+        if digest is not None:
+          self.wheel_cache.release(digest)
+    return dataclasses.replace(
+      result,
+      queue_time=started - submitted,
+      run_time=finished - started,
+    )
+
+  def _take(self) -> '_Run':
+    if self.closed.is_set():
+      raise ValueError(f'''
+Context: the context has been closed
+'''.strip())
+    if self.pool is None:
+      return _Run(self)
+    try:
+      run = self.pool.get_nowait()
+    except queue.Empty:
+      # The pool is filled by one thread, so under load it runs dry, and
+      # waiting for it would set up the runs one at a time.
+      return _Run(self)
+    if isinstance(run, Exception):
+      raise run
+    return run
 
-      start(store)
+def _tick(engine: wasmtime.Engine, closed: threading.Event, tick: float):
+  while not closed.wait(tick):
+    engine.increment_epoch()
 
-      with open(stdout_file) as file:
-        stdout_content = file.read()
+def _fill(
+  ref: weakref.ref,
+  pool: queue.Queue,
+  closed: threading.Event,
+):
+  while not closed.is_set():
+    context = ref()
+    if context is None:
+      break
+    try:
+      run = _Run(context)
+    except Exception as error:
+      # Hand the error to whoever is waiting for a run.
+      pool.put(error)
+      return
+    # Waiting for room in the pool mustn't keep the context alive.
+    del context
+    pool.put(run)
+  # The last run may have gone in after the pool was drained.
+  _drain(pool)
 
-      with open(stderr_file) as file:
-        stderr_content = file.read()
+def _drain(pool: queue.Queue):
+  while True:
+    try:
+      run = pool.get_nowait()
+    except queue.Empty:
+      return
+    if isinstance(run, _Run):
+      run.close()
+
+def _release(
+  closed: threading.Event,
+  pool: Optional[queue.Queue],
+  directory: Optional[str],
+):
+  # Whatever a context holds outside itself, let go of when it's closed
+  # or collected.
+  closed.set()
+  if pool is not None:
+    _drain(pool)
+  if directory is not None:
+    _remove(directory)
+
+class _Run:
+  """A store with the module instantiated in it, ready to run once. The
+  interpreter reads its program from standard input, and its standard
+  input, output and error are pipes to this process. It sees a scratch
+  directory of its own at `/`, removed along with the run.
+  """
+  stdin: int
+  scratch: tempfile.TemporaryDirectory
+  stdout: '_Output'
+  stderr: '_Output'
+  writer: Optional[threading.Thread]
+  store: Optional[wasmtime.Store]
+  instance: Optional[wasmtime.Instance]
 
-      return Result(
-        stdout_content,
-        stderr_content,
-        memory.data_len(store),
-        memory.size(store),
-        store.fuel_consumed(),
+  def __init__(self, context: Context):
+    self.stdin = None
+    self.stdout = None
+    self.stderr = None
+    self.writer = None
+    self.store = None
+    self.instance = None
+    self.scratch = None
+    read = None
+    try:
+      read, self.stdin = os.pipe()
+      self.stdout = _Output(context.max_output)
+      self.stderr = _Output(context.max_output)
+      self.scratch = tempfile.TemporaryDirectory()
+      wasi_config = wasmtime.WasiConfig()
+      wasi_config.stdin_file = f'/dev/fd/{read}'
+      wasi_config.stdout_file = self.stdout.path
+      wasi_config.stderr_file = self.stderr.path
+      wasi_config.preopen_dir(self.scratch.name, '/')
+      # The cache is shared by every run, so none may change it.
+      wasi_config.preopen_dir(
+        context.wheel_cache.directory,
+        WHEELS,
+        fs_mutable=False,
       )
+      wasi_config.argv = ('python', '-')
+
+      self.store = wasmtime.Store(context.engine)
+      self.store.set_wasi(wasi_config)
+      self.store.set_epoch_deadline(NO_DEADLINE)
+      self.instance = context.linker.instantiate(self.store, context.module)
+    except BaseException:
+      self.close()
+      raise
+    finally:
+      # WASI opened the pipes for itself, so these ends can go.
+      if read is not None:
+        os.close(read)
+      for output in [self.stdout, self.stderr]:
+        if output is not None:
+          output.opened()
+
+  def run(
+    self,
+    entry: str,
+    fuel: int,
+    deadline: int,
+    script: bytes,
+  ) -> Result:
+    store = self.store
+    # The store is fresh, so all the fuel consumed is this run's.
+    store.set_fuel(fuel)
+    store.set_epoch_deadline(deadline)
+    # why doesn't this get assigned in the instance constructor?
+    # why should i need to pass it again here?
+    exports = self.instance.exports(store)
+    start   = exports[entry]
+    memory  = exports['memory']
+
+    # Written from a thread, since a program longer than the pipe holds
+    # is only read once the run starts.
+    self.writer = threading.Thread(
+      target=_write,
+      args=(self.stdin, script),
+      daemon=True,
+    )
+    self.stdin = None
+    self.writer.start()
+
+    start(store)
+
+    data_len = memory.data_len(store)
+    memory_size = memory.size(store)
+    fuel_consumed = fuel - store.get_fuel()
+    # The output pipes only reach the end once the store is gone.
+    self.close()
+
+    return Result(
+      self.stdout.text(),
+      self.stderr.text(),
+      data_len,
+      memory_size,
+      fuel_consumed,
+    )
+
+  def close(self):
+    if self.store is not None:
+      self.instance = None
+      self.store.close()
+      self.store = None
+    if self.stdin is not None:
+      os.close(self.stdin)
+      self.stdin = None
+    if self.writer is not None:
+      self.writer.join()
+    for output in [self.stdout, self.stderr]:
+      if output is not None:
+        # A run that failed to set up still has its end open.
+        output.opened()
+        output.reader.join()
+    if self.scratch is not None:
+      self.scratch.cleanup()
+
+class _Output:
+  """Up to `limit` bytes of what a run writes to a pipe. The rest is read
+  and dropped, so the run never waits on a full pipe.
+  """
+  limit: int
+  data: bytearray
+  fd: int
+  path: str
+  reader: threading.Thread
+
+  def __init__(self, limit: int):
+    self.limit = limit
+    self.data = bytearray()
+    read, self.fd = os.pipe()
+    self.path = f'/dev/fd/{self.fd}'
+    self.reader = threading.Thread(
+      target=self._read,
+      args=(read,),
+      daemon=True,
+    )
+    self.reader.start()
+
+  def opened(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+  def text(self) -> str:
+    self.reader.join()
+    return self.data.decode(errors='replace')
+
+  def _read(self, fd: int):
+    with open(fd, 'rb', buffering=0) as file:
+      while True:
+        chunk = file.read(1 << 16)
+        if len(chunk) == 0:
+          return
+        room = self.limit - len(self.data)
+        if room > 0:
+          self.data += chunk[:room]
+
+def _write(fd: int, data: bytes):
+  try:
+    with open(fd, 'wb') as file:
+      file.write(data)
+  except BrokenPipeError:
+    # The run ended without reading all of it.
+    pass
+
+class TestContext(unittest.TestCase):
+  # Stands in for the interpreter: copies standard input to standard
+  # output and error.
+  echo = '''
+(module
+  (import "wasi_snapshot_preview1" "fd_read"
+    (func $read (param i32 i32 i32 i32) (result i32)))
+  (import "wasi_snapshot_preview1" "fd_write"
+    (func $write (param i32 i32 i32 i32) (result i32)))
+  (memory (export "memory") 2)
+  (func (export "_start")
+    (loop $l
+      (i32.store (i32.const 0) (i32.const 64))
+      (i32.store (i32.const 4) (i32.const 65536))
+      (drop (call $read (i32.const 0) (i32.const 0) (i32.const 1)
+        (i32.const 8)))
+      (if (i32.gt_u (i32.load (i32.const 8)) (i32.const 0))
+        (then
+          (i32.store (i32.const 4) (i32.load (i32.const 8)))
+          (drop (call $write (i32.const 1) (i32.const 0) (i32.const 1)
+            (i32.const 8)))
+          (drop (call $write (i32.const 2) (i32.const 0) (i32.const 1)
+            (i32.const 8)))
+          (br $l))))))
+'''
+  loop = '''
+(module
+  (memory (export "memory") 1)
+  (func (export "_start") (loop $l (br $l))))
+'''
+
+  # Makes a directory `poison` in the scratch directory and in the wheel
+  # cache, the first two preopened, and writes 0 for each that worked
+  # and 1 for each that didn't.
+  mkdir = '''
+(module
+  (import "wasi_snapshot_preview1" "path_create_directory"
+    (func $mkdir (param i32 i32 i32) (result i32)))
+  (import "wasi_snapshot_preview1" "fd_write"
+    (func $write (param i32 i32 i32 i32) (result i32)))
+  (memory (export "memory") 1)
+  (data (i32.const 16) "poison")
+  (func (export "_start")
+    (i32.store8 (i32.const 32)
+      (i32.add (i32.const 48)
+        (i32.ne (call $mkdir (i32.const 3) (i32.const 16) (i32.const 6))
+          (i32.const 0))))
+    (i32.store8 (i32.const 33)
+      (i32.add (i32.const 48)
+        (i32.ne (call $mkdir (i32.const 4) (i32.const 16) (i32.const 6))
+          (i32.const 0))))
+    (i32.store (i32.const 0) (i32.const 32))
+    (i32.store (i32.const 4) (i32.const 2))
+    (drop (call $write (i32.const 1) (i32.const 0) (i32.const 1)
+      (i32.const 8)))))
+'''
+
+  def context(self, directory: str, source: str, **kwargs) -> Context:
+    path = os.path.join(directory, 'python.wat')
+    with open(path, 'w') as file:
+      file.write(source)
+    return Context(path, **kwargs)
+
+  def test_echo(self):
+    with tempfile.TemporaryDirectory() as directory:
+      with self.context(directory, self.echo) as context:
+        result = context('print("hello")')
+        self.assertEqual('print("hello")', result.stdout)
+        self.assertEqual('print("hello")', result.stderr)
+        self.assertEqual(2, result.memory_size)
+        self.assertGreaterEqual(result.run_time, 0)
+        # More than a pipe holds.
+        source = 'x' * 300_000
+        self.assertEqual(source, context(source).stdout)
+      self.assertRaises(ValueError, context, 'print(1)')
+      self.assertRaises(ValueError, Context)
+
+  def test_pool(self):
+    def full(context: Context):
+      for _ in range(500):
+        if context.pool.full():
+          return
+        time.sleep(0.01)
+      self.fail('the pool was never filled')
+
+    with tempfile.TemporaryDirectory() as directory:
+      with self.context(directory, self.echo, pool_size=2) as context:
+        self.assertEqual(2, context.pool.maxsize)
+        for index in range(4):
+          full(context)
+          run = context.pool.queue[0]
+          self.assertEqual(f'{index}', context(f'{index}').stdout)
+          # The call took the oldest run, which is used up.
+          self.assertIsNone(run.store)
+          self.assertNotIn(run, context.pool.queue)
+        futures = [context.submit(f'{index}') for index in range(16)]
+        self.assertEqual(
+          [f'{index}' for index in range(16)],
+          [future.result().stdout for future in futures],
+        )
+        full(context)
+        pool = context.pool
+      self.assertEqual(0, pool.qsize())
+      with self.context(directory, self.echo) as context:
+        self.assertIsNone(context.pool)
+        self.assertIsNone(context.filler)
+        self.assertEqual('hello', context('hello').stdout)
+
+  def test_output(self):
+    with tempfile.TemporaryDirectory() as directory:
+      with self.context(directory, self.echo) as context:
+        source = ''.join(f'{index:07}\n' for index in range(150_000))
+        result = context(source)
+        self.assertEqual(1 << 20, context.max_output)
+        self.assertEqual(source[:1 << 20], result.stdout)
+        self.assertEqual(source[:1 << 20], result.stderr)
+      with self.context(directory, self.echo, max_output=10) as context:
+        result = context(source)
+        self.assertEqual(source[:10], result.stdout)
+
+  def test_wheels(self):
+    with tempfile.TemporaryDirectory() as directory:
+      wheel = os.path.join(directory, 'hello.whl')
+      with zipfile.ZipFile(wheel, 'w') as package:
+        package.writestr('hello/__main__.py', 'print("hello")')
+      with self.context(directory, self.echo, pool_size=1) as context:
+        result = context(wheel=wheel, module='hello')
+        (digest,) = os.listdir(context.cache_directory)
+        self.assertIn(f"'{WHEELS}/{digest}'", result.stdout)
+        self.assertIn("run_module('hello'", result.stdout)
+        self.assertEqual(0, len(context.wheel_cache.users))
+        run = _Run(context)
+        scratch = run.scratch.name
+        self.assertEqual([], os.listdir(scratch))
+        run.close()
+        self.assertFalse(os.path.exists(scratch))
+        cache_directory = context.cache_directory
+      self.assertFalse(os.path.exists(cache_directory))
+      # Nor does a context that's never closed leave its cache behind.
+      context = self.context(directory, self.echo)
+      cache_directory = context.cache_directory
+      del context
+      self.assertFalse(os.path.exists(cache_directory))
+
+  def test_broken(self):
+    # Imports a function that nothing defines, so instantiating fails.
+    broken = '''
+(module
+  (import "env" "missing" (func))
+  (memory (export "memory") 1)
+  (func (export "_start")))
+'''
+    with tempfile.TemporaryDirectory() as directory:
+      with self.context(directory, broken) as context:
+        fds = len(os.listdir('/proc/self/fd'))
+        threads = threading.active_count()
+        # The errors hold on to the failed runs, which mustn't keep
+        # their stores, pipes or threads.
+        errors = []
+        for _ in range(10):
+          try:
+            context('print(1)')
+          except wasmtime.WasmtimeError as error:
+            errors.append(error)
+        self.assertEqual(10, len(errors))
+        self.assertEqual(fds, len(os.listdir('/proc/self/fd')))
+        self.assertEqual(threads, threading.active_count())
+      with self.context(directory, broken, pool_size=1) as context:
+        self.assertRaises(wasmtime.WasmtimeError, context, 'print(1)')
+
+  def test_read_only(self):
+    with tempfile.TemporaryDirectory() as directory:
+      with self.context(directory, self.mkdir) as context:
+        self.assertEqual('01', context('').stdout)
+        self.assertEqual([], os.listdir(context.cache_directory))
+
+  def test_timeout(self):
+    with tempfile.TemporaryDirectory() as directory:
+      with self.context(directory, self.loop) as context:
+        started = time.perf_counter()
+        with self.assertRaises(Timeout) as error:
+          context('print(1)', timeout=0.2)
+        self.assertLess(time.perf_counter() - started, 5)
+        self.assertEqual(0.2, error.exception.seconds)
+        self.assertRaises(wasmtime.Trap, context, 'print(1)', fuel=1000)
+      with self.context(directory, self.echo) as context:
+        result = context('hello', timeout=5)
+        self.assertEqual('hello', result.stdout)
+        self.assertGreater(result.fuel_consumed, 0)
+
+  def test_async(self):
+    async def main(context: Context) -> list[Result]:
+      calls = [context.run(f'{index}', timeout=5) for index in range(8)]
+      return await asyncio.gather(*calls)
+
+    with tempfile.TemporaryDirectory() as directory:
+      with self.context(directory, self.echo, max_concurrency=2) as context:
+        results = asyncio.run(main(context))
+        futures = [context.submit(f'{index}') for index in range(8)]
+        self.assertEqual(
+          [f'{index}' for index in range(8)],
+          [result.stdout for result in results],
+        )
+        self.assertEqual(
+          [f'{index}' for index in range(8)],
+          [future.result().stdout for future in futures],
+        )
+      self.assertRaises(ValueError, context.submit, 'print(1)')
+
+class TestWheelCache(unittest.TestCase):
+  class Cache(WheelCache):
+    def _extract(self, wheel: str, digest: str) -> int:
+      self.extracted.append(digest)
+      # Long enough for other threads to ask for the same wheel.
+      time.sleep(0.05)
+      return super()._extract(wheel, digest)
+
+  def test_cache(self):
+    with tempfile.TemporaryDirectory() as directory:
+      wheels = []
+      for name in ['a', 'b', 'c']:
+        wheel = os.path.join(directory, f'{name}.whl')
+        with zipfile.ZipFile(wheel, 'w') as package:
+          package.writestr(f'{name}/__main__.py', name * 1000)
+        wheels.append(wheel)
+      cache = self.Cache(os.path.join(directory, 'cache'), max_bytes=1500)
+      cache.extracted = []
+      a = cache.acquire(wheels[0])
+      self.assertEqual([a], cache.extracted)
+      cache.release(a)
+      # A hit.
+      self.assertEqual(a, cache.acquire(wheels[0]))
+      self.assertEqual([a], cache.extracted)
+      path = os.path.join(cache.directory, a, 'a', '__main__.py')
+      with open(path) as file:
+        self.assertEqual('a' * 1000, file.read())
+      self.assertEqual(0o444, os.stat(path).st_mode & 0o777)
+      # Misses from several threads at once, each extracted once.
+      with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        digests = list(executor.map(cache.acquire, wheels[1:] * 4))
+      b, c = digests[:2]
+      self.assertEqual(3, len(cache.extracted))
+      self.assertEqual({a, b, c}, set(cache.extracted))
+      # Over the limit, but every entry is in use.
+      self.assertEqual({a, b, c}, set(cache.sizes))
+      cache.release(a)
+      self.assertEqual({b, c}, set(cache.sizes))
+      self.assertEqual(sorted([b, c]), sorted(os.listdir(cache.directory)))
+      # The least recently used go first.
+      self.assertEqual(c, cache.acquire(wheels[2]))
+      for digest in digests + [c]:
+        cache.release(digest)
+      self.assertEqual({c}, set(cache.sizes))
+      self.assertEqual(3, len(cache.extracted))
+      # A new cache picks up the entries already there, and nothing else.
+      os.mkdir(os.path.join(cache.directory, 'poison'))
+      cache = self.Cache(cache.directory)
+      cache.extracted = []
+      self.assertEqual({c}, set(cache.sizes))
+      self.assertEqual(c, cache.acquire(wheels[2]))
+      self.assertEqual([], cache.extracted)
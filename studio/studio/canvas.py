@@ -0,0 +1,221 @@
+import gc
+import os
+import unittest
+import collections
+import concurrent.futures
+import multiprocessing.shared_memory
+
+import numpy
+import cairocffi as cairo
+
+from typing import Callable
+from typing import Iterator
+from typing import Optional
+
+from . import media
+
+# A scene draws the frame with the given index onto a context for a
+# transparent surface. Scenes rendered in a process pool are pickled,
+# so they must be defined at the top level of a module.
+Scene = Callable[[cairo.Context, int], None]
+
+class Animation:
+  """A clip of `frames` frames of `width` by `height` pixels, where
+  each frame is drawn by `scene` from its index alone, so frames can be
+  rendered in any order and on any core.
+
+  Frames are rendered by a process pool of `workers` processes (by
+  default one per core, and none at all for zero) straight into slots
+  of one block of shared memory, so no pixels are pickled. There are
+  `slots` slots, by default two per worker, and a frame is only started
+  once a slot is free, so memory stays bounded however long the clip.
+  Finished frames are handed on in order.
+  """
+  scene: Scene
+  frames: int
+  width: int
+  height: int
+  framerate: int
+  workers: int
+  slots: int
+
+  def __init__(
+    self,
+    scene: Scene,
+    frames: int,
+    width: int = 512,
+    height: int = 512,
+    framerate: int = 15,
+    workers: Optional[int] = None,
+    slots: Optional[int] = None,
+  ):
+    if workers is None:
+      workers = os.cpu_count() or 1
+    if slots is None:
+      slots = max(2, 2 * workers)
+    self.scene = scene
+    self.frames = frames
+    self.width = width
+    self.height = height
+    self.framerate = framerate
+    self.workers = workers
+    self.slots = slots
+
+  @property
+  def frame_bytes(self) -> int:
+    return self.width * self.height * 4
+
+  def __iter__(self) -> Iterator[numpy.ndarray]:
+    """Yield each frame in order as a new `(height, width, 4)` array of
+    BGRA bytes."""
+    for frame in self._rendered():
+      result = frame.copy()
+      # Views must be gone before the shared memory can be closed.
+      del frame
+      yield result
+
+  def render(self, target: str, queue_size: int = 8) -> str:
+    """Encode the clip to `target` with a `media.VideoWriter`, which
+    encodes while the next frames render."""
+    with media.VideoWriter(
+      target,
+      self.height,
+      self.width,
+      self.framerate,
+      queue_size=queue_size,
+    ) as writer:
+      for frame in self._rendered():
+        writer.write(frame)
+        del frame
+    return target
+
+  def _rendered(self) -> Iterator[numpy.ndarray]:
+    # Yield a view of each frame in its slot, which is only valid until
+    # the next frame is asked for.
+    size = self.frame_bytes
+    memory = multiprocessing.shared_memory.SharedMemory(
+      create=True,
+      size=size * self.slots,
+    )
+    try:
+      pixels = numpy.ndarray(
+        (self.slots, self.height, self.width, 4),
+        dtype=numpy.uint8,
+        buffer=memory.buf,
+      )
+      try:
+        yield from self._schedule(memory.name, pixels)
+      finally:
+        del pixels
+    finally:
+      memory.close()
+      memory.unlink()
+
+  def _schedule(
+    self,
+    name: str,
+    pixels: numpy.ndarray,
+  ) -> Iterator[numpy.ndarray]:
+    if self.workers <= 0:
+      _init(name, self.scene, self.width, self.height)
+      try:
+        for index in range(self.frames):
+          _render_frame(index, 0)
+          yield pixels[0]
+      finally:
+        _close()
+      return
+    with concurrent.futures.ProcessPoolExecutor(
+      self.workers,
+      initializer=_init,
+      initargs=(name, self.scene, self.width, self.height),
+    ) as pool:
+      free = collections.deque(range(self.slots))
+      pending = collections.deque()
+      for index in range(self.frames):
+        if len(free) == 0:
+          slot, future = pending.popleft()
+          future.result()
+          yield pixels[slot]
+          free.append(slot)
+        slot = free.popleft()
+        pending.append((slot, pool.submit(_render_frame, index, slot)))
+      while len(pending) > 0:
+        slot, future = pending.popleft()
+        future.result()
+        yield pixels[slot]
+
+# The shared memory, scene and frame size of the current worker, set
+# once by the pool's initializer.
+_worker = None
+
+def _init(name: str, scene: Scene, width: int, height: int):
+  global _worker
+  memory = multiprocessing.shared_memory.SharedMemory(name=name)
+  _worker = (memory, scene, width, height)
+
+def _close():
+  global _worker
+  if _worker is not None:
+    _worker[0].close()
+    _worker = None
+
+def _render_frame(index: int, slot: int):
+  memory, scene, width, height = _worker
+  size = width * height * 4
+  view = memory.buf[slot * size:(slot + 1) * size]
+  surface = None
+  ctx = None
+  try:
+    numpy.frombuffer(view, dtype=numpy.uint8)[:] = 0
+    surface = cairo.ImageSurface.create_for_data(
+      view,
+      cairo.FORMAT_ARGB32,
+      width,
+      height,
+      width * 4,
+    )
+    ctx = cairo.Context(surface)
+    scene(ctx, index)
+    surface.flush()
+  finally:
+    # The view can't be released while anything still exports it, so
+    # the surface over it goes first, whether or not the scene failed.
+    if surface is not None:
+      surface.finish()
+    del ctx, surface
+    try:
+      view.release()
+    except BufferError:
+      # Something in a reference cycle, like a traceback that holds the
+      # scene's frame, still has the pixels.
+      gc.collect()
+      view.release()
+
+def _test_scene(ctx: cairo.Context, index: int):
+  ctx.set_source_rgb(index / 255, 0, 0)
+  ctx.paint()
+
+def _failing_scene(ctx: cairo.Context, index: int):
+  _test_scene(ctx, index)
+  if index == 2:
+    raise ValueError(index)
+
+class TestAnimation(unittest.TestCase):
+  def test_order(self):
+    for workers in [0, 2]:
+      animation = Animation(_test_scene, 9, 4, 3, workers=workers, slots=3)
+      frames = list(animation)
+      self.assertEqual(9, len(frames))
+      for index, frame in enumerate(frames):
+        self.assertEqual((3, 4, 4), frame.shape)
+        # An opaque red of `index`, in Cairo's native-endian byte order.
+        pixel = frame[1, 2].view(numpy.uint32)[0]
+        self.assertEqual(0xff000000 | (index << 16), int(pixel))
+
+  def test_error(self):
+    for workers in [0, 2]:
+      animation = Animation(_failing_scene, 5, 4, 3, workers=workers)
+      with self.assertRaises(ValueError) as context:
+        list(animation)
+      self.assertEqual((2,), context.exception.args)
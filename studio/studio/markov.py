@@ -0,0 +1,296 @@
+import random
+import unittest
+import dataclasses
+
+from typing import Iterator
+from typing import Optional
+
+@dataclasses.dataclass(frozen=True)
+class Rule:
+  pattern: str
+  replacement: str
+  terminal: bool = False
+
+  def __str__(self) -> str:
+    arrow = '->.' if self.terminal else '->'
+    return f'{self.pattern} {arrow} {self.replacement}'
+
+class OutOfSteps(Exception):
+  def __init__(self, rewriter: 'Rewriter'):
+    self.rewriter = rewriter
+
+  def __str__(self) -> str:
+    return f'''
+Ran out of steps after {self.rewriter.steps} rewrites
+'''.strip()
+
+class Automaton:
+  """An Aho-Corasick automaton over the patterns of a set of rules,
+  which finds every occurrence of every pattern in one pass over a
+  string.
+  """
+  goto: list[dict[str, int]]
+  fail: list[int]
+  outputs: list[list[tuple[int, int]]]
+
+  def __init__(self, patterns: list[str]):
+    self.goto = [{}]
+    self.fail = [0]
+    self.outputs = [[]]
+    for index, pattern in enumerate(patterns):
+      if len(pattern) == 0:
+        continue
+      state = 0
+      for char in pattern:
+        target = self.goto[state].get(char)
+        if target is None:
+          target = len(self.goto)
+          self.goto[state][char] = target
+          self.goto.append({})
+          self.fail.append(0)
+          self.outputs.append([])
+        state = target
+      self.outputs[state].append((index, len(pattern)))
+    # Breadth first, so the failure link of every shorter prefix is
+    # known before it is needed.
+    queue = list(self.goto[0].values())
+    for state in queue:
+      for char, target in self.goto[state].items():
+        queue.append(target)
+        link = self.fail[state]
+        while link != 0 and char not in self.goto[link]:
+          link = self.fail[link]
+        link = self.goto[link].get(char, 0)
+        self.fail[target] = link
+        self.outputs[target].extend(self.outputs[link])
+
+  def scan(
+    self,
+    text: str,
+    start: int = 0,
+    stop: Optional[int] = None,
+  ) -> Iterator[tuple[int, int]]:
+    """Yield `(pattern, position)` for each occurrence that lies
+    entirely within `text[start:stop]`.
+    """
+    if stop is None:
+      stop = len(text)
+    goto = self.goto
+    fail = self.fail
+    outputs = self.outputs
+    state = 0
+    for position in range(start, stop):
+      char = text[position]
+      while state != 0 and char not in goto[state]:
+        state = fail[state]
+      state = goto[state].get(char, 0)
+      for index, size in outputs[state]:
+        yield (index, position+1-size)
+
+class Algorithm:
+  """A Markov algorithm: an ordered list of rules. Each step rewrites
+  the leftmost occurrence of the pattern of the first rule that occurs
+  in the string, and the algorithm halts after a terminal rule or when
+  no rule applies. An empty pattern occurs at the start of any string.
+  """
+  rules: list[Rule]
+  automaton: Automaton
+  longest: int
+
+  def __init__(self, rules: list[Rule]):
+    self.rules = rules
+    self.automaton = Automaton([rule.pattern for rule in rules])
+    self.longest = max([len(rule.pattern) for rule in rules], default=0)
+
+  @staticmethod
+  def from_string(source: str) -> 'Algorithm':
+    """Read one rule per line, as `pattern -> replacement`, or with
+    `->.` for a terminal rule. Blank lines and lines starting with `#`
+    are skipped.
+    """
+    rules = []
+    for line in source.splitlines():
+      if len(line.strip()) == 0 or line.lstrip().startswith('#'):
+        continue
+      pattern, arrow, replacement = line.partition('->')
+      if arrow == '':
+        raise ValueError(f'''
+Expected a rule, but got the following line:
+
+{line}
+'''.strip())
+      terminal = replacement.startswith('.')
+      if terminal:
+        replacement = replacement[1:]
+      rules.append(Rule(pattern.strip(), replacement.strip(), terminal))
+    return Algorithm(rules)
+
+  def start(self, text: str) -> 'Rewriter':
+    return Rewriter(self, text)
+
+  def apply(self, text: str, budget: Optional[int] = None) -> str:
+    """Run the algorithm on `text` to completion. Given `budget`, at
+    most that many rewrites are made before raising `OutOfSteps`.
+    """
+    rewriter = self.start(text)
+    if not rewriter.run(budget):
+      raise OutOfSteps(rewriter)
+    return rewriter.text
+
+class Rewriter:
+  """A run of an algorithm on a string. The occurrences of every pattern
+  are found once up front and then kept up to date: after a rewrite,
+  only the occurrences that overlap it are dropped, and only the text
+  around it is scanned again.
+
+  The occurrences are kept as in a gap buffer, so a rewrite does not
+  have to renumber all the occurrences after it. Those that start
+  before the gap are kept as positions, in `left`, and the rest as
+  distances from the end of the string, in `right`, in increasing
+  order. A rewrite at the gap changes neither, and moving the gap only
+  moves the occurrences it passes over.
+  """
+  algorithm: Algorithm
+  text: str
+  steps: int
+  halted: bool
+
+  def __init__(self, algorithm: Algorithm, text: str):
+    self.algorithm = algorithm
+    self.text = text
+    self.steps = 0
+    self.halted = False
+    count = len(algorithm.rules)
+    self.left = [[] for _ in range(count)]
+    self.right = [[] for _ in range(count)]
+    self.gap = 0
+    found = sorted(algorithm.automaton.scan(text), key=lambda x: -x[1])
+    for index, position in found:
+      self.right[index].append(len(text)-position)
+
+  def first(self) -> Optional[tuple[int, int]]:
+    """The rule that applies next and where, or `None` if none does."""
+    size = len(self.text)
+    for index in range(len(self.algorithm.rules)):
+      if len(self.algorithm.rules[index].pattern) == 0:
+        return (index, 0)
+      if len(self.left[index]) > 0:
+        return (index, self.left[index][0])
+      if len(self.right[index]) > 0:
+        return (index, size-self.right[index][-1])
+    return None
+
+  def step(self) -> bool:
+    """Make one rewrite. Returns whether the algorithm can go on."""
+    if self.halted:
+      return False
+    found = self.first()
+    if found is None:
+      self.halted = True
+      return False
+    index, position = found
+    rule = self.algorithm.rules[index]
+    self._rewrite(position, len(rule.pattern), rule.replacement)
+    self.steps += 1
+    if rule.terminal:
+      self.halted = True
+    return not self.halted
+
+  def run(self, budget: Optional[int] = None) -> bool:
+    """Step until the algorithm halts, or for at most `budget` rewrites.
+    Returns whether it halted.
+    """
+    taken = 0
+    while not self.halted:
+      if budget is not None and taken >= budget:
+        return False
+      self.step()
+      taken += 1
+    return True
+
+  def _move(self, gap: int):
+    size = len(self.text)
+    if gap < self.gap:
+      for left, right in zip(self.left, self.right):
+        while len(left) > 0 and left[-1] >= gap:
+          right.append(size-left.pop())
+    elif gap > self.gap:
+      for left, right in zip(self.left, self.right):
+        while len(right) > 0 and size-right[-1] < gap:
+          left.append(size-right.pop())
+    self.gap = gap
+
+  def _rewrite(self, position: int, size: int, replacement: str):
+    longest = self.algorithm.longest
+    # Everything that could overlap the rewrite starts after `start`.
+    start = max(0, position-longest+1)
+    self._move(start)
+    old = len(self.text)
+    for right in self.right:
+      while len(right) > 0 and old-right[-1] < position+size:
+        right.pop()
+    text = self.text[:position]+replacement+self.text[position+size:]
+    self.text = text
+    end = position+len(replacement)
+    found = self.algorithm.automaton.scan(
+      text,
+      start,
+      min(len(text), end+longest-1),
+    )
+    added = [(index, at) for index, at in found if at < end]
+    added.sort(key=lambda x: -x[1])
+    for index, at in added:
+      self.right[index].append(len(text)-at)
+
+def _naive(rules: list[Rule], text: str, budget: int) -> tuple[str, int]:
+  steps = 0
+  while steps < budget:
+    for rule in rules:
+      position = text.find(rule.pattern)
+      if position >= 0:
+        break
+    else:
+      break
+    text = text[:position]+rule.replacement+text[position+len(rule.pattern):]
+    steps += 1
+    if rule.terminal:
+      break
+  return (text, steps)
+
+class TestMarkov(unittest.TestCase):
+  def test_binary(self):
+    # Converts a binary number to unary.
+    algorithm = Algorithm.from_string('''
+# binary to unary
+|0 -> 0||
+1 -> 0|
+0 ->
+''')
+    self.assertEqual('|'*13, algorithm.apply('1101'))
+    self.assertEqual('1 -> 0|', f'{algorithm.rules[1]}')
+
+  def test_terminal(self):
+    algorithm = Algorithm.from_string('''
+a ->. b
+->. x
+''')
+    self.assertEqual('cbca', algorithm.apply('caca'))
+    self.assertEqual('xccc', algorithm.apply('ccc'))
+    rewriter = Algorithm.from_string('a -> aa').start('a')
+    self.assertFalse(rewriter.run(10))
+    self.assertEqual(10, rewriter.steps)
+    self.assertRaises(OutOfSteps, rewriter.algorithm.apply, 'a', 5)
+
+  def test_naive(self):
+    rng = random.Random(0)
+    def word(low: int, high: int) -> str:
+      return ''.join(rng.choice('abc') for _ in range(rng.randint(low, high)))
+    for _ in range(300):
+      rules = [
+        Rule(word(0, 3), word(0, 3), rng.random() < 0.1)
+        for _ in range(rng.randint(1, 6))
+      ]
+      text = word(0, 30)
+      rewriter = Algorithm(rules).start(text)
+      rewriter.run(50)
+      self.assertEqual(_naive(rules, text, 50), (rewriter.text, rewriter.steps))
@@ -3,91 +3,688 @@ import PIL.Image
 
 import IPython
 
+import io
+import os
+import sys
 import time
 import math
 import tqdm
-import array
+import queue
+import numpy
+import urllib3
 import requests
+import requests.adapters
 import hashlib
+import tempfile
+import unittest
+import functools
+import threading
+import subprocess
+import collections
+import http.server
+import concurrent.futures
 
 import cairocffi as cairo
 
+from typing import Any
+from typing import Iterable
 from typing import Optional
 from typing import Callable
 
+class EncoderError(Exception):
+  command: list[str]
+  returncode: Optional[int]
+  stderr: str
+
+  def __init__(
+    self,
+    command: list[str],
+    returncode: Optional[int],
+    stderr: str,
+  ):
+    self.command = command
+    self.returncode = returncode
+    self.stderr = stderr
+
+  def __str__(self) -> str:
+    return f'''
+The encoder exited with status {self.returncode}:
+
+{' '.join(self.command)}
+
+{self.stderr}
+'''.strip()
+
+def _encoder_command(
+  source: str,
+  target: str,
+  height: int,
+  width: int,
+  framerate: int,
+) -> list[str]:
+  if target.endswith('.gif'):
+    output = []
+  elif ( False
+    or target.endswith('.webm')
+    or target.endswith('.mp4')
+  ):
+    output = ['-pix_fmt', 'yuv420p']
+  else:
+    raise ValueError(f'''
+Cannot render a video to the following target:
+
+{target}
+'''.strip())
+  return [
+    'ffmpeg',
+    '-y',
+    '-nostats',
+    '-loglevel', 'error',
+    '-f', 'rawvideo',
+    '-pix_fmt', 'bgra',
+    '-r', f'{framerate}',
+    '-s', f'{width}x{height}',
+    '-i', source,
+    *output,
+    target,
+  ]
+
+def _display(target: str) -> IPython.display.DisplayObject:
+  if target.endswith('.gif'):
+    return IPython.display.Image(filename=target)
+  return IPython.display.Video(target, embed=True)
+
 def render_video(
   source: str = 'source.raw',
   target: str = 'target.webm',
   height: int = 512,
   width: int = 512,
   framerate: int = 15,
+  frames: Optional[Iterable[Any]] = None,
 ) -> IPython.display.DisplayObject:
-  if target.endswith('.gif'):
-    parts = [
-      f'ffmpeg',
-      f'-f rawvideo',
-      f'-pix_fmt bgra',
-      f'-r {framerate}',
-      f'-s {width}x{height}',
-      f'-i {source}',
-      f'{target}',
-    ]
-    command = ' '.join(parts)
-    os.system(command)
-    image = IPython.display.Image(filename=target)
-    return image
-  elif ( False
-    or target.endswith('.webm')
-    or target.endswith('.mp4')
+  """Encode raw BGRA frames into a video or gif. The frames are read
+  from the file `source`, or given `frames`, streamed straight to the
+  encoder without touching the disk.
+  """
+  if frames is not None:
+    with VideoWriter(target, height, width, framerate) as writer:
+      writer.write_all(frames)
+    return _display(target)
+  command = _encoder_command(source, target, height, width, framerate)
+  result = subprocess.run(
+    command,
+    stdin=subprocess.DEVNULL,
+    capture_output=True,
+  )
+  if result.returncode != 0:
+    stderr = result.stderr.decode(errors='replace')
+    raise EncoderError(command, result.returncode, stderr)
+  return _display(target)
+
+class VideoWriter:
+  """Streams frames into an ffmpeg process through its stdin, so frames
+  are encoded while the next ones are rendered, and nothing is written
+  to disk but the video itself.
+
+  A frame is BGRA bytes, an array of shape `(height, width, 4)` in BGRA
+  order, a Cairo `ImageSurface` in `FORMAT_ARGB32` or `FORMAT_RGB24`, or
+  a PIL image. Frames are copied and handed to a writer thread through a
+  queue of at most `queue_size` frames, so `write` blocks when the
+  encoder falls behind rather than buffering the whole clip. If the
+  encoder fails, the next `write` or `close` raises `EncoderError`.
+
+  The encoder is ffmpeg, unless `command` names another program to
+  read the frames from its stdin.
+  """
+  target: str
+  height: int
+  width: int
+  command: list[str]
+  process: subprocess.Popen
+
+  def __init__(
+    self,
+    target: str,
+    height: int,
+    width: int,
+    framerate: int = 15,
+    queue_size: int = 8,
+    command: Optional[list[str]] = None,
   ):
-    parts = [
-      f'ffmpeg',
-      f'-f rawvideo',
-      f'-pix_fmt bgra',
-      f'-r {framerate}',
-      f'-s {width}x{height}',
-      f'-i {source}',
-      f'-pix_fmt yuv420p',
-      f'{target}',
-    ]
-    command = ' '.join(parts)
-    os.system(command)
-    video = IPython.display.Video(target, embed=True)
-    return video
+    if command is None:
+      command = _encoder_command('pipe:0', target, height, width, framerate)
+    self.target = target
+    self.height = height
+    self.width = width
+    self.command = command
+    self.process = subprocess.Popen(
+      self.command,
+      stdin=subprocess.PIPE,
+      stdout=subprocess.DEVNULL,
+      stderr=subprocess.PIPE,
+    )
+    self.frames = 0
+    self._queue = queue.Queue(maxsize=queue_size)
+    self._failed = None
+    self._closed = False
+    # Only the end of the encoder's output is kept for the error.
+    self._stderr = collections.deque(maxlen=64)
+    self._writer = threading.Thread(target=self._write_frames, daemon=True)
+    self._reader = threading.Thread(target=self._read_stderr, daemon=True)
+    self._writer.start()
+    self._reader.start()
+
+  def write(self, frame: Any):
+    if self._closed:
+      raise ValueError('Cannot write to a closed video writer')
+    if self._failed is not None:
+      self._fail()
+    data = _frame_bytes(frame, self.height, self.width)
+    self._queue.put(data)
+    self.frames += 1
+
+  def write_all(self, frames: Iterable[Any]):
+    for frame in frames:
+      self.write(frame)
+
+  def close(self):
+    if self._closed:
+      return
+    self._closed = True
+    self._queue.put(None)
+    self._writer.join()
+    try:
+      self.process.stdin.close()
+    except OSError as error:
+      self._failed = self._failed or error
+    returncode = self.process.wait()
+    self._reader.join()
+    if returncode != 0 or self._failed is not None:
+      self._fail()
+
+  def abort(self):
+    """Stop the encoder without waiting for it to finish."""
+    self._closed = True
+    self.process.kill()
+    self._queue.put(None)
+    self._writer.join()
+    self.process.wait()
+
+  def __enter__(self) -> 'VideoWriter':
+    return self
+
+  def __exit__(self, kind, value, traceback):
+    if kind is None:
+      self.close()
+    else:
+      self.abort()
+
+  def _fail(self):
+    # A failed write means the encoder closed its input, so give it a
+    # moment to exit and finish its complaint.
+    try:
+      returncode = self.process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+      returncode = None
+    self._reader.join(timeout=5)
+    stderr = b''.join(self._stderr).decode(errors='replace').strip()
+    if stderr == '' and self._failed is not None:
+      stderr = f'{self._failed}'
+    raise EncoderError(self.command, returncode, stderr)
+
+  def _write_frames(self):
+    stdin = self.process.stdin
+    while True:
+      data = self._queue.get()
+      if data is None:
+        return
+      if self._failed is not None:
+        # Keep taking frames so that `write` never blocks on a dead
+        # encoder.
+        continue
+      try:
+        stdin.write(data)
+      except (BrokenPipeError, OSError) as error:
+        self._failed = error
+
+  def _read_stderr(self):
+    for line in self.process.stderr:
+      self._stderr.append(line)
+
+def _frame_bytes(frame: Any, height: int, width: int) -> bytes:
+  # A copy of the frame as tightly packed BGRA rows, since the caller
+  # may draw the next frame into the same buffer while this one waits
+  # in the queue.
+  row = width*4
+  if isinstance(frame, cairo.ImageSurface):
+    frame.flush()
+    stride = frame.get_stride()
+    data = bytes(frame.get_data())
+    if stride != row:
+      data = b''.join(
+        data[y*stride:y*stride+row] for y in range(frame.get_height())
+      )
+  elif isinstance(frame, PIL.Image.Image):
+    if frame.mode != 'RGBA':
+      frame = frame.convert('RGBA')
+    data = frame.tobytes('raw', 'BGRA')
+  elif isinstance(frame, numpy.ndarray):
+    data = numpy.ascontiguousarray(frame, dtype=numpy.uint8).tobytes()
+  elif isinstance(frame, (bytes, bytearray, memoryview)):
+    data = bytes(frame)
   else:
-    raise ValueError(f'''                                                                                                                                                                       
-Cannot render a video to the following target:                                                                                                                                                  
-                                                                                                                                                                                                
-{target}                                                                                                                                                                                        
+    raise ValueError(f'''
+Cannot write the following value as a frame:
+
+{frame}
+'''.strip())
+  if len(data) != row*height:
+    raise ValueError(f'''
+Expected a frame of {width}x{height} BGRA pixels ({row*height} bytes),
+but got {len(data)} bytes
 '''.strip())
+  return data
 
 def fetch_image(url: str) -> PIL.Image.Image:
-  bits = requests.get(url, stream=True).raw
-  return PIL.Image.open(bits)
+  (result,) = fetch_images([url])
+  return result.image
+
+class LazyImage:
+  """A downloaded image that is only decoded when `image` is first
+  used. The bytes are on disk at `path` if the download went through a
+  cache, and held in memory otherwise.
+  """
+  url: str
+  digest: str
+  path: Optional[str]
+
+  def __init__(
+    self,
+    url: str,
+    digest: str,
+    path: Optional[str] = None,
+    data: Optional[bytes] = None,
+  ):
+    self.url = url
+    self.digest = digest
+    self.path = path
+    self._data = data
+
+  @functools.cached_property
+  def image(self) -> PIL.Image.Image:
+    if self.path is not None:
+      return PIL.Image.open(self.path)
+    return PIL.Image.open(io.BytesIO(self._data))
+
+  def read(self) -> bytes:
+    if self._data is not None:
+      return self._data
+    with open(self.path, 'rb') as file:
+      return file.read()
+
+class ImageCache:
+  """A content-addressed cache of downloads on disk. Each download is
+  stored once under the `sha256` of its bytes, and each URL remembers
+  the digest of what it returned, so fetching the same URL or the same
+  image from another URL costs nothing. Once the blobs take more than
+  `max_bytes`, the least recently used ones are evicted, going by the
+  later of their access and modification times, which a hit refreshes.
+  """
+  directory: str
+  max_bytes: int
+  hits: int
+  downloads: int
+  evictions: int
+
+  def __init__(self, directory: str, max_bytes: int = 1 << 30):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.downloads = 0
+    self.evictions = 0
+    os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'urls'), exist_ok=True)
+    self._lock = threading.Lock()
+
+  def blob_path(self, digest: str) -> str:
+    return os.path.join(self.directory, 'blobs', digest[:2], digest)
+
+  def _url_path(self, url: str) -> str:
+    return os.path.join(self.directory, 'urls', sha256(url))
+
+  def get(self, url: str) -> Optional[LazyImage]:
+    try:
+      with open(self._url_path(url)) as file:
+        digest = file.read().strip()
+      path = self.blob_path(digest)
+      os.utime(path)
+    except OSError:
+      return None
+    with self._lock:
+      self.hits += 1
+    return LazyImage(url, digest, path=path)
+
+  def put(self, url: str, data: bytes) -> LazyImage:
+    digest = sha256(data)
+    path = self.blob_path(digest)
+    if os.path.exists(path):
+      os.utime(path)
+    else:
+      _write_atomic(path, data)
+    _write_atomic(self._url_path(url), digest.encode())
+    with self._lock:
+      self.downloads += 1
+    return LazyImage(url, digest, path=path)
+
+  def size(self) -> int:
+    return sum(size for _, _, size in self._blobs())
+
+  def evict(self, keep: Iterable[str] = ()):
+    """Delete the least recently used blobs until the cache fits in
+    `max_bytes`, sparing the digests in `keep`.
+    """
+    keep = set(keep)
+    blobs = sorted(self._blobs(), key=lambda blob: blob[1])
+    total = sum(size for _, _, size in blobs)
+    for path, _, size in blobs:
+      if total <= self.max_bytes:
+        break
+      if os.path.basename(path) in keep:
+        continue
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+      self.evictions += 1
+
+  def _blobs(self) -> list[tuple[str, float, int]]:
+    result = []
+    root = os.path.join(self.directory, 'blobs')
+    for prefix in os.scandir(root):
+      if not prefix.is_dir():
+        continue
+      for entry in os.scandir(prefix.path):
+        if entry.name.startswith('.'):
+          continue
+        stat = entry.stat()
+        used = max(stat.st_atime, stat.st_mtime)
+        result.append((entry.path, used, stat.st_size))
+    return result
+
+def _write_atomic(path: str, data: bytes):
+  # Write next to the target and rename, so a concurrent reader never
+  # sees half a file.
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+  try:
+    with os.fdopen(handle, 'wb') as file:
+      file.write(data)
+    os.replace(temporary, path)
+  except BaseException:
+    os.unlink(temporary)
+    raise
+
+def image_session(
+  workers: int = 8,
+  retries: int = 3,
+  backoff: float = 0.5,
+) -> requests.Session:
+  """A session whose connection pool fits `workers` threads, retrying
+  failed connections and transient server errors with backoff.
+  """
+  retry = urllib3.util.Retry(
+    total=retries,
+    backoff_factor=backoff,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=['GET'],
+  )
+  adapter = requests.adapters.HTTPAdapter(
+    pool_connections=workers,
+    pool_maxsize=workers,
+    max_retries=retry,
+  )
+  session = requests.Session()
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+  return session
+
+def fetch_images(
+  urls: Iterable[str],
+  cache: Optional[ImageCache] = None,
+  workers: int = 8,
+  retries: int = 3,
+  timeout: float = 30,
+  session: Optional[requests.Session] = None,
+) -> list[LazyImage]:
+  """Download many images over one pooled session, at most `workers`
+  at a time, in the order of `urls`. Each URL is downloaded once, and
+  not at all if it is already in `cache`. Images are not decoded until
+  they are used.
+  """
+  urls = list(urls)
+  if session is None:
+    session = image_session(workers, retries)
+  def fetch(url: str) -> LazyImage:
+    if cache is not None:
+      result = cache.get(url)
+      if result is not None:
+        return result
+    response = session.get(url, timeout=timeout)
+    response.raise_for_status()
+    data = response.content
+    if cache is not None:
+      return cache.put(url, data)
+    return LazyImage(url, sha256(data), data=data)
+  unique = list(dict.fromkeys(urls))
+  with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+    fetched = dict(zip(unique, pool.map(fetch, unique)))
+  if cache is not None:
+    cache.evict(keep=[image.digest for image in fetched.values()])
+  return [fetched[url] for url in urls]
 
 def cat_image(images: list[PIL.Image.Image], rows: int, cols: int):
   assert len(images) == rows * cols
+  grid = grid_image(images, rows, cols, cell=images[0].size, mode='RGB')
+  return PIL.Image.fromarray(grid, 'RGB')
 
-  width, height = images[0].size
-  grid = PIL.Image.new(
-    'RGB',
-    size=(cols * width, rows * height),
-  )
+_CHANNELS = {'L': 1, 'RGB': 3, 'RGBA': 4}
+
+def grid_image(
+  images: list[Any],
+  rows: int,
+  cols: int,
+  cell: Optional[tuple[int, int]] = None,
+  mode: str = 'RGB',
+  background: int = 0,
+  target: Optional[str] = None,
+  workers: int = 0,
+) -> numpy.ndarray:
+  """Lay out up to `rows * cols` images in a grid, left to right and
+  top to bottom, into one array of shape `(height, width, channels)`.
 
-  for index, image in enumerate(images):
-    box = (index % cols * width, index // cols * height)
-    grid.paste(image, box=box)
+  Images can be PIL images, `LazyImage`s, paths or arrays, of any size
+  and mode; each is converted to `mode` ('L', 'RGB' or 'RGBA'),
+  shrunk to fit in a cell if it is too big, and centered in its cell.
+  Cells are `cell` pixels (width, height), or by default as big as the
+  biggest image. Given `target`, the grid is a `numpy.memmap` of an
+  `.npy` file there rather than an array in memory, for grids too large
+  to hold. With `workers`, images are decoded in a thread pool, with
+  only a few of them decoded ahead at a time.
+  """
+  assert len(images) <= rows * cols
+  if mode not in _CHANNELS:
+    raise ValueError(f'''
+Cannot compose a grid in the following mode:
 
+{mode}
+'''.strip())
+  if cell is None:
+    sizes = [_tile_size(image) for image in images]
+    cell = (
+      max([width for width, _ in sizes], default=1),
+      max([height for _, height in sizes], default=1),
+    )
+  width, height = cell
+  shape = (rows * height, cols * width, _CHANNELS[mode])
+  if target is None:
+    grid = numpy.full(shape, background, dtype=numpy.uint8)
+  else:
+    grid = numpy.lib.format.open_memmap(
+      target,
+      mode='w+',
+      dtype=numpy.uint8,
+      shape=shape,
+    )
+    grid[...] = background
+  def place(index: int, tile: numpy.ndarray):
+    top = index // cols * height + (height - tile.shape[0]) // 2
+    left = index % cols * width + (width - tile.shape[1]) // 2
+    grid[top:top+tile.shape[0], left:left+tile.shape[1]] = tile
+  def decode(image: Any) -> numpy.ndarray:
+    return _tile_array(image, mode, cell)
+  if workers <= 0:
+    for index, image in enumerate(images):
+      place(index, decode(image))
+  else:
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+      pending = collections.deque()
+      for index, image in enumerate(images):
+        pending.append((index, pool.submit(decode, image)))
+        if len(pending) >= 2 * workers:
+          index, future = pending.popleft()
+          place(index, future.result())
+      while len(pending) > 0:
+        index, future = pending.popleft()
+        place(index, future.result())
+  if target is not None:
+    grid.flush()
   return grid
 
+def _tile_image(image: Any) -> PIL.Image.Image:
+  if isinstance(image, LazyImage):
+    return image.image
+  if isinstance(image, str):
+    return PIL.Image.open(image)
+  if isinstance(image, numpy.ndarray):
+    return PIL.Image.fromarray(image)
+  return image
+
+def _tile_size(image: Any) -> tuple[int, int]:
+  if isinstance(image, numpy.ndarray):
+    return (image.shape[1], image.shape[0])
+  # Opening an image only reads its header.
+  return _tile_image(image).size
+
+def _tile_array(
+  image: Any,
+  mode: str,
+  cell: tuple[int, int],
+) -> numpy.ndarray:
+  image = _tile_image(image)
+  if image.width > cell[0] or image.height > cell[1]:
+    image = image.copy()
+    image.thumbnail(cell, _LANCZOS)
+  if image.mode != mode:
+    image = image.convert(mode)
+  return numpy.asarray(image).reshape(image.height, image.width, -1)
+
+# `ANTIALIAS` is gone from Pillow 10, and the filters moved into
+# `Resampling` in 9.1.
+_RESAMPLING = getattr(PIL.Image, 'Resampling', PIL.Image)
+_LANCZOS = _RESAMPLING.LANCZOS
+
+FILTERS = {
+  'nearest': _RESAMPLING.NEAREST,
+  'box': _RESAMPLING.BOX,
+  'bilinear': _RESAMPLING.BILINEAR,
+  'hamming': _RESAMPLING.HAMMING,
+  'bicubic': _RESAMPLING.BICUBIC,
+  'lanczos': _RESAMPLING.LANCZOS,
+}
+
 def scale_image(image: PIL.Image.Image, factor: float) -> PIL.Image.Image:
   width  = int(image.width  * factor)
   height = int(image.height * factor)
-  return image.resize((width, height), PIL.Image.ANTIALIAS)
+  return image.resize((width, height), _LANCZOS)
+
+def scale_images(
+  images: list[Any],
+  factor: Optional[float] = None,
+  size: Optional[tuple[int, int]] = None,
+  filter: str = 'lanczos',
+  workers: int = 8,
+  cache: Optional[str] = None,
+) -> list[PIL.Image.Image]:
+  """Resize many images in a thread pool, which runs in parallel since
+  Pillow lets go of the GIL while it resamples. Each image is scaled by
+  `factor`, or to exactly `size` (width, height).
+
+  Images can be PIL images, `LazyImage`s or paths. A JPEG given as a
+  path or `LazyImage` is decoded at a reduced scale with `draft` when it
+  is being shrunk, which is much faster than decoding it in full. PIL
+  images are the caller's, and are left as they are. Given a
+  `cache` directory, each variant is stored there as a PNG under the
+  `sha256` of its source, its size and its filter, and later calls load
+  it from there instead.
+  """
+  assert (factor is None) != (size is None)
+  if filter not in FILTERS:
+    raise ValueError(f'''
+Unknown resampling filter: {filter}
+'''.strip())
+  if cache is not None:
+    os.makedirs(cache, exist_ok=True)
+  def scale(source: Any) -> PIL.Image.Image:
+    image, digest = _open_source(source)
+    target = size
+    if target is None:
+      target = (int(image.width * factor), int(image.height * factor))
+    path = None
+    if cache is not None:
+      if digest is None:
+        digest = sha256(image)
+      name = f'{digest}-{target[0]}x{target[1]}-{filter}.png'
+      path = os.path.join(cache, name)
+      if os.path.exists(path):
+        result = PIL.Image.open(path)
+        result.load()
+        return result
+    if (
+      # `draft` changes the image itself, so only on one opened here.
+      image is not source
+      and image.format == 'JPEG'
+      and target[0] < image.width
+      and target[1] < image.height
+    ):
+      image.draft(image.mode, target)
+    result = image.resize(target, FILTERS[filter])
+    if path is not None:
+      stream = io.BytesIO()
+      result.save(stream, 'PNG')
+      _write_atomic(path, stream.getvalue())
+    return result
+  with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+    return list(pool.map(scale, images))
+
+def _open_source(image: Any) -> tuple[PIL.Image.Image, Optional[str]]:
+  # A fresh, undecoded image where possible so `draft` still applies,
+  # along with the digest of its file when that is cheap to get.
+  if isinstance(image, LazyImage):
+    if image.path is not None:
+      return (PIL.Image.open(image.path), image.digest)
+    return (PIL.Image.open(io.BytesIO(image.read())), image.digest)
+  if isinstance(image, str):
+    with open(image, 'rb') as file:
+      data = file.read()
+    return (PIL.Image.open(io.BytesIO(data)), sha256(data))
+  return (image, None)
 
 def sha256(value) -> str:
   if isinstance(value, str):
     return hashlib.sha256(value.encode()).hexdigest()
+  elif isinstance(value, (bytes, bytearray, memoryview)):
+    return hashlib.sha256(value).hexdigest()
   elif isinstance(value, PIL.Image.Image):
     return hashlib.sha256(value.tobytes()).hexdigest()
   else:
@@ -98,20 +695,333 @@ Cannot compute the SHA256 hash of the following value:
 '''.strip())
 
 def pil_from_cairo(surface: cairo.ImageSurface) -> PIL.Image.Image:
-  buf = surface.get_data()
-  width = surface.get_width()
-  height = surface.get_height()
-  stride = surface.get_stride()
-  return PIL.Image.frombuffer("RGBA", (width, height), buf, "raw", "BGRA", stride)
+  """A copy of the surface as an RGBA image, with premultiplied alpha
+  undone, so it stays valid whatever later happens to the surface.
+  """
+  return PixelBuffer.from_cairo(surface).image()
 
 def cairo_from_pil(image: PIL.Image.Image) -> cairo.ImageSurface:
-  if image.mode != 'RGBA':
-    image = image.convert('RGBA')
-  data = array.array('B', image.tobytes())
-  surface = cairo.ImageSurface.create_for_data(
-    data,
-    cairo.FORMAT_ARGB32,
-    image.width,
-    image.height,
-  )
-  return surface
+  """A new surface holding the image, in Cairo's row stride and
+  premultiplied byte order. The surface keeps its buffer alive."""
+  return PixelBuffer.from_pil(image).surface()
+
+# The offsets of the red, green, blue and alpha bytes of a pixel of a
+# Cairo ARGB32 surface, which is a native-endian 32-bit word.
+if sys.byteorder == 'little':
+  _CAIRO_ORDER = (2, 1, 0, 3)
+else:
+  _CAIRO_ORDER = (1, 2, 3, 0)
+
+class PixelBuffer:
+  """One allocation of pixels, seen as a Cairo `ImageSurface`, a PIL
+  image and a NumPy array without copying. Cairo and PIL disagree on
+  the layout of a pixel: Cairo wants native-endian ARGB with
+  premultiplied alpha, and PIL straight RGBA bytes. So the buffer is in
+  one `layout` at a time, 'cairo' or 'pil', and `surface` and `image`
+  convert it in place, a band of rows at a time, before handing out
+  their view. A view of the other layout is still valid memory, but its
+  pixels are scrambled until the buffer is converted back.
+  """
+  width: int
+  height: int
+  stride: int
+  data: numpy.ndarray
+  layout: str
+
+  # How many rows to convert at once, which bounds the temporaries.
+  BAND = 64
+
+  def __init__(self, width: int, height: int, layout: str = 'cairo'):
+    assert layout in ['cairo', 'pil']
+    self.width = width
+    self.height = height
+    # Cairo needs rows aligned to 4 bytes, which 4-byte pixels already
+    # are, so the stride is the same for both libraries.
+    self.stride = width * 4
+    self.data = numpy.zeros((height, self.stride), dtype=numpy.uint8)
+    self.layout = layout
+    self._surface = None
+
+  @staticmethod
+  def from_pil(image: PIL.Image.Image) -> 'PixelBuffer':
+    if image.mode != 'RGBA':
+      image = image.convert('RGBA')
+    result = PixelBuffer(image.width, image.height, layout='pil')
+    result.array[...] = numpy.asarray(image)
+    return result
+
+  @staticmethod
+  def from_cairo(surface: cairo.ImageSurface) -> 'PixelBuffer':
+    kind = surface.get_format()
+    if kind not in [cairo.FORMAT_ARGB32, cairo.FORMAT_RGB24]:
+      raise ValueError(f'''
+Cannot read a Cairo surface with the following format:
+
+{kind}
+'''.strip())
+    surface.flush()
+    width = surface.get_width()
+    height = surface.get_height()
+    stride = surface.get_stride()
+    source = numpy.frombuffer(surface.get_data(), dtype=numpy.uint8)
+    source = source[:height * stride].reshape(height, stride)
+    result = PixelBuffer(width, height, layout='cairo')
+    result.data[...] = source[:, :width * 4]
+    if kind == cairo.FORMAT_RGB24:
+      # The unused byte of RGB24 is undefined, and means opaque.
+      result.array[..., _CAIRO_ORDER[3]] = 255
+    return result
+
+  @property
+  def array(self) -> numpy.ndarray:
+    """The pixels as an array of shape `(height, width, 4)`, in the
+    byte order of the current layout."""
+    return self.data.reshape(self.height, self.width, 4)
+
+  def surface(self) -> cairo.ImageSurface:
+    self.to_cairo()
+    if self._surface is None:
+      self._surface = cairo.ImageSurface.create_for_data(
+        self.data,
+        cairo.FORMAT_ARGB32,
+        self.width,
+        self.height,
+        self.stride,
+      )
+    return self._surface
+
+  def image(self) -> PIL.Image.Image:
+    self.to_pil()
+    return PIL.Image.frombuffer(
+      'RGBA',
+      (self.width, self.height),
+      self.data,
+      'raw',
+      'RGBA',
+      self.stride,
+      1,
+    )
+
+  def to_pil(self):
+    if self.layout == 'pil':
+      return
+    if self._surface is not None:
+      self._surface.flush()
+    red, green, blue, alpha = _CAIRO_ORDER
+    pixels = self.array
+    for top in range(0, self.height, self.BAND):
+      band = pixels[top:top + self.BAND]
+      a = band[..., alpha].astype(numpy.uint16)[..., None]
+      color = band[..., [red, green, blue]].astype(numpy.uint16)
+      color *= 255
+      color += a // 2
+      color //= numpy.maximum(a, 1)
+      numpy.minimum(color, 255, out=color)
+      band[..., 3] = a[..., 0]
+      band[..., :3] = color
+    self.layout = 'pil'
+
+  def to_cairo(self):
+    if self.layout == 'cairo':
+      return
+    red, green, blue, alpha = _CAIRO_ORDER
+    pixels = self.array
+    for top in range(0, self.height, self.BAND):
+      band = pixels[top:top + self.BAND]
+      a = band[..., 3].astype(numpy.uint16)[..., None]
+      color = band[..., :3].astype(numpy.uint16)
+      color *= a
+      color += 127
+      color //= 255
+      band[..., alpha] = a[..., 0]
+      band[..., red] = color[..., 0]
+      band[..., green] = color[..., 1]
+      band[..., blue] = color[..., 2]
+    self.layout = 'cairo'
+    if self._surface is not None:
+      self._surface.mark_dirty()
+
+class TestVideo(unittest.TestCase):
+  def test_stream(self):
+    with tempfile.TemporaryDirectory() as directory:
+      target = os.path.join(directory, 'frames.raw')
+      # Stands in for ffmpeg by copying its input to the target.
+      command = [
+        sys.executable,
+        '-c',
+        'import shutil, sys; '
+        'shutil.copyfileobj(sys.stdin.buffer, open(sys.argv[1], "wb"))',
+        target,
+      ]
+      frames = [
+        numpy.full((3, 2, 4), index, numpy.uint8) for index in range(5)
+      ]
+      with VideoWriter(target, 3, 2, queue_size=2, command=command) as writer:
+        writer.write_all(frames)
+        writer.write(PIL.Image.new('RGBA', (2, 3), (1, 2, 3, 4)))
+      with open(target, 'rb') as file:
+        data = file.read()
+      self.assertEqual(6, writer.frames)
+      expected = b''.join(frame.tobytes() for frame in frames)
+      self.assertEqual(expected+b'\x03\x02\x01\x04'*6, data)
+      self.assertRaises(ValueError, writer.write, frames[0])
+
+  def test_error(self):
+    command = [
+      sys.executable,
+      '-c',
+      'import sys; sys.stdin.buffer.read(1); '
+      'sys.stderr.write("no such codec\\n"); sys.exit(3)',
+    ]
+    frame = bytes(2*2*4)
+    with self.assertRaises(EncoderError) as context:
+      with VideoWriter('out.webm', 2, 2, command=command) as writer:
+        for _ in range(100):
+          writer.write(frame)
+        writer.close()
+    self.assertEqual(3, context.exception.returncode)
+    self.assertEqual('no such codec', context.exception.stderr)
+    self.assertIn('no such codec', f'{context.exception}')
+    writer = VideoWriter('out.webm', 2, 2, command=command)
+    self.assertRaises(ValueError, writer.write, bytes(3))
+    writer.abort()
+
+class TestFetch(unittest.TestCase):
+  def test_cache(self):
+    images = {}
+    for index, color in enumerate(['red', 'green', 'blue']):
+      stream = io.BytesIO()
+      PIL.Image.new('RGB', (8, 8), color).save(stream, 'PNG')
+      images[f'/{index}.png'] = stream.getvalue()
+    images['/copy.png'] = images['/0.png']
+    requested = []
+    class Handler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        requested.append(self.path)
+        data = images.get(self.path)
+        if data is None:
+          self.send_error(404)
+          return
+        self.send_response(200)
+        self.send_header('Content-Length', f'{len(data)}')
+        self.end_headers()
+        self.wfile.write(data)
+
+      def log_message(self, *args):
+        pass
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+    try:
+      with tempfile.TemporaryDirectory() as directory:
+        cache = ImageCache(directory)
+        urls = [f'{base}/{name}' for name in ['0.png', '1.png', '0.png']]
+        first = fetch_images(urls, cache=cache, workers=2)
+        self.assertEqual(2, len(requested))
+        self.assertEqual((8, 8), first[0].image.size)
+        self.assertEqual(first[0].digest, first[2].digest)
+        second = fetch_images(urls+[f'{base}/copy.png'], cache=cache)
+        self.assertEqual(3, len(requested))
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(first[0].digest, second[3].digest)
+        self.assertEqual(2, len(cache._blobs()))
+        cache.max_bytes = len(images['/2.png'])
+        (last,) = fetch_images([f'{base}/2.png'], cache=cache)
+        self.assertEqual([last.path], [path for path, _, _ in cache._blobs()])
+        self.assertRaises(
+          requests.HTTPError,
+          fetch_images,
+          [f'{base}/missing.png'],
+          retries=0,
+        )
+    finally:
+      server.shutdown()
+      server.server_close()
+
+class TestGrid(unittest.TestCase):
+  def test_grid(self):
+    images = [
+      PIL.Image.new('RGB', (4, 2), 'red'),
+      PIL.Image.new('L', (2, 4), 255),
+      numpy.full((2, 2, 4), 7, dtype=numpy.uint8),
+      PIL.Image.new('RGBA', (8, 8), 'blue'),
+    ]
+    grid = grid_image(images, 2, 2, cell=(4, 4), background=1)
+    self.assertEqual((8, 8, 3), grid.shape)
+    self.assertEqual([255, 0, 0], list(grid[1, 0]))
+    self.assertEqual([1, 1, 1], list(grid[0, 0]))
+    self.assertEqual([255, 255, 255], list(grid[0, 5]))
+    self.assertEqual([7, 7, 7], list(grid[5, 1]))
+    self.assertEqual([0, 0, 255], list(grid[7, 7]))
+    self.assertEqual((16, 16, 3), grid_image(images, 2, 2).shape)
+    with tempfile.TemporaryDirectory() as directory:
+      target = os.path.join(directory, 'grid.npy')
+      mapped = grid_image(
+        images,
+        2,
+        2,
+        cell=(4, 4),
+        background=1,
+        target=target,
+        workers=2,
+      )
+      self.assertTrue(numpy.array_equal(grid, mapped))
+      self.assertTrue(numpy.array_equal(grid, numpy.load(target)))
+    same = [PIL.Image.new('RGB', (3, 3), color) for color in ['red', 'green']]
+    self.assertEqual((6, 3), cat_image(same, 1, 2).size)
+
+class TestScale(unittest.TestCase):
+  def test_scale(self):
+    with tempfile.TemporaryDirectory() as directory:
+      photo = os.path.join(directory, 'photo.jpg')
+      gradient = numpy.arange(256*256*3, dtype=numpy.uint32) % 251
+      gradient = gradient.astype(numpy.uint8).reshape(256, 256, 3)
+      PIL.Image.fromarray(gradient).save(photo, 'JPEG')
+      images = [photo, PIL.Image.new('RGBA', (10, 20), 'red')]
+      cache = os.path.join(directory, 'variants')
+      first = scale_images(images, factor=0.25, cache=cache, workers=2)
+      self.assertEqual([(64, 64), (2, 5)], [image.size for image in first])
+      self.assertEqual(2, len(os.listdir(cache)))
+      second = scale_images(images, factor=0.25, cache=cache)
+      for lhs, rhs in zip(first, second):
+        self.assertEqual(lhs.tobytes(), rhs.tobytes())
+      scale_images(images, size=(8, 8), filter='box', cache=cache)
+      self.assertEqual(4, len(os.listdir(cache)))
+      self.assertEqual((5, 10), scale_image(images[1], 0.5).size)
+
+  def test_caller_image(self):
+    with tempfile.TemporaryDirectory() as directory:
+      photo = os.path.join(directory, 'photo.jpg')
+      PIL.Image.new('RGB', (512, 512), 'blue').save(photo, 'JPEG')
+      with PIL.Image.open(photo) as image:
+        (result,) = scale_images([image], factor=0.25)
+        self.assertEqual((128, 128), result.size)
+        self.assertEqual((512, 512), image.size)
+        image.load()
+        self.assertEqual((512, 512), image.size)
+
+class TestPixelBuffer(unittest.TestCase):
+  def test_layouts(self):
+    image = PIL.Image.new('RGBA', (3, 130), (200, 100, 50, 255))
+    image.putpixel((1, 0), (200, 100, 50, 128))
+    image.putpixel((2, 0), (200, 100, 50, 0))
+    buffer = PixelBuffer.from_pil(image)
+    view = buffer.image()
+    self.assertEqual((200, 100, 50, 255), view.getpixel((0, 129)))
+    buffer.to_cairo()
+    red, green, blue, alpha = _CAIRO_ORDER
+    pixel = buffer.array[0, 1]
+    self.assertEqual(
+      (100, 50, 25, 128),
+      (pixel[red], pixel[green], pixel[blue], pixel[alpha]),
+    )
+    self.assertEqual([0, 0, 0, 0], list(buffer.array[0, 2]))
+    view = buffer.image()
+    self.assertEqual((200, 100, 50, 255), view.getpixel((0, 0)))
+    self.assertEqual(128, view.getpixel((1, 0))[3])
+    for expected, actual in zip((200, 100, 50), view.getpixel((1, 0))):
+      self.assertLessEqual(abs(expected - actual), 2)
+    # The image is a view of the buffer, not a copy.
+    buffer.array[0, 0] = (1, 2, 3, 4)
+    self.assertEqual((1, 2, 3, 4), view.getpixel((0, 0)))
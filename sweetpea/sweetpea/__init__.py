@@ -1 +1,7 @@
 from . import expression
+from . import machine
+from . import search
+from . import batch
+from . import binary
+from . import statement
+from . import optimize
@@ -0,0 +1,133 @@
+import os
+import unittest
+import collections
+import concurrent.futures
+
+from typing import Iterable
+from typing import Iterator
+from typing import Optional
+
+from .expression import Error
+from .expression import Expression
+
+def normalize_many(
+  exprs: Iterable[Expression],
+  workers: Optional[int] = None,
+  chunksize: int = 256,
+  ordered: bool = True,
+  fuel: Optional[int] = None,
+  timeout: Optional[float] = None,
+) -> Iterator:
+  """Normalize many independent expressions in a process pool of
+  `workers` processes (by default one per core, and none at all for
+  zero). Expressions are sent to the workers `chunksize` at a time in
+  their wire form, and only a few chunks per worker are in flight, so
+  `exprs` can be a long lazy iterable.
+
+  When `ordered`, results are yielded in input order; otherwise each
+  result is yielded as `(index, value)` as soon as its chunk is done.
+  With `fuel` or `timeout`, an expression that runs out of either is
+  given the value `None`.
+  """
+  if workers is None:
+    workers = os.cpu_count() or 1
+  chunks = _chunks(exprs, chunksize)
+  if workers <= 0:
+    index = 0
+    for chunk in chunks:
+      for value in _normalize_chunk(chunk, fuel, timeout):
+        value = _decode(value)
+        yield value if ordered else (index, value)
+        index += 1
+    return
+  with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+    pending = collections.deque()
+    start = 0
+    for chunk in chunks:
+      future = pool.submit(_normalize_chunk, chunk, fuel, timeout)
+      pending.append((start, future))
+      start += len(chunk)
+      if len(pending) >= 2*workers:
+        yield from _drain(pending, ordered)
+    while len(pending) > 0:
+      yield from _drain(pending, ordered)
+
+def _drain(pending: collections.deque, ordered: bool) -> Iterator:
+  # Yield the results of at least one finished chunk: the oldest one
+  # when ordered, or any finished one otherwise.
+  if ordered:
+    start, future = pending.popleft()
+    finished = [(start, future)]
+  else:
+    futures = [future for _, future in pending]
+    done, _ = concurrent.futures.wait(
+      futures,
+      return_when=concurrent.futures.FIRST_COMPLETED,
+    )
+    finished = [entry for entry in pending if entry[1] in done]
+    for entry in finished:
+      pending.remove(entry)
+  for start, future in finished:
+    for offset, value in enumerate(future.result()):
+      value = _decode(value)
+      yield value if ordered else (start+offset, value)
+
+def _chunks(exprs: Iterable[Expression], size: int) -> Iterator[list[bytes]]:
+  chunk = []
+  for value in exprs:
+    chunk.append(value.to_wire())
+    if len(chunk) == size:
+      yield chunk
+      chunk = []
+  if len(chunk) > 0:
+    yield chunk
+
+def _normalize_chunk(
+  chunk: list[bytes],
+  fuel: Optional[int],
+  timeout: Optional[float],
+) -> list[Optional[bytes]]:
+  # Takes and returns wire forms, so a chunk crosses to and from a
+  # worker as bytes rather than as pickled nodes.
+  results = []
+  for data in chunk:
+    value = Expression.from_wire(data)
+    try:
+      value = Expression.normalize(value, fuel=fuel, timeout=timeout)
+      results.append(value.to_wire())
+    except Error:
+      results.append(None)
+  return results
+
+def _decode(data: Optional[bytes]) -> Optional[Expression]:
+  if data is None:
+    return None
+  return Expression.from_wire(data)
+
+class TestBatch(unittest.TestCase):
+  def test_normalize_many(self):
+    sources = [
+      '[foo] [bar] f',
+      '[foo] d',
+      '[d a] d a',
+      '[foo] [bar] c a',
+      'baz [quux] a',
+    ] * 5
+    exprs = [Expression.from_string(source) for source in sources]
+    expected = [
+      None if source == '[d a] d a' else Expression.normalize(value)
+      for source, value in zip(sources, exprs)
+    ]
+    actual = list(normalize_many(exprs, workers=0, chunksize=3, fuel=100))
+    self.assertEqual(expected, actual)
+    actual = list(normalize_many(exprs, workers=2, chunksize=3, fuel=100))
+    self.assertEqual(expected, actual)
+    actual = normalize_many(
+      exprs,
+      workers=2,
+      chunksize=2,
+      ordered=False,
+      fuel=100,
+    )
+    actual = sorted(actual, key=lambda entry: entry[0])
+    self.assertEqual(list(enumerate(expected)), actual)
@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import unittest
+import tracemalloc
+import dataclasses
+
+from typing import Callable
+from typing import Optional
+
+from .expression import Expression
+from .expression import State
+
+@dataclasses.dataclass
+class Workload:
+  """A benchmark: a source of the given `size`, which is either reduced
+  with a `State` or, for `kind == 'parse'`, only parsed. `fuel` bounds
+  the steps of workloads that do not terminate.
+  """
+  name: str
+  size: int
+  kind: str
+  source: Callable[[int], str]
+  fuel: Optional[int] = None
+
+@dataclasses.dataclass
+class Result:
+  name: str
+  size: int
+  seconds: float
+  steps: int = 0
+  steps_per_second: float = 0.0
+  peak_bytes: int = 0
+  megabytes_per_second: float = 0.0
+
+@dataclasses.dataclass
+class Regression:
+  name: str
+  metric: str
+  baseline: float
+  current: float
+
+  def __str__(self) -> str:
+    return f'''
+{self.name}: {self.metric} went from {self.baseline:.4g} to {self.current:.4g}
+'''.strip()
+
+def deep_nesting(depth: int) -> str:
+  # Unwraps `depth` quotes one at a time.
+  return '['*depth+'foo'+']'*depth+' a'*depth
+
+def flat_sequence(length: int) -> str:
+  return ' '.join('[foo] [bar] f d e c a' for _ in range(length))
+
+def copy_blowup(copies: int) -> str:
+  # Doubles the body of a quote until there are about `copies` copies
+  # of it, and then runs it.
+  doublings = max(0, copies.bit_length()-1)
+  return '[[foo] e]'+' d c'*doublings+' a'
+
+def stuck_variables(count: int) -> str:
+  # Every variable thunks the quotes before it into the sink.
+  return ' '.join(f'[foo] [bar] x{index % 64} f' for index in range(count))
+
+def large_source(lines: int) -> str:
+  line = '[foo [bar baz] d] [(quux | [a b])] f c @note a\n'
+  return line*lines
+
+def loop(size: int) -> str:
+  # Runs forever, so it is bounded by the fuel of its workload.
+  return '[d a] d a'
+
+WORKLOADS = [
+  Workload('deep_nesting', 20_000, 'reduce', deep_nesting),
+  Workload('flat_sequence', 20_000, 'reduce', flat_sequence),
+  Workload('copy_blowup', 1 << 20, 'reduce', copy_blowup),
+  Workload('stuck_variables', 20_000, 'reduce', stuck_variables),
+  Workload('loop', 200_000, 'reduce', loop, fuel=200_000),
+  Workload('large_source', 100_000, 'parse', large_source),
+]
+
+def run_workload(workload: Workload, repeat: int = 3) -> Result:
+  """Time the best of `repeat` runs, then run once more under
+  `tracemalloc` for the peak memory, which is kept out of the timings
+  since tracing slows everything down.
+  """
+  source = workload.source(workload.size)
+  if workload.kind == 'parse':
+    def run() -> int:
+      Expression.from_string(source)
+      return 0
+  else:
+    value = Expression.from_string(source)
+    def run() -> int:
+      state = State(value, fuel=workload.fuel)
+      state.run()
+      return state.steps
+  best = None
+  steps = 0
+  for _ in range(repeat):
+    start = time.perf_counter()
+    steps = run()
+    seconds = time.perf_counter()-start
+    best = seconds if best is None else min(best, seconds)
+  tracemalloc.start()
+  try:
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  result = Result(workload.name, workload.size, best, peak_bytes=peak)
+  if workload.kind == 'parse':
+    megabytes = len(source.encode())/(1 << 20)
+    result.megabytes_per_second = megabytes/max(best, 1e-9)
+  else:
+    result.steps = steps
+    result.steps_per_second = steps/max(best, 1e-9)
+  return result
+
+def run_all(
+  workloads: list[Workload] = WORKLOADS,
+  scale: float = 1.0,
+  repeat: int = 3,
+) -> list[Result]:
+  results = []
+  for workload in workloads:
+    size = max(1, int(workload.size*scale))
+    fuel = workload.fuel
+    if fuel is not None:
+      fuel = max(1, int(fuel*scale))
+    workload = dataclasses.replace(workload, size=size, fuel=fuel)
+    results.append(run_workload(workload, repeat))
+  return results
+
+def save(results: list[Result], path: str):
+  with open(path, 'w') as file:
+    entries = [dataclasses.asdict(result) for result in results]
+    json.dump(entries, file, indent=2)
+
+def load(path: str) -> list[Result]:
+  with open(path) as file:
+    return [Result(**entry) for entry in json.load(file)]
+
+def compare(
+  results: list[Result],
+  baseline: list[Result],
+  tolerance: float = 0.1,
+) -> list[Regression]:
+  """The metrics that got worse than the baseline by more than
+  `tolerance`, as a fraction. Results are matched by name and size, so
+  runs at different scales are not compared.
+  """
+  previous = {(result.name, result.size): result for result in baseline}
+  regressions = []
+  for result in results:
+    before = previous.get((result.name, result.size))
+    if before is None:
+      continue
+    for metric in ['steps_per_second', 'megabytes_per_second']:
+      old, new = getattr(before, metric), getattr(result, metric)
+      if old > 0 and new < old*(1-tolerance):
+        regressions.append(Regression(result.name, metric, old, new))
+    old, new = before.peak_bytes, result.peak_bytes
+    if old > 0 and new > old*(1+tolerance):
+      regressions.append(Regression(result.name, 'peak_bytes', old, new))
+  return regressions
+
+def report(results: list[Result]) -> str:
+  lines = [
+    f'{"workload":<16} {"size":>8} {"seconds":>9} {"steps/s":>12} '
+    f'{"MB/s":>8} {"peak MB":>8}'
+  ]
+  for result in results:
+    lines.append(
+      f'{result.name:<16} {result.size:>8} {result.seconds:>9.4f} '
+      f'{result.steps_per_second:>12.0f} '
+      f'{result.megabytes_per_second:>8.2f} '
+      f'{result.peak_bytes/(1 << 20):>8.2f}'
+    )
+  return '\n'.join(lines)
+
+def main(argv: Optional[list[str]] = None) -> int:
+  parser = argparse.ArgumentParser(
+    prog='python -m sweetpea.benchmark',
+    description='Benchmark the sweetpea reducer and parser.',
+  )
+  parser.add_argument('--scale', type=float, default=1.0)
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--only', nargs='*', default=None)
+  parser.add_argument('--output', help='save the results as JSON')
+  parser.add_argument('--baseline', help='compare with saved results')
+  parser.add_argument('--tolerance', type=float, default=0.1)
+  args = parser.parse_args(argv)
+  workloads = WORKLOADS
+  if args.only is not None:
+    workloads = [w for w in WORKLOADS if w.name in args.only]
+  results = run_all(workloads, scale=args.scale, repeat=args.repeat)
+  print(report(results))
+  if args.output is not None:
+    save(results, args.output)
+  if args.baseline is not None:
+    regressions = compare(results, load(args.baseline), args.tolerance)
+    for regression in regressions:
+      print(regression)
+    if len(regressions) > 0:
+      return 1
+  return 0
+
+class TestBenchmark(unittest.TestCase):
+  def test_run(self):
+    results = run_all(scale=0.001, repeat=1)
+    self.assertEqual([w.name for w in WORKLOADS], [r.name for r in results])
+    for result in results:
+      self.assertGreater(result.peak_bytes, 0)
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, 'baseline.json')
+      save(results, path)
+      baseline = load(path)
+    self.assertEqual(results, baseline)
+    self.assertEqual([], compare(results, baseline))
+    slower = [
+      dataclasses.replace(result, steps_per_second=result.steps_per_second/2)
+      for result in results
+    ]
+    regressions = compare(slower, baseline)
+    self.assertEqual(
+      {r.name for r in results if r.steps > 0},
+      {r.name for r in regressions},
+    )
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,422 @@
+import io
+import mmap
+import random
+import array
+import tempfile
+import unittest
+
+from typing import Any
+from typing import BinaryIO
+from typing import Iterator
+from typing import Union
+
+from .expression import Error
+from .expression import Expression
+from .expression import Choice
+from .expression import Packed
+from .expression import Quote
+from .expression import State
+from .expression import symbols
+from .expression import OPCODE_BITS
+from .expression import OPCODE_MASK
+from .expression import QUOTE
+from .expression import CHOICE
+
+MAGIC = b'SWPE'
+STATE_MAGIC = b'SWPS'
+VERSION = 1
+
+# An image is the magic number and version, then a symbol table (a
+# count, then each name as a length and its UTF-8 bytes), then the root
+# block. A block is a sequence of varints, each holding an opcode in its
+# low bits like a packed word. The operand is an index into the symbol
+# table, or for quotes and choices the length in bytes of the block that
+# follows, so a reader can skip over a body without decoding it.
+
+class BadImage(Error):
+  reason: str
+
+  def __init__(self, reason: str):
+    self.reason = reason
+
+  def __str__(self) -> str:
+    return f'''
+Cannot read a sweetpea image: {self.reason}
+'''.strip()
+
+def dumps(value: Expression) -> bytes:
+  value = value.pack()
+  words = value.words[value.start:value.stop]
+  index = {}
+  names = []
+  for position, word in enumerate(words):
+    opcode = word & OPCODE_MASK
+    if opcode == QUOTE or opcode == CHOICE:
+      continue
+    symbol = word >> OPCODE_BITS
+    local = index.get(symbol)
+    if local is None:
+      local = len(names)
+      index[symbol] = local
+      names.append(symbols.names[symbol])
+    words[position] = (local << OPCODE_BITS) | opcode
+  # Walk backwards to find how many bytes each word and everything after
+  # it takes, which gives the byte length of every body before its
+  # header is written.
+  total = array.array('q', [0])*(len(words)+1)
+  ends = {}
+  for position in range(len(words)-1, -1, -1):
+    word = words[position]
+    opcode = word & OPCODE_MASK
+    if opcode == QUOTE or opcode == CHOICE:
+      end = position+1+(word >> OPCODE_BITS)
+      length = total[position+1]-total[end]
+      ends[position] = length
+      word = (length << OPCODE_BITS) | opcode
+    total[position] = _varint_size(word)+total[position+1]
+  result = bytearray(MAGIC)
+  _write_varint(result, VERSION)
+  _write_varint(result, len(names))
+  for name in names:
+    data = name.encode()
+    _write_varint(result, len(data))
+    result.extend(data)
+  _write_varint(result, total[0])
+  for position, word in enumerate(words):
+    length = ends.get(position)
+    if length is not None:
+      word = (length << OPCODE_BITS) | (word & OPCODE_MASK)
+    _write_varint(result, word)
+  return bytes(result)
+
+def dump(value: Expression, file: BinaryIO):
+  file.write(dumps(value))
+
+def loads(data: bytes) -> Expression:
+  return Image(data).root.decode()
+
+def load(file: BinaryIO) -> Expression:
+  return loads(file.read())
+
+def dumps_state(state: State) -> bytes:
+  """Encode a state so it can be resumed later, possibly in another
+  process: its step count, fuel and exploring flag, then an image whose
+  root holds one quote per stack, with one quote per entry. The
+  deadline and profile are not kept.
+  """
+  # The stacks of a fork are partly shared until this.
+  state.unshare()
+  stacks = [
+    Quote(Expression.from_array([Quote(point) for point in stack]))
+    for stack in [state.sink, state.data, state.code]
+  ]
+  result = bytearray(STATE_MAGIC)
+  _write_varint(result, VERSION)
+  _write_varint(result, state.steps)
+  _write_varint(result, 0 if state.fuel is None else state.fuel+1)
+  _write_varint(result, int(state.explore))
+  result.extend(dumps(Expression.from_array(stacks)))
+  return bytes(result)
+
+def dump_state(state: State, file: BinaryIO):
+  file.write(dumps_state(state))
+
+def loads_state(data: bytes) -> State:
+  if data[0:len(STATE_MAGIC)] != STATE_MAGIC:
+    raise BadImage('wrong magic number')
+  version, position = _read_varint(data, len(STATE_MAGIC))
+  if version != VERSION:
+    raise BadImage(f'unsupported version {version}')
+  steps, position = _read_varint(data, position)
+  fuel, position = _read_varint(data, position)
+  explore, position = _read_varint(data, position)
+  stacks = list(Image(data[position:]).root)
+  if len(stacks) != 3:
+    raise BadImage('a state needs three stacks')
+  stacks = [[_entry(block) for block in _quoted(stack)] for stack in stacks]
+  state = State(
+    Expression.from_array([]),
+    fuel=None if fuel == 0 else fuel-1,
+    explore=bool(explore),
+  )
+  state.sink, state.data, state.code = stacks
+  state.steps = steps
+  return state
+
+def load_state(file: BinaryIO) -> State:
+  return loads_state(file.read())
+
+def _quoted(term: Union[Expression, 'Block']) -> list['Block']:
+  # The stacks of a state, and their entries, are all quotes.
+  if not isinstance(term, Block) or term.kind != QUOTE:
+    raise BadImage('a state stack must be a quote of quotes')
+  result = list(term)
+  for entry in result:
+    if not isinstance(entry, Block) or entry.kind != QUOTE:
+      raise BadImage('a state stack must be a quote of quotes')
+  return result
+
+def _entry(block: 'Block') -> Expression:
+  # A single term comes back as its node, as the stacks of a state hold
+  # quotes as `Quote` nodes; a longer sequence comes back packed.
+  terms = list(block)
+  if len(terms) != 1:
+    return block.decode()
+  term = terms[0]
+  if not isinstance(term, Block):
+    return term
+  if term.kind == QUOTE:
+    return term.quote()
+  return term.decode()
+
+class Image:
+  """A sweetpea image over any buffer, such as bytes or an `mmap`.
+  Only the header and symbol table are read up front; blocks are
+  decoded when asked for, so one subterm of a large image can be read
+  without decoding the rest.
+  """
+  buffer: Any
+  table: list[int]
+  root: 'Block'
+
+  def __init__(self, buffer: Any):
+    self.buffer = buffer
+    if bytes(buffer[0:len(MAGIC)]) != MAGIC:
+      raise BadImage('wrong magic number')
+    version, position = _read_varint(buffer, len(MAGIC))
+    if version != VERSION:
+      raise BadImage(f'unsupported version {version}')
+    count, position = _read_varint(buffer, position)
+    self.table = []
+    for _ in range(count):
+      size, position = _read_varint(buffer, position)
+      if position+size > len(buffer):
+        raise BadImage('truncated')
+      try:
+        name = bytes(buffer[position:position+size]).decode()
+      except UnicodeDecodeError:
+        raise BadImage('a symbol is not valid UTF-8')
+      self.table.append(symbols.intern(name))
+      position += size
+    size, position = _read_varint(buffer, position)
+    if position+size > len(buffer):
+      raise BadImage('truncated')
+    self.root = Block(self, QUOTE, position, position+size)
+
+  @staticmethod
+  def open(path: str) -> 'Image':
+    with open(path, 'rb') as file:
+      buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return Image(buffer)
+
+  def close(self):
+    if isinstance(self.buffer, mmap.mmap):
+      self.buffer.close()
+
+  def symbol(self, value: int) -> int:
+    """The word for a decoded varint that refers to the symbol table."""
+    index = value >> OPCODE_BITS
+    if index >= len(self.table):
+      raise BadImage(f'symbol {index} is not in the table')
+    return (self.table[index] << OPCODE_BITS) | (value & OPCODE_MASK)
+
+class Block:
+  """A block of an image that has not been decoded. The root and the
+  bodies of quotes are sequences; the block of a choice holds exactly
+  two sequences, one per alternative.
+  """
+  image: Image
+  kind: int
+  start: int
+  stop: int
+
+  def __init__(self, image: Image, kind: int, start: int, stop: int):
+    self.image = image
+    self.kind = kind
+    self.start = start
+    self.stop = stop
+
+  def __iter__(self) -> Iterator[Union[Expression, 'Block']]:
+    """Yield the terms of the block, with quotes and choices as blocks
+    of their own, without decoding their bodies.
+    """
+    image = self.image
+    buffer = image.buffer
+    position = self.start
+    while position < self.stop:
+      value, position = _read_varint(buffer, position)
+      opcode = value & OPCODE_MASK
+      if opcode == QUOTE or opcode == CHOICE:
+        end = position+(value >> OPCODE_BITS)
+        if end > self.stop:
+          raise BadImage('a block overruns its parent')
+        yield Block(image, opcode, position, end)
+        position = end
+      else:
+        yield symbols.view(image.symbol(value))
+    if position != self.stop:
+      raise BadImage('a block overruns its parent')
+
+  def __getitem__(self, index: int) -> Union[Expression, 'Block']:
+    for position, term in enumerate(self):
+      if position == index:
+        return term
+    raise IndexError(index)
+
+  def decode(self) -> Expression:
+    """Decode the block: a sequence as a packed expression, or a choice
+    as a `Choice` node.
+    """
+    if self.kind == CHOICE:
+      fst, snd = self._alternatives()
+      return Choice(fst.decode(), snd.decode())
+    image = self.image
+    buffer = image.buffer
+    words = array.array('q')
+    frames = []
+    position = self.start
+    while True:
+      while len(frames) > 0 and frames[-1][1] == position:
+        index, _ = frames.pop()
+        opcode = words[index]
+        words[index] = ((len(words)-index-1) << OPCODE_BITS) | opcode
+        if opcode == CHOICE:
+          _check_choice(words, index)
+      if position >= self.stop:
+        break
+      value, position = _read_varint(buffer, position)
+      opcode = value & OPCODE_MASK
+      if opcode == QUOTE or opcode == CHOICE:
+        end = position+(value >> OPCODE_BITS)
+        if end > self.stop or (len(frames) > 0 and end > frames[-1][1]):
+          raise BadImage('a block overruns its parent')
+        frames.append((len(words), end))
+        words.append(opcode)
+      else:
+        words.append(image.symbol(value))
+    if len(frames) > 0 or position != self.stop:
+      raise BadImage('a block overruns its parent')
+    return Packed(words, 0, len(words))
+
+  def _alternatives(self) -> tuple['Block', 'Block']:
+    terms = list(self)
+    if (
+      len(terms) != 2
+      or not all(isinstance(term, Block) for term in terms)
+      or any(term.kind != QUOTE for term in terms)
+    ):
+      raise BadImage('a choice needs exactly two quotes')
+    return (terms[0], terms[1])
+
+  def quote(self) -> Expression:
+    return Quote(self.decode())
+
+def _check_choice(words: array.array, index: int):
+  # The body of a choice must be exactly two quotes.
+  stop = index+1+(words[index] >> OPCODE_BITS)
+  position = index+1
+  for _ in range(2):
+    if position >= stop or words[position] & OPCODE_MASK != QUOTE:
+      raise BadImage('a choice needs exactly two quotes')
+    position += 1+(words[position] >> OPCODE_BITS)
+  if position != stop:
+    raise BadImage('a choice needs exactly two quotes')
+
+def _varint_size(value: int) -> int:
+  size = 1
+  while value >= 0x80:
+    value >>= 7
+    size += 1
+  return size
+
+def _write_varint(result: bytearray, value: int):
+  while value >= 0x80:
+    result.append((value & 0x7f) | 0x80)
+    value >>= 7
+  result.append(value)
+
+def _read_varint(buffer: Any, position: int) -> tuple[int, int]:
+  result = 0
+  shift = 0
+  while True:
+    if position >= len(buffer):
+      raise BadImage('truncated')
+    byte = buffer[position]
+    position += 1
+    result |= (byte & 0x7f) << shift
+    if byte < 0x80:
+      return (result, position)
+    shift += 7
+
+class TestBinary(unittest.TestCase):
+  def test_roundtrip(self):
+    sources = [
+      '',
+      'foo',
+      '[foo] [bar] (baz | [quux d]) @x a',
+      '[' * 200 + 'foo' + ']' * 200,
+      ' '.join(f'[sym{index} a]' for index in range(300)),
+    ]
+    for source in sources:
+      value = Expression.from_string(source)
+      data = dumps(value)
+      self.assertEqual(value, loads(data))
+      stream = io.BytesIO()
+      dump(value, stream)
+      stream.seek(0)
+      self.assertEqual(value, load(stream))
+    self.assertRaises(BadImage, loads, b'nope')
+    self.assertRaises(BadImage, loads, dumps(value)[:-1])
+
+  def test_state(self):
+    value = Expression.from_string('[foo] bar [baz] [(a | b)] f [quux d] a')
+    state = State(value, fuel=7)
+    self.assertFalse(state.run())
+    stream = io.BytesIO()
+    # A fork, whose stacks are all shared.
+    dump_state(state.fork(), stream)
+    stream.seek(0)
+    resumed = load_state(stream)
+    self.assertEqual(state.value, resumed.value)
+    self.assertEqual((7, 0), (resumed.steps, resumed.fuel))
+    state.fuel = resumed.fuel = None
+    state.run()
+    resumed.run()
+    self.assertEqual(state.value, resumed.value)
+    self.assertEqual(state.steps, resumed.steps)
+    self.assertRaises(BadImage, loads_state, dumps(value))
+
+  def test_lazy(self):
+    source = '[foo [bar]] (baz | [quux]) @x'
+    with tempfile.NamedTemporaryFile(suffix='.swpe') as file:
+      dump(Expression.from_string(source), file)
+      file.flush()
+      image = Image.open(file.name)
+      quote, choice, annotate = image.root
+      self.assertEqual('foo [bar]', f'{quote.decode()}')
+      self.assertEqual('[bar]', f'{quote[1].quote()}')
+      self.assertEqual('(baz | [quux])', f'{choice.decode()}')
+      self.assertEqual('@x', f'{annotate}')
+      self.assertEqual(source, f'{image.root.decode()}')
+      image.close()
+
+  def test_corrupt(self):
+    data = dumps(Expression.from_string('[foo] [bar] (baz | [quux d]) @x a'))
+    # Bad UTF-8 in the symbol table, and a symbol outside of it.
+    name = data.index(b'foo')
+    self.assertRaises(BadImage, loads, data[:name]+b'\xff'+data[name+1:])
+    self.assertRaises(BadImage, loads, data[:-1]+bytes([0x70]))
+    state = dumps_state(State(Expression.from_string('[foo] a')))
+    rng = random.Random(0)
+    for base in [data, state]:
+      for _ in range(500):
+        corrupt = bytearray(base)
+        for _ in range(rng.randint(1, 3)):
+          corrupt[rng.randrange(len(corrupt))] = rng.randrange(256)
+        try:
+          if base is state:
+            f'{loads_state(bytes(corrupt)).value}'
+          else:
+            f'{loads(bytes(corrupt))}'
+        except BadImage:
+          pass
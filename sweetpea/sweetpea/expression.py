@@ -1,10 +1,26 @@
+import io
 import re
+import copy
+import time
+import array
+import struct
+import weakref
 import unittest
 import dataclasses
+import collections
 
+from typing import TextIO
+from typing import Union
+from typing import Iterable
 from typing import Optional
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from . import statement
 
 class Expression:
+  __slots__ = ()
+
   def assert_identity(self):
     raise WrongTag(expected='identity', actual=self)
 
@@ -20,6 +36,9 @@ class Expression:
   def assert_catenate(self):
     raise WrongTag(expected='catenate', actual=self)
 
+  def assert_choice(self):
+    raise WrongTag(expected='choice', actual=self)
+
   def quote(self) -> 'Expression':
     return Quote(self)
 
@@ -28,56 +47,106 @@ class Expression:
       return self
     return Catenate(self, rhs)
 
+  def pack(self) -> 'Packed':
+    words = array.array('q')
+    _encode(words, self)
+    return Packed(words, 0, len(words))
+
+  def write(self, stream: TextIO):
+    """Print the expression to a text stream, a piece at a time and
+    without recursing, so deep and large terms are cheap to dump.
+    """
+    printer = Printer(stream)
+    printer.write(self)
+    printer.flush()
+
+  def __str__(self) -> str:
+    stream = io.StringIO()
+    self.write(stream)
+    return stream.getvalue()
+
+  def __eq__(self, other) -> bool:
+    # Nodes, packed expressions and ropes all compare, and hash,
+    # through their packed form, so equal terms are equal however they
+    # are stored.
+    if not isinstance(other, Expression):
+      return NotImplemented
+    return self.pack() == other
+
+  def __hash__(self) -> int:
+    return hash(self.pack())
+
+  def to_wire(self) -> bytes:
+    """Encode the expression for another process: the names it uses,
+    then its packed words numbered against those names.
+    """
+    names, words = _localize(self.pack())
+    header = '\n'.join(names).encode()
+    return struct.pack('<I', len(header))+header+words.tobytes()
+
   @staticmethod
-  def normalize(expr: 'Expression') -> 'Expression':
-    state = State(expr)
-    while state.has_next:
-      state.step()
+  def from_wire(data: bytes) -> 'Packed':
+    (size,) = struct.unpack_from('<I', data)
+    names = data[4:4+size].decode().split('\n') if size > 0 else []
+    return _globalize(names, data[4+size:])
+
+  @staticmethod
+  def normalize(
+    expr: 'Expression',
+    cache: Optional['Cache'] = None,
+    fuel: Optional[int] = None,
+    timeout: Optional[float] = None,
+    module: Optional['statement.Module'] = None,
+  ) -> 'Expression':
+    """Reduce an expression to its normal form. Given `fuel`, at most
+    that many steps are taken, and given `timeout`, reduction stops
+    after that many seconds. Either limit raises an error holding the
+    partial state, which can be resumed with `State.run`. Given a
+    `module`, the variables it defines are replaced by their bodies.
+    """
+    # The cache is keyed on terms alone, so it is only used without a
+    # module.
+    if cache is not None and module is None:
+      return cache.normalize(expr, fuel=fuel, timeout=timeout)
+    deadline = None
+    if timeout is not None:
+      deadline = time.monotonic()+timeout
+    state = State(expr, fuel=fuel, deadline=deadline, module=module)
+    if not state.run():
+      if state.fuel is not None and state.fuel <= 0:
+        raise OutOfFuel(state)
+      raise OutOfTime(state)
     return state.value
 
   @staticmethod
   def from_array(xs: list['Expression']) -> 'Expression':
-    state = Identity()
-    for child in reversed(xs):
-      state = child.seq(state)
-    return state
+    words = array.array('q')
+    for child in xs:
+      _encode(words, child)
+    return Packed(words, 0, len(words))
 
   @staticmethod
   def from_string(string: str) -> 'Expression':
-    stack = []
-    build = []
-    tokens = string
-    tokens = tokens.replace('\t', ' ')
-    tokens = tokens.replace('\r', ' ')
-    tokens = tokens.replace('\n', ' ')
-    tokens = tokens.replace('[', '[ ')
-    tokens = tokens.replace(']', ' ]')
-    tokens = tokens.split(' ')
-    for token in tokens:
-      if token == '[':
-        stack.append(build)
-        build = []
-      elif token == ']':
-        if len(stack) == 0:
-          raise UnbalancedBrackets(source=string)
-        value = Expression.from_array(build).quote()
-        build = stack.pop()
-        build.append(value)
-      elif token in ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']:
-        value = Constant(token)
-        build.append(value)
-      elif re.match(r'^[a-zA-Z_][a-zA-Z0-9_]*$', token):
-        value = Variable(token)
-        build.append(value)
-      elif re.match(r'^@[a-zA-Z_][a-zA-Z0-9_]*$', token):
-        value = Annotate(token)
-        build.append(value)
-      elif len(token) == 0:
-        continue
-      else:
-        raise UnknownToken(source=string, token=token)
-    return Expression.from_array(build)
+    parser = Parser()
+    parser.feed(string)
+    return parser.finish()
 
+  @staticmethod
+  def from_stream(chunks: Iterable[str]) -> 'Expression':
+    parser = Parser()
+    for chunk in chunks:
+      parser.feed(chunk)
+    return parser.finish()
+
+  @staticmethod
+  def from_file(
+    file: Union[str, TextIO],
+    chunk_size: int = 1 << 20,
+  ) -> 'Expression':
+    if isinstance(file, str):
+      with open(file) as handle:
+        return Expression.from_file(handle, chunk_size)
+    return Expression.from_stream(iter(lambda: file.read(chunk_size), ''))
 
 class Error(Exception):
   pass
@@ -103,31 +172,31 @@ Expected a value with tag {self.expected}, but got {self.actual}
 '''.strip()
 
 class UnknownToken(Error):
-  source: str
   token: str
+  line: int
+  column: int
 
-  def __init__(self, source: str, token: str):
-    self.source = source
+  def __init__(self, token: str, line: int, column: int):
     self.token = token
+    self.line = line
+    self.column = column
 
   def __str__(self) -> str:
     return f'''
-Unknown token `{self.token}` in source code:
-
-{self.source}
+Unknown token `{self.token}` at line {self.line}, column {self.column}
 '''.strip()
 
 class UnbalancedBrackets(Error):
-  source: str
+  line: int
+  column: int
 
-  def __init__(self, source: str):
-    self.source = source
+  def __init__(self, line: int, column: int):
+    self.line = line
+    self.column = column
 
   def __str__(self) -> str:
     return f'''
-Unbalanced brackets in source code:
-
-{self.source}
+Unbalanced bracket at line {self.line}, column {self.column}
 '''.strip()
 
 class NoMoreCode(Error):
@@ -152,7 +221,40 @@ class NoMoreData(Error):
 No more data
 '''.strip()
 
-@dataclasses.dataclass(frozen=True)
+class Branch(Error):
+  state: 'State'
+
+  def __init__(self, state: 'State'):
+    self.state = state
+
+  def __str__(self) -> str:
+    return f'''
+Reached a choice after {self.state.steps} steps
+'''.strip()
+
+class OutOfFuel(Error):
+  state: 'State'
+
+  def __init__(self, state: 'State'):
+    self.state = state
+
+  def __str__(self) -> str:
+    return f'''
+Ran out of fuel after {self.state.steps} steps
+'''.strip()
+
+class OutOfTime(Error):
+  state: 'State'
+
+  def __init__(self, state: 'State'):
+    self.state = state
+
+  def __str__(self) -> str:
+    return f'''
+Ran out of time after {self.state.steps} steps
+'''.strip()
+
+@dataclasses.dataclass(frozen=True, eq=False)
 class Identity(Expression):
   def assert_identity(self):
     pass
@@ -163,7 +265,7 @@ class Identity(Expression):
   def __str__(self) -> str:
     return ''
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, eq=False)
 class Constant(Expression):
   name: str
 
@@ -173,7 +275,7 @@ class Constant(Expression):
   def __str__(self) -> str:
     return self.name
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, eq=False)
 class Variable(Expression):
   name: str
 
@@ -183,7 +285,7 @@ class Variable(Expression):
   def __str__(self) -> str:
     return self.name
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, eq=False)
 class Annotate(Expression):
   name: str
 
@@ -193,17 +295,14 @@ class Annotate(Expression):
   def __str__(self) -> str:
     return self.name
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, eq=False)
 class Quote(Expression):
   body: Expression
 
   def assert_quote(self):
     pass
 
-  def __str__(self) -> str:
-    return f'[{self.body}]'
-
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, eq=False)
 class Catenate(Expression):
   fst: Expression
   snd: Expression
@@ -214,39 +313,991 @@ class Catenate(Expression):
   def seq(self, rhs: Expression) -> Expression:
     if isinstance(rhs, Identity):
       return self
-    if isinstance(rhs, Catenate):
-      hidden = self.snd.seq(rhs)
-      return self.fst.seq(hidden)
-    return Catenate(self, rhs)
+    if not isinstance(rhs, Catenate):
+      return Catenate(self, rhs)
+    # Re-associate to the right, walking the tree with a stack rather
+    # than recursing so that deep chains cannot overflow.
+    leaves = []
+    stack = [self]
+    while len(stack) > 0:
+      point = stack.pop()
+      if isinstance(point, Catenate):
+        stack.append(point.snd)
+        stack.append(point.fst)
+      else:
+        leaves.append(point)
+    result = rhs
+    for leaf in reversed(leaves):
+      result = leaf.seq(result)
+    return result
+
+@dataclasses.dataclass(frozen=True, eq=False)
+class Choice(Expression):
+  """A nondeterministic choice `(A | B)`, which reduces to either `A`
+  or `B`. A `State` treats a choice as stuck unless it is exploring, in
+  which case it stops and leaves the choice to a search.
+  """
+  fst: Expression
+  snd: Expression
+
+  def assert_choice(self):
+    pass
+
+OPCODE_BITS = 4
+OPCODE_MASK = (1 << OPCODE_BITS) - 1
+
+CONSTANT = 0
+VARIABLE = 1
+ANNOTATE = 2
+QUOTE = 3
+OP_A = 4
+OP_B = 5
+OP_C = 6
+OP_D = 7
+OP_E = 8
+OP_F = 9
+OP_G = 10
+OP_H = 11
+CHOICE = 12
+
+# Known constants get an opcode of their own, so an interpreter can
+# dispatch on the opcode alone. Other constants share `CONSTANT`.
+OPCODES = {
+  'a': OP_A,
+  'b': OP_B,
+  'c': OP_C,
+  'd': OP_D,
+  'e': OP_E,
+  'f': OP_F,
+  'g': OP_G,
+  'h': OP_H,
+}
+
+def _word(opcode: int, operand: int) -> int:
+  return (operand << OPCODE_BITS) | opcode
+
+class Symbols:
+  """Interns the names of constants, variables and annotations, so a
+  packed word can refer to a name by its index. Views are cached per
+  word, so decoding the same word twice returns the same node.
+  """
+  names: list[str]
+  index: dict[str, int]
+  views: dict[int, Expression]
+
+  def __init__(self):
+    self.names = []
+    self.index = {}
+    self.views = {}
+
+  def intern(self, name: str) -> int:
+    result = self.index.get(name)
+    if result is None:
+      result = len(self.names)
+      self.names.append(name)
+      self.index[name] = result
+    return result
+
+  def name(self, index: int) -> str:
+    return self.names[index]
+
+  def view(self, word: int) -> Expression:
+    result = self.views.get(word)
+    if result is None:
+      name = self.names[word >> OPCODE_BITS]
+      opcode = word & OPCODE_MASK
+      if opcode == CONSTANT or opcode >= OP_A:
+        result = Constant(name)
+      elif opcode == VARIABLE:
+        result = Variable(name)
+      elif opcode == ANNOTATE:
+        result = Annotate(name)
+      else:
+        raise ValueError(f'Cannot view a word with opcode {opcode}')
+      self.views[word] = result
+    return result
+
+symbols = Symbols()
+
+class Packed(Expression):
+  """A sequence of terms stored as a flat array of words. Each word
+  holds an opcode in its low bits and an operand in the rest: the
+  interned name for constants, variables and annotations, or the
+  number of words in the body for quotes, whose body follows
+  immediately. A choice is encoded like a quote whose body is exactly
+  two quotes, one for each alternative. A packed expression is a span
+  of an array that is never mutated once built, so slicing and sharing
+  it are free.
+  """
+  __slots__ = ('words', 'start', 'stop', '_hash', '__weakref__')
+  __match_args__ = ('words', 'start', 'stop')
+
+  words: array.array
+  start: int
+  stop: int
+
+  # A packed expression is a leaf as far as a `Rope` is concerned.
+  depth = 0
+
+  def __init__(self, words: array.array, start: int, stop: int):
+    self.words = words
+    self.start = start
+    self.stop = stop
+    self._hash = None
+
+  @property
+  def is_empty(self) -> bool:
+    return self.start == self.stop
+
+  @property
+  def size(self) -> int:
+    return self.stop-self.start
+
+  def pack(self) -> 'Packed':
+    return self
+
+  def seq(self, rhs: Expression) -> Expression:
+    return Rope.join(self, rhs)
+
+  def uncons(self) -> tuple[Expression, 'Packed']:
+    """Split off the first term as a node, along with the rest of the
+    sequence. The sequence must not be empty.
+    """
+    words, start = self.words, self.start
+    assert start != self.stop
+    word = words[start]
+    opcode = word & OPCODE_MASK
+    if opcode == QUOTE:
+      end = start+1+(word >> OPCODE_BITS)
+      head = Quote(Packed(words, start+1, end))
+    elif opcode == CHOICE:
+      end = start+1+(word >> OPCODE_BITS)
+      head = _choice(words, start)
+    else:
+      end = start+1
+      head = symbols.view(word)
+    return (head, Packed(words, end, self.stop))
+
+  def __iter__(self):
+    point = self
+    while not point.is_empty:
+      head, point = point.uncons()
+      yield head
+
+  def unpack(self) -> Expression:
+    """Build the equivalent tree of nodes. Quote bodies are unpacked
+    as well, so the result shares nothing with this array.
+    """
+    words = self.words
+    frames = []
+    build = []
+    stop = self.stop
+    index = self.start
+    while True:
+      while index == stop and len(frames) > 0:
+        if frames[-1][2] == CHOICE:
+          fst, snd = build
+          value = Choice(fst.body, snd.body)
+        else:
+          value = Quote(_catenate(build))
+        build, stop, _ = frames.pop()
+        build.append(value)
+      if index == self.stop:
+        break
+      word = words[index]
+      index += 1
+      opcode = word & OPCODE_MASK
+      if opcode == QUOTE or opcode == CHOICE:
+        frames.append((build, stop, opcode))
+        build = []
+        stop = index+(word >> OPCODE_BITS)
+      else:
+        build.append(symbols.view(word))
+    return _catenate(build)
+
+  def __eq__(self, other) -> bool:
+    if not isinstance(other, Expression):
+      return NotImplemented
+    other = other.pack()
+    if (
+      self.words is other.words
+      and self.start == other.start
+      and self.stop == other.stop
+    ):
+      return True
+    if self.stop-self.start != other.stop-other.start:
+      return False
+    lhs = self.words[self.start:self.stop]
+    rhs = other.words[other.start:other.stop]
+    return lhs == rhs
+
+  def __hash__(self) -> int:
+    if self._hash is None:
+      self._hash = hash(self.words[self.start:self.stop].tobytes())
+    return self._hash
+
+  def __repr__(self) -> str:
+    return f'Packed({str(self)!r})'
+
+  def __reduce__(self):
+    # Symbols are interned per process, so a pickle carries the names
+    # it uses and is renumbered against the local table when loaded.
+    return (Expression.from_wire, (self.to_wire(),))
+
+class Rope(Expression):
+  """A sequence joined from packed pieces, kept as a balanced binary
+  tree so that joining two sequences takes logarithmic time instead of
+  copying both. Joins that add up to at most `LEAF_SIZE` words are
+  copied into a single packed expression instead, so that the leaves
+  stay large and stepping through a rope stays cheap.
+  """
+  __slots__ = ('fst', 'snd', 'size', 'depth', '_hash')
+  __match_args__ = ('fst', 'snd')
+
+  fst: Expression
+  snd: Expression
+  size: int
+  depth: int
+
+  LEAF_SIZE = 256
+
+  def __init__(self, fst: Expression, snd: Expression):
+    self.fst = fst
+    self.snd = snd
+    self.size = fst.size+snd.size
+    self.depth = 1+max(fst.depth, snd.depth)
+    self._hash = None
+
+  @staticmethod
+  def join(lhs: Expression, rhs: Expression) -> Expression:
+    if not isinstance(lhs, (Packed, Rope)):
+      lhs = lhs.pack()
+    if not isinstance(rhs, (Packed, Rope)):
+      rhs = rhs.pack()
+    if lhs.size == 0:
+      return rhs
+    if rhs.size == 0:
+      return lhs
+    return _join(lhs, rhs)
+
+  @property
+  def is_empty(self) -> bool:
+    return self.size == 0
+
+  def seq(self, rhs: Expression) -> Expression:
+    return Rope.join(self, rhs)
+
+  def pack(self) -> Packed:
+    words = array.array('q')
+    stack = [self]
+    while len(stack) > 0:
+      point = stack.pop()
+      if isinstance(point, Rope):
+        stack.append(point.snd)
+        stack.append(point.fst)
+      else:
+        words.extend(point.words[point.start:point.stop])
+    return Packed(words, 0, len(words))
+
+  def __eq__(self, other) -> bool:
+    return self.pack() == other
+
+  def __hash__(self) -> int:
+    if self._hash is None:
+      self._hash = hash(self.pack())
+    return self._hash
+
+  def __repr__(self) -> str:
+    return f'Rope({str(self)!r})'
+
+  def __reduce__(self):
+    return (Expression.from_wire, (self.to_wire(),))
+
+class Printer:
+  """Prints terms to a text stream. Terms are walked with an explicit
+  stack, and the text is buffered and written in large pieces, so
+  printing neither recurses nor copies strings over and over. Terms
+  written one after another are separated by spaces, like a sequence.
+  """
+  stream: TextIO
+  parts: list[str]
+  space: bool
+
+  # How many pieces to buffer before writing them to the stream.
+  BUFFER_SIZE = 4096
+
+  def __init__(self, stream: TextIO):
+    self.stream = stream
+    self.parts = []
+    self.space = False
+
+  def flush(self):
+    self.stream.write(''.join(self.parts))
+    self.parts = []
+
+  def write(self, expr: Expression):
+    parts = self.parts
+    # Closing brackets and the bar of a choice are pushed as strings
+    # onto the same stack as the terms still to print.
+    stack = [expr]
+    while len(stack) > 0:
+      point = stack.pop()
+      match point:
+        case '|':
+          parts.append(' |' if self.space else '|')
+          self.space = True
+        case str(close):
+          parts.append(close)
+          self.space = True
+        case Packed():
+          self._write_packed(point)
+        case Rope(fst, snd) | Catenate(fst, snd):
+          stack.append(snd)
+          stack.append(fst)
+        case Identity():
+          pass
+        case Quote(body):
+          parts.append(' [' if self.space else '[')
+          self.space = False
+          stack.append(']')
+          stack.append(body)
+        case Choice(fst, snd):
+          parts.append(' (' if self.space else '(')
+          self.space = False
+          stack.append(')')
+          stack.append(snd)
+          stack.append('|')
+          stack.append(fst)
+        case Constant(name) | Variable(name) | Annotate(name):
+          if self.space:
+            parts.append(' ')
+          parts.append(name)
+          self.space = True
+      if len(parts) >= self.BUFFER_SIZE:
+        self.flush()
+        parts = self.parts
+
+  def _write_packed(self, value: Packed):
+    words = value.words
+    names = symbols.names
+    parts = self.parts
+    space = self.space
+    closes = []
+    index = value.start
+    stop = value.stop
+    while index < stop or len(closes) > 0:
+      while len(closes) > 0 and closes[-1][0] == index:
+        _, close = closes.pop()
+        if close == '|':
+          # The second alternative follows the end of the first one.
+          parts.append(' |' if space else '|')
+          word = words[index]
+          index += 1
+          closes.append((index+(word >> OPCODE_BITS), ''))
+          space = True
+        elif close == ')' or close == ']':
+          parts.append(close)
+          space = True
+      if index == stop:
+        break
+      word = words[index]
+      index += 1
+      if space:
+        parts.append(' ')
+      opcode = word & OPCODE_MASK
+      if opcode == QUOTE:
+        parts.append('[')
+        closes.append((index+(word >> OPCODE_BITS), ']'))
+        space = False
+      elif opcode == CHOICE:
+        parts.append('(')
+        closes.append((index+(word >> OPCODE_BITS), ')'))
+        word = words[index]
+        index += 1
+        closes.append((index+(word >> OPCODE_BITS), '|'))
+        space = False
+      else:
+        parts.append(names[word >> OPCODE_BITS])
+        space = True
+      if len(parts) >= self.BUFFER_SIZE:
+        self.flush()
+        parts = self.parts
+    self.space = space
+
+def _join(lhs: Expression, rhs: Expression) -> Expression:
+  if lhs.size+rhs.size <= Rope.LEAF_SIZE:
+    words = lhs.pack()
+    words = words.words[words.start:words.stop]
+    _encode(words, rhs)
+    return Packed(words, 0, len(words))
+  if lhs.depth > rhs.depth+1:
+    return _balance(lhs.fst, _join(lhs.snd, rhs))
+  if rhs.depth > lhs.depth+1:
+    return _balance(_join(lhs, rhs.fst), rhs.snd)
+  return Rope(lhs, rhs)
+
+def _balance(fst: Expression, snd: Expression) -> Expression:
+  # Restore the invariant that the depths of siblings differ by at
+  # most one, with a single or double rotation.
+  if fst.depth > snd.depth+1:
+    if fst.fst.depth >= fst.snd.depth:
+      return Rope(fst.fst, Rope(fst.snd, snd))
+    return Rope(
+      Rope(fst.fst, fst.snd.fst),
+      Rope(fst.snd.snd, snd),
+    )
+  if snd.depth > fst.depth+1:
+    if snd.snd.depth >= snd.fst.depth:
+      return Rope(Rope(fst, snd.fst), snd.snd)
+    return Rope(
+      Rope(fst, snd.fst.fst),
+      Rope(snd.fst.snd, snd.snd),
+    )
+  return Rope(fst, snd)
+
+_TOKEN = re.compile(r'\n|[\[\]()|]|[^\s\[\]()|]+')
+_VARIABLE = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*')
+_ANNOTATE = re.compile(r'@[a-zA-Z_][a-zA-Z0-9_]*')
+
+class Parser:
+  """Builds a packed expression from source code in a single pass. The
+  source can be fed in chunks of any size: a token cut off at the end
+  of a chunk is held back until the next one. Each distinct token is
+  classified and interned once, after which it costs a dictionary
+  lookup.
+  """
+  words: array.array
+  stack: list[tuple[str, int, int, int]]
+  cache: dict[str, int]
+  pending: str
+  offset: int
+  line: int
+  line_start: int
+
+  def __init__(self):
+    self.words = array.array('q')
+    self.stack = []
+    self.cache = {}
+    self.pending = ''
+    # The offset in the source of the start of the pending text, and
+    # the offset of the start of the current line.
+    self.offset = 0
+    self.line = 1
+    self.line_start = 0
+
+  def feed(self, chunk: str):
+    self._scan(self.pending+chunk, final=False)
+
+  def finish(self) -> Packed:
+    self._scan(self.pending, final=True)
+    if len(self.stack) > 0:
+      _, _, line, column = self.stack[-1]
+      raise UnbalancedBrackets(line, column)
+    words = self.words
+    return Packed(words, 0, len(words))
+
+  def _scan(self, text: str, final: bool):
+    words = self.words
+    stack = self.stack
+    cache = self.cache
+    offset = self.offset
+    line = self.line
+    line_start = self.line_start
+    size = len(text)
+    self.pending = ''
+    for match in _TOKEN.finditer(text):
+      token = match.group()
+      if token == '\n':
+        line += 1
+        line_start = offset+match.end()
+      elif token == '[':
+        column = offset+match.start()-line_start+1
+        stack.append(('[', len(words), line, column))
+        words.append(QUOTE)
+      elif token == '(':
+        column = offset+match.start()-line_start+1
+        stack.append(('(', len(words), line, column))
+        words.append(CHOICE)
+        words.append(QUOTE)
+      elif token in ']|)':
+        opening = {']': '[', '|': '(', ')': '|'}[token]
+        if len(stack) == 0 or stack[-1][0] != opening:
+          column = offset+match.start()-line_start+1
+          raise UnbalancedBrackets(line, column)
+        kind, index, line_open, column_open = stack.pop()
+        if token == ']':
+          words[index] = _word(QUOTE, len(words)-index-1)
+        elif token == '|':
+          words[index+1] = _word(QUOTE, len(words)-index-2)
+          stack.append(('|', index, line_open, column_open))
+          words.append(QUOTE)
+        else:
+          middle = index+2+(words[index+1] >> OPCODE_BITS)
+          words[middle] = _word(QUOTE, len(words)-middle-1)
+          words[index] = _word(CHOICE, len(words)-index-1)
+      elif not final and match.end() == size:
+        self.pending = token
+        offset += match.start()
+        break
+      else:
+        word = cache.get(token)
+        if word is None:
+          column = offset+match.start()-line_start+1
+          word = _classify(token, line, column)
+          cache[token] = word
+        words.append(word)
+    else:
+      offset += size
+    self.offset = offset
+    self.line = line
+    self.line_start = line_start
+
+def _classify(token: str, line: int, column: int) -> int:
+  opcode = OPCODES.get(token)
+  if opcode is not None:
+    return _word(opcode, symbols.intern(token))
+  if _VARIABLE.fullmatch(token):
+    return _word(VARIABLE, symbols.intern(token))
+  if _ANNOTATE.fullmatch(token):
+    return _word(ANNOTATE, symbols.intern(token))
+  raise UnknownToken(token, line, column)
+
+class Terms:
+  """A hash-consing table. Interning a term returns the one packed
+  expression that stands for every structurally equal term, with its
+  hash computed once, so interned terms can be compared and looked up
+  by identity. Terms are only held weakly.
+  """
+  table: weakref.WeakValueDictionary
+
+  def __init__(self):
+    self.table = weakref.WeakValueDictionary()
+
+  def intern(self, value: Expression) -> Packed:
+    value = value.pack()
+    key = value.words[value.start:value.stop].tobytes()
+    result = self.table.get(key)
+    if result is None:
+      words = array.array('q')
+      words.frombytes(key)
+      result = Packed(words, 0, len(words))
+      result._hash = hash(key)
+      self.table[key] = result
+    return result
+
+  def __len__(self) -> int:
+    return len(self.table)
+
+@dataclasses.dataclass
+class CacheStats:
+  hits: int = 0
+  misses: int = 0
+  evictions: int = 0
+
+class Cache:
+  """A bounded cache of normal forms, keyed on hash-consed terms and
+  evicting the least recently used entry once it is full.
+  """
+  capacity: int
+  terms: Terms
+  entries: collections.OrderedDict
+  stats: CacheStats
+
+  def __init__(
+    self,
+    capacity: int = 1024,
+    terms: Optional[Terms] = None,
+  ):
+    assert capacity > 0
+    self.capacity = capacity
+    self.terms = terms if terms is not None else Terms()
+    self.entries = collections.OrderedDict()
+    self.stats = CacheStats()
+
+  def normalize(
+    self,
+    expr: Expression,
+    fuel: Optional[int] = None,
+    timeout: Optional[float] = None,
+  ) -> Expression:
+    key = self.terms.intern(expr)
+    result = self.entries.get(key)
+    if result is not None:
+      self.entries.move_to_end(key)
+      self.stats.hits += 1
+      return result
+    self.stats.misses += 1
+    result = Expression.normalize(key, fuel=fuel, timeout=timeout)
+    result = self.terms.intern(result)
+    self.entries[key] = result
+    if len(self.entries) > self.capacity:
+      self.entries.popitem(last=False)
+      self.stats.evictions += 1
+    return result
+
+  def clear(self):
+    self.entries.clear()
+
+  def __len__(self) -> int:
+    return len(self.entries)
+
+def _choice(words: array.array, index: int) -> 'Choice':
+  fst = index+1
+  snd = fst+1+(words[fst] >> OPCODE_BITS)
+  stop = snd+1+(words[snd] >> OPCODE_BITS)
+  return Choice(Packed(words, fst+1, snd), Packed(words, snd+1, stop))
+
+def _only(body: Expression) -> Expression:
+  # The single term in a sequence, or the sequence itself if it does
+  # not have exactly one term.
+  body = body.pack()
+  if body.is_empty:
+    return body
+  head, rest = body.uncons()
+  if rest.is_empty:
+    return head
+  return body
+
+def _localize(value: Packed) -> tuple[tuple[str, ...], array.array]:
+  index = {}
+  names = []
+  words = array.array('q')
+  for word in value.words[value.start:value.stop]:
+    opcode = word & OPCODE_MASK
+    if opcode == QUOTE or opcode == CHOICE:
+      words.append(word)
+      continue
+    symbol = word >> OPCODE_BITS
+    local = index.get(symbol)
+    if local is None:
+      local = len(names)
+      index[symbol] = local
+      names.append(symbols.names[symbol])
+    words.append(_word(opcode, local))
+  return (tuple(names), words)
+
+def _globalize(names: Iterable[str], data: bytes) -> Packed:
+  table = [symbols.intern(name) for name in names]
+  words = array.array('q')
+  words.frombytes(data)
+  for index, word in enumerate(words):
+    opcode = word & OPCODE_MASK
+    if opcode != QUOTE and opcode != CHOICE:
+      words[index] = _word(opcode, table[word >> OPCODE_BITS])
+  return Packed(words, 0, len(words))
+
+def _catenate(xs: list[Expression]) -> Expression:
+  state = Identity()
+  for child in reversed(xs):
+    state = child.seq(state)
+  return state
+
+def _encode(words: array.array, expr: Expression):
+  # Quote and choice headers are patched once their body has been
+  # written, which is marked by pushing the index of the header onto
+  # the stack.
+  stack = [expr]
+  while len(stack) > 0:
+    point = stack.pop()
+    match point:
+      case int(index):
+        opcode = words[index] & OPCODE_MASK
+        words[index] = _word(opcode, len(words)-index-1)
+      case Packed(source, start, stop):
+        words.extend(source[start:stop])
+      case Rope(fst, snd):
+        stack.append(snd)
+        stack.append(fst)
+      case Identity():
+        pass
+      case Catenate(fst, snd):
+        stack.append(snd)
+        stack.append(fst)
+      case Quote(body):
+        stack.append(len(words))
+        stack.append(body)
+        words.append(QUOTE)
+      case Choice(fst, snd):
+        stack.append(len(words))
+        stack.append(Quote(snd))
+        stack.append(Quote(fst))
+        words.append(CHOICE)
+      case Constant(name):
+        opcode = OPCODES.get(name, CONSTANT)
+        words.append(_word(opcode, symbols.intern(name)))
+      case Variable(name):
+        words.append(_word(VARIABLE, symbols.intern(name)))
+      case Annotate(name):
+        words.append(_word(ANNOTATE, symbols.intern(name)))
+
+@dataclasses.dataclass
+class Profile:
+  """Counts collected while a state runs: how often each constant was
+  executed, how often each term got stuck, and the largest size each
+  stack reached.
+  """
+  steps: int = 0
+  constants: collections.Counter = dataclasses.field(
+    default_factory=collections.Counter,
+  )
+  stuck: collections.Counter = dataclasses.field(
+    default_factory=collections.Counter,
+  )
+  code_high: int = 0
+  data_high: int = 0
+  sink_high: int = 0
 
   def __str__(self) -> str:
-    return f'{self.fst} {self.snd}'
+    lines = [
+      f'steps: {self.steps}',
+      f'code high-water: {self.code_high}',
+      f'data high-water: {self.data_high}',
+      f'sink high-water: {self.sink_high}',
+    ]
+    for name, count in self.constants.most_common():
+      lines.append(f'constant {name}: {count}')
+    for name, count in self.stuck.most_common():
+      lines.append(f'stuck {name}: {count}')
+    return '\n'.join(lines)
+
+@dataclasses.dataclass(frozen=True)
+class _Shared:
+  # The bottom of a stack, shared by forks. Its entries are
+  # `items[:stop]` on top of those of `rest`, and none of them change.
+  items: list[Expression]
+  stop: int
+  rest: Optional['_Shared']
+  size: int
+
+# How many entries a state copies at a time from a shared stack.
+_PULL = 64
+
+def _share(top: list, base: Optional[_Shared]) -> Optional[_Shared]:
+  if len(top) == 0:
+    return base
+  return _Shared(top, len(top), base, len(top)+_size(base))
+
+def _pull(base: _Shared) -> tuple[list, Optional[_Shared]]:
+  start = max(0, base.stop-_PULL)
+  items = base.items[start:base.stop]
+  if start == 0:
+    return (items, base.rest)
+  return (items, _Shared(base.items, start, base.rest, base.size-len(items)))
+
+def _size(base: Optional[_Shared]) -> int:
+  return 0 if base is None else base.size
+
+def _whole(top: list, base: Optional[_Shared]) -> list:
+  chunks = [top]
+  while base is not None:
+    chunks.append(base.items[:base.stop])
+    base = base.rest
+  result = []
+  for chunk in reversed(chunks):
+    result.extend(chunk)
+  return result
 
 class State:
+  """A reduction in progress. `run` takes steps until there is no more
+  code, or until the optional `fuel` (a number of steps) or `deadline`
+  (a `time.monotonic` timestamp) runs out, after which it can be
+  resumed by raising the limits and calling `run` again.
+
+  A choice is stuck like a variable, unless the state is exploring, in
+  which case stepping onto a choice leaves it on the code stack and
+  raises `Branch`; `split` then forks the state once per alternative.
+
+  Forking takes constant time: the stacks so far are frozen and shared
+  by both states, and each pulls entries back from them a few at a time
+  as it reaches them. A fork with a profile gets a copy of it, so counts
+  stay apart.
+
+  Given a `statement.Module`, a variable the module defines is replaced
+  by the body of its definition instead of getting stuck.
+  """
+  # The tops of the stacks, above the parts shared with forks.
   code: list[Expression]
   data: list[Expression]
   sink: list[Expression]
+  steps: int
+  fuel: Optional[int]
+  deadline: Optional[float]
+  profile: Optional[Profile]
+  explore: bool
+  module: Optional['statement.Module']
+
+  # How many steps to take between looking at the clock.
+  CLOCK_INTERVAL = 1024
 
-  def __init__(self, init: Expression):
+  def __init__(
+    self,
+    init: Expression,
+    fuel: Optional[int] = None,
+    deadline: Optional[float] = None,
+    profile: Optional[Profile] = None,
+    explore: bool = False,
+    module: Optional['statement.Module'] = None,
+  ):
     self.code = [init]
     self.data = []
     self.sink = []
+    self._code_base = None
+    self._data_base = None
+    self._sink_base = None
+    self.steps = 0
+    self.fuel = fuel
+    self.deadline = deadline
+    self.profile = profile
+    self.explore = explore
+    self.module = module
+
+  def run(self) -> bool:
+    """Step until there is no more code or a limit is reached. Returns
+    whether the state is in normal form.
+    """
+    # The profiler is chosen once per run, so it costs nothing per step
+    # when it is disabled.
+    step = self.step if self.profile is None else self._step_profiled
+    while self.has_next:
+      batch = self.CLOCK_INTERVAL
+      if self.fuel is not None:
+        if self.fuel <= 0:
+          return False
+        batch = min(batch, self.fuel)
+      if self.deadline is not None and time.monotonic() >= self.deadline:
+        return False
+      taken = 0
+      code = self.code
+      try:
+        while taken < batch and len(code) > 0:
+          step()
+          taken += 1
+      finally:
+        self.steps += taken
+        if self.fuel is not None:
+          self.fuel -= taken
+    return True
+
+  def fork(self) -> 'State':
+    """Copy the state in constant time, so that each copy can be
+    reduced on its own.
+    """
+    self._code_base = _share(self.code, self._code_base)
+    self._data_base = _share(self.data, self._data_base)
+    self._sink_base = _share(self.sink, self._sink_base)
+    self.code = []
+    self.data = []
+    self.sink = []
+    result = State.__new__(State)
+    result.__dict__.update(self.__dict__)
+    result.code = []
+    result.data = []
+    result.sink = []
+    if self.profile is not None:
+      result.profile = copy.deepcopy(self.profile)
+    return result
+
+  def split(self) -> Optional[tuple['State', 'State']]:
+    """If the next term is a choice, take it off the code stack and
+    return one state for each alternative. Otherwise return `None`.
+    """
+    if not self.has_next:
+      return None
+    point = self.code[-1]
+    match point:
+      case Packed(words, start, stop) if start < stop:
+        if words[start] & OPCODE_MASK != CHOICE:
+          return None
+        end = start+1+(words[start] >> OPCODE_BITS)
+        point = _choice(words, start)
+        self.code.pop()
+        if end < stop:
+          self.code.append(Packed(words, end, stop))
+      case Choice(_, _):
+        self.code.pop()
+      case _:
+        return None
+    fst = self.fork()
+    fst.send(point.fst)
+    snd = self.fork()
+    snd.send(point.snd)
+    return (fst, snd)
+
+  def _step_profiled(self):
+    profile = self.profile
+    point = self.code[-1]
+    match point:
+      case Packed(words, start, stop) if start < stop:
+        word = words[start]
+        if word & OPCODE_MASK not in (QUOTE, CHOICE):
+          point = symbols.view(word)
+    if isinstance(point, Constant):
+      profile.constants[point.name] += 1
+    sink_size = len(self.sink)
+    self.step()
+    # Only thunking grows the sink, and it always ends with the term
+    # that got stuck.
+    if len(self.sink) > sink_size:
+      profile.stuck[f'{self.sink[-1]}'] += 1
+    profile.steps += 1
+    code_depth = len(self.code) + _size(self._code_base)
+    data_depth = len(self.data) + _size(self._data_base)
+    sink_depth = len(self.sink) + _size(self._sink_base)
+    profile.code_high = max(profile.code_high, code_depth)
+    profile.data_high = max(profile.data_high, data_depth)
+    profile.sink_high = max(profile.sink_high, sink_depth)
+
+  def unshare(self):
+    """Copy the parts of the stacks shared with forks into the state,
+    so that `code`, `data` and `sink` hold the whole of each.
+    """
+    self.code = _whole(self.code, self._code_base)
+    self.data = _whole(self.data, self._data_base)
+    self.sink = _whole(self.sink, self._sink_base)
+    self._code_base = None
+    self._data_base = None
+    self._sink_base = None
 
   @property
   def value(self) -> Expression:
-    hidden = self.sink+self.data+list(reversed(self.code))
+    hidden = (
+      _whole(self.sink, self._sink_base)
+      + _whole(self.data, self._data_base)
+      + list(reversed(_whole(self.code, self._code_base)))
+    )
     return Expression.from_array(hidden)
 
+  def write_value(self, stream: TextIO):
+    """Print the value of the state without building it first."""
+    printer = Printer(stream)
+    for point in _whole(self.sink, self._sink_base):
+      printer.write(point)
+    for point in _whole(self.data, self._data_base):
+      printer.write(point)
+    for point in reversed(_whole(self.code, self._code_base)):
+      printer.write(point)
+    printer.flush()
+
   @property
   def has_next(self) -> bool:
+    if len(self.code) == 0:
+      self._pull_code()
     return len(self.code) > 0
 
   def next(self) -> Expression:
     if len(self.code) == 0:
-      raise NoMoreCode(self)
+      self._pull_code()
+      if len(self.code) == 0:
+        raise NoMoreCode(self)
     result = self.code.pop()
     return result
 
+  def _pull_code(self):
+    if self._code_base is not None:
+      # Extended in place, since `run` holds on to the list.
+      items, self._code_base = _pull(self._code_base)
+      self.code.extend(items)
+
   def send(self, expr: Expression):
     self.code.append(expr)
 
@@ -255,35 +1306,82 @@ class State:
 
   def pop(self) -> Expression:
     if len(self.data) == 0:
-      raise NoMoreData(self)
+      self._pull_data(1)
     result = self.data.pop()
     return result
 
   def peek(self, index: int = 0) -> Expression:
     if index >= len(self.data):
-      raise NoMoreData(self)
+      self._pull_data(index+1)
     result = self.data[-1-index]
     return result
 
+  def _pull_data(self, count: int):
+    while len(self.data) < count and self._data_base is not None:
+      items, self._data_base = _pull(self._data_base)
+      self.data[:0] = items
+    if len(self.data) < count:
+      raise NoMoreData(self)
+
   def thunk_with(self, point: Expression):
+    if self._data_base is not None:
+      self.data = _whole(self.data, self._data_base)
+      self._data_base = None
     self.sink.extend(self.data)
     self.data = []
     self.sink.append(point)
 
   def step(self):
     point = self.next()
+    match point:
+      case Packed(words, start, stop):
+        if start == stop:
+          return
+        # Decode the first word in place, rather than splitting the
+        # span into nodes and taking another step to run them.
+        word = words[start]
+        opcode = word & OPCODE_MASK
+        if opcode == QUOTE:
+          end = start+1+(word >> OPCODE_BITS)
+          if end < stop:
+            self.send(Packed(words, end, stop))
+          self.push(Quote(Packed(words, start+1, end)))
+          return
+        if opcode == CHOICE:
+          end = start+1+(word >> OPCODE_BITS)
+          if end < stop:
+            self.send(Packed(words, end, stop))
+          point = _choice(words, start)
+        else:
+          if start+1 < stop:
+            self.send(Packed(words, start+1, stop))
+          point = symbols.view(word)
     match point:
       case Identity():
         pass
       case Catenate(fst, snd):
         self.send(snd)
         self.send(fst)
+      case Rope(fst, snd):
+        self.send(snd)
+        self.send(fst)
       case Quote(_):
         self.push(point)
       case Variable(name):
-        self.thunk_with(point)
+        body = None
+        if self.module is not None:
+          body = self.module.lookup(name)
+        if body is None:
+          self.thunk_with(point)
+        else:
+          self.send(body)
       case Annotate(name):
         pass
+      case Choice(_, _):
+        if self.explore:
+          self.send(point)
+          raise Branch(self)
+        self.thunk_with(point)
       case Constant(name):
         try:
           self._exec(point)
@@ -326,9 +1424,22 @@ class State:
         self.push(fst)
         self.push(snd)
       case 'g':
-        pass
+        snd = self.peek(0)
+        snd.assert_quote()
+        fst = self.peek(1)
+        fst.assert_quote()
+        self.pop()
+        self.pop()
+        result = Choice(fst.body, snd.body).quote()
+        self.push(result)
       case 'h':
-        pass
+        value = self.peek(0)
+        value.assert_quote()
+        choice = _only(value.body)
+        choice.assert_choice()
+        self.pop()
+        self.push(choice.fst.quote())
+        self.push(choice.snd.quote())
 
 class TestBasic(unittest.TestCase):
   def test_axioms(self):
@@ -347,3 +1458,219 @@ class TestBasic(unittest.TestCase):
       actual_source = f'{actual}'
       self.assertEqual(expected, actual)
       self.assertEqual(expected_source, actual_source)
+
+class TestPacked(unittest.TestCase):
+  def test_packed(self):
+    sources = [
+      '',
+      'foo',
+      '[]',
+      '[foo] [bar] c',
+      '[[foo] @bar [[baz]]] a quux',
+    ]
+    for source in sources:
+      value = Expression.from_string(source)
+      self.assertEqual(source, f'{value}')
+      self.assertEqual(value, value.unpack())
+      self.assertEqual(value.unpack(), value)
+      self.assertEqual(source, f'{value.unpack()}')
+      self.assertEqual(value, value.unpack().pack())
+    nested = Expression.from_string('[[foo] bar] baz')
+    head, rest = nested.uncons()
+    self.assertEqual(Quote(Expression.from_string('[foo] bar')), head)
+    self.assertEqual(Variable('baz'), rest)
+    self.assertRaises(UnbalancedBrackets, Expression.from_string, '[foo')
+    self.assertRaises(UnbalancedBrackets, Expression.from_string, 'foo]')
+    for source in sources:
+      value = Expression.from_string(source)
+      self.assertEqual(value, Expression.from_wire(value.to_wire()))
+
+  def test_hash(self):
+    sources = ['', 'foo', '[foo] [bar] c', '[[foo] @bar] (baz | quux)']
+    for source in sources:
+      value = Expression.from_string(source)
+      node = value.unpack()
+      self.assertEqual(hash(value), hash(node))
+      self.assertEqual(1, len({value, node}))
+    fst = Catenate(Variable('foo'), Catenate(Variable('bar'), Variable('baz')))
+    snd = Catenate(Catenate(Variable('foo'), Variable('bar')), Variable('baz'))
+    self.assertEqual(fst, snd)
+    self.assertEqual({fst: 1}.get(snd), 1)
+    self.assertNotEqual(Variable('foo'), Constant('foo'))
+
+class TestCache(unittest.TestCase):
+  def test_cache(self):
+    terms = Terms()
+    fst = terms.intern(Expression.from_string('[foo] [bar] f'))
+    snd = terms.intern(Expression.from_string('[foo] [bar] f').unpack())
+    self.assertIs(fst, snd)
+    cache = Cache(capacity=2, terms=terms)
+    sources = ['[foo] d', '[foo] d', '[bar] d', '[baz] d', '[foo] d']
+    for source in sources:
+      value = Expression.from_string(source)
+      actual = Expression.normalize(value, cache=cache)
+      self.assertEqual(Expression.normalize(value), actual)
+    self.assertEqual(CacheStats(hits=1, misses=4, evictions=2), cache.stats)
+    self.assertEqual(2, len(cache))
+
+class TestParser(unittest.TestCase):
+  def test_parser(self):
+    source = '[foo bar] [[baz] quux] @x c\n[d] a\r\n\tfoo'
+    expected = Expression.from_string(source)
+    for size in [1, 2, 3, 7]:
+      chunks = [source[i:i+size] for i in range(0, len(source), size)]
+      actual = Expression.from_stream(chunks)
+      self.assertEqual(expected, actual)
+    self.assertEqual('[foo bar] [[baz] quux] @x c [d] a foo', f'{expected}')
+    with self.assertRaises(UnknownToken) as context:
+      Expression.from_string('foo\n  [bar $baz]')
+    self.assertEqual(('$baz', 2, 8), (
+      context.exception.token,
+      context.exception.line,
+      context.exception.column,
+    ))
+    with self.assertRaises(UnbalancedBrackets) as context:
+      Expression.from_string('[foo]\n[[bar]')
+    self.assertEqual((2, 1), (
+      context.exception.line,
+      context.exception.column,
+    ))
+
+class TestLimits(unittest.TestCase):
+  def test_limits(self):
+    loop = Expression.from_string('[d a] d a')
+    with self.assertRaises(OutOfFuel) as context:
+      Expression.normalize(loop, fuel=100)
+    state = context.exception.state
+    self.assertEqual(100, state.steps)
+    self.assertTrue(state.has_next)
+    self.assertRaises(OutOfTime, Expression.normalize, loop, timeout=0.01)
+    self.assertRaises(OutOfFuel, Expression.normalize, loop, fuel=-1)
+    value = Expression.from_string('[foo] [bar] f [baz] c quux a')
+    state = State(value, fuel=3)
+    self.assertFalse(state.run())
+    state.fuel = None
+    self.assertTrue(state.run())
+    self.assertEqual(Expression.normalize(value), state.value)
+
+  def test_profile(self):
+    value = Expression.from_string('[foo] d [bar] f e e quux a')
+    profile = Profile()
+    state = State(value, profile=profile)
+    self.assertTrue(state.run())
+    self.assertEqual(Expression.normalize(value), state.value)
+    self.assertEqual(state.steps, profile.steps)
+    self.assertEqual({'d': 1, 'f': 1, 'e': 2, 'a': 1}, profile.constants)
+    self.assertEqual({'quux': 1, 'a': 1}, profile.stuck)
+    self.assertEqual(3, profile.data_high)
+    self.assertEqual(3, profile.sink_high)
+
+class TestChoice(unittest.TestCase):
+  def test_choice(self):
+    sources = [
+      '(foo | bar)',
+      '[(| [baz])] (foo [(a |)] | bar quux) d',
+      '(|)',
+    ]
+    for source in sources:
+      value = Expression.from_string(source)
+      self.assertEqual(source, f'{value}')
+      self.assertEqual(source, f'{value.unpack()}')
+      self.assertEqual(value, value.unpack().pack())
+    axioms = [
+      ('[foo] [bar] g', '[(foo | bar)]'),
+      ('[(foo | bar)] h', '[foo] [bar]'),
+      ('[foo bar] h', '[foo bar] h'),
+      ('[foo] (bar | baz) d', '[foo] (bar | baz) d'),
+    ]
+    for (source, expected_source) in axioms:
+      value = Expression.from_string(source)
+      actual = Expression.normalize(value)
+      self.assertEqual(expected_source, f'{actual}')
+    self.assertRaises(UnbalancedBrackets, Expression.from_string, '(foo)')
+    self.assertRaises(UnbalancedBrackets, Expression.from_string, '[foo | b]')
+    state = State(Expression.from_string('[foo] (d | e) bar'), explore=True)
+    self.assertRaises(Branch, state.run)
+    fst, snd = state.split()
+    fst.run()
+    snd.run()
+    self.assertEqual('[foo] [foo] bar', f'{fst.value}')
+    self.assertEqual('bar', f'{snd.value}')
+
+class TestRope(unittest.TestCase):
+  def test_rope(self):
+    piece = Expression.from_string('[foo] bar (baz | quux)')
+    value = Expression.from_string('')
+    expected = []
+    for _ in range(500):
+      value = value.seq(piece)
+      expected.append(f'{piece}')
+      self.assertLessEqual(value.depth, 16)
+    self.assertIsInstance(value, Rope)
+    self.assertEqual(' '.join(expected), f'{value}')
+    self.assertEqual(Expression.from_string(f'{value}'), value)
+    source = '[x] ' + ' '.join(['[foo bar baz quux] c'] * 200) + ' a'
+    actual = Expression.normalize(Expression.from_string(source))
+    self.assertEqual(' '.join(['x'] + ['foo bar baz quux'] * 200), f'{actual}')
+
+class TestPrinter(unittest.TestCase):
+  def test_printer(self):
+    value = Identity()
+    for index in range(10_000):
+      value = Quote(Catenate(Variable('foo'), value))
+    source = f'{value}'
+    self.assertEqual('[foo '*3+'[foo', source[:19])
+    self.assertEqual(']'*10_000, source[-10_000:])
+    self.assertEqual(source, f'{value.pack()}')
+    sources = [
+      '[foo] (bar | [baz]) a',
+      '[[foo] d] [bar] f quux a',
+      '(| (a |)) [] d',
+    ]
+    for source in sources:
+      state = State(Expression.from_string(source))
+      while True:
+        stream = io.StringIO()
+        state.write_value(stream)
+        self.assertEqual(f'{state.value}', stream.getvalue())
+        if not state.has_next:
+          break
+        state.step()
+
+class TestFork(unittest.TestCase):
+  def test_fork(self):
+    state = State(Expression.from_string('[foo] [bar] [quux] f e'))
+    for _ in range(2):
+      state.step()
+    fork = state.fork()
+    self.assertIsNot(state.code, fork.code)
+    fork.run()
+    self.assertEqual('[foo] [bar] [quux] f e', f'{state.value}')
+    self.assertEqual('[foo] [quux]', f'{fork.value}')
+    state.run()
+    self.assertEqual(fork.value, state.value)
+    # Forking copies none of the stacks, and each fork copies only what
+    # it reaches of them.
+    value = Expression.from_string(' '.join(['[foo]'] * 1000) + ' e e x')
+    state = State(value, fuel=1000)
+    state.run()
+    fork = state.fork()
+    self.assertEqual(([], [], []), (fork.code, fork.data, fork.sink))
+    self.assertIs(state._data_base, fork._data_base)
+    fork.fuel = 2
+    fork.run()
+    self.assertEqual(_PULL-2, len(fork.data))
+    fork.fuel = None
+    fork.run()
+    self.assertEqual(' '.join(['[foo]'] * 998 + ['x']), f'{fork.value}')
+    self.assertEqual(' '.join(['[foo]'] * 1000 + ['e e x']), f'{state.value}')
+    profile = Profile()
+    value = Expression.from_string('[foo] d e [bar] d e')
+    state = State(value, fuel=1, profile=profile)
+    state.run()
+    fork = state.fork()
+    fork.fuel = None
+    fork.run()
+    self.assertIs(profile, state.profile)
+    self.assertEqual(1, profile.steps)
+    self.assertEqual(fork.steps, fork.profile.steps)
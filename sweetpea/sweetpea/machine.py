@@ -0,0 +1,281 @@
+import array
+import unittest
+
+from typing import Union
+from typing import Callable
+from typing import Optional
+
+from .expression import Expression
+from .expression import Packed
+from .expression import Rope
+from .expression import OPCODE_BITS
+from .expression import OPCODE_MASK
+from .expression import QUOTE
+from .expression import CHOICE
+
+class Program:
+  """An expression lowered to bytecode. The bytecode is the packed
+  encoding with a dedicated opcode for each known constant, so a
+  program can be run any number of times without decoding names.
+  """
+  code: Packed
+
+  def __init__(self, code: Packed):
+    self.code = code
+
+  @staticmethod
+  def compile(value: Expression) -> 'Program':
+    return Program(value.pack())
+
+  def run(self) -> Expression:
+    machine = Machine(self)
+    machine.run()
+    return machine.value
+
+  def __str__(self) -> str:
+    return f'{self.code}'
+
+class Machine:
+  """Runs a program with a dispatch table over opcodes. It computes the
+  same normal forms as `State`, but the code stack holds spans of
+  bytecode instead of nodes, the data stack holds the bodies of quotes,
+  and stuck terms are written straight into the sink as words. Missing
+  arguments and the shape of a choice are checked with plain tests
+  rather than by raising and catching an error. Choices are always
+  stuck; exploring them is left to `State`.
+  """
+  code: list[Union[tuple[array.array, int, int], Rope]]
+  data: list[Union[Packed, Rope]]
+  sink: array.array
+
+  def __init__(self, program: Program):
+    code = program.code
+    self.code = [(code.words, code.start, code.stop)]
+    self.data = []
+    self.sink = array.array('q')
+
+  @property
+  def has_next(self) -> bool:
+    return len(self.code) > 0
+
+  @property
+  def value(self) -> Expression:
+    words = array.array('q', self.sink)
+    for body in self.data:
+      quote_into(words, body)
+    for frame in reversed(self.code):
+      if isinstance(frame, Rope):
+        frame = frame.pack()
+        frame = (frame.words, frame.start, frame.stop)
+      source, start, stop = frame
+      words.extend(source[start:stop])
+    return Packed(words, 0, len(words))
+
+  def thunk_with(self, word: int):
+    for body in self.data:
+      quote_into(self.sink, body)
+    self.data.clear()
+    self.sink.append(word)
+
+  def run(self):
+    code = self.code
+    data = self.data
+    table = DISPATCH
+    while len(code) > 0:
+      frame = code.pop()
+      if isinstance(frame, Rope):
+        code.append(frame.snd)
+        code.append(frame.fst)
+        continue
+      if isinstance(frame, Packed):
+        frame = (frame.words, frame.start, frame.stop)
+      words, pc, stop = frame
+      while pc < stop:
+        word = words[pc]
+        pc += 1
+        opcode = word & OPCODE_MASK
+        if opcode == QUOTE:
+          end = pc+(word >> OPCODE_BITS)
+          data.append(Packed(words, pc, end))
+          pc = end
+          continue
+        if opcode == CHOICE:
+          end = pc+(word >> OPCODE_BITS)
+          self.thunk_with(word)
+          self.sink.extend(words[pc:end])
+          pc = end
+          continue
+        body = table[opcode](self, word)
+        if body is not None:
+          # Only the rest of the current span needs to be saved, and
+          # not even that if the body is in tail position.
+          if pc < stop:
+            code.append((words, pc, stop))
+          if isinstance(body, Rope):
+            code.append(body)
+            break
+          words, pc, stop = body.words, body.start, body.stop
+
+def quote_into(words: array.array, body: Union[Packed, Rope]):
+  body = body.pack()
+  words.append(((body.stop-body.start) << OPCODE_BITS) | QUOTE)
+  words.extend(body.words[body.start:body.stop])
+
+def quoted(body: Union[Packed, Rope]) -> Packed:
+  """`body` quoted once, as a sequence of one quote."""
+  words = array.array('q')
+  quote_into(words, body)
+  return Packed(words, 0, len(words))
+
+def make_choice(
+  fst: Union[Packed, Rope],
+  snd: Union[Packed, Rope],
+) -> Packed:
+  """The sequence `(fst | snd)`."""
+  words = array.array('q', [CHOICE])
+  quote_into(words, fst)
+  quote_into(words, snd)
+  words[0] = ((len(words)-1) << OPCODE_BITS) | CHOICE
+  return Packed(words, 0, len(words))
+
+def split_choice(
+  body: Union[Packed, Rope],
+) -> Optional[tuple[Packed, Packed]]:
+  """The alternatives of a sequence that is exactly one choice, or
+  `None` for any other sequence.
+  """
+  body = body.pack()
+  words, start, stop = body.words, body.start, body.stop
+  if (
+    start == stop
+    or words[start] & OPCODE_MASK != CHOICE
+    or start+1+(words[start] >> OPCODE_BITS) != stop
+  ):
+    return None
+  fst = start+1
+  snd = fst+1+(words[fst] >> OPCODE_BITS)
+  return (Packed(words, fst+1, snd), Packed(words, snd+1, stop))
+
+def _op_nop(machine: Machine, word: int) -> Optional[Expression]:
+  return None
+
+def _op_stuck(machine: Machine, word: int) -> Optional[Expression]:
+  machine.thunk_with(word)
+  return None
+
+def _op_a(machine: Machine, word: int) -> Optional[Expression]:
+  data = machine.data
+  if len(data) < 1:
+    machine.thunk_with(word)
+    return None
+  return data.pop()
+
+def _op_b(machine: Machine, word: int) -> Optional[Expression]:
+  data = machine.data
+  if len(data) < 1:
+    machine.thunk_with(word)
+    return None
+  data.append(quoted(data.pop()))
+  return None
+
+def _op_c(machine: Machine, word: int) -> Optional[Expression]:
+  data = machine.data
+  if len(data) < 2:
+    machine.thunk_with(word)
+    return None
+  snd = data.pop()
+  fst = data.pop()
+  data.append(Rope.join(fst, snd))
+  return None
+
+def _op_d(machine: Machine, word: int) -> Optional[Expression]:
+  data = machine.data
+  if len(data) < 1:
+    machine.thunk_with(word)
+    return None
+  data.append(data[-1])
+  return None
+
+def _op_e(machine: Machine, word: int) -> Optional[Expression]:
+  data = machine.data
+  if len(data) < 1:
+    machine.thunk_with(word)
+    return None
+  data.pop()
+  return None
+
+def _op_f(machine: Machine, word: int) -> Optional[Expression]:
+  data = machine.data
+  if len(data) < 2:
+    machine.thunk_with(word)
+    return None
+  data[-1], data[-2] = data[-2], data[-1]
+  return None
+
+def _op_g(machine: Machine, word: int) -> Optional[Expression]:
+  data = machine.data
+  if len(data) < 2:
+    machine.thunk_with(word)
+    return None
+  snd = data.pop()
+  fst = data.pop()
+  data.append(make_choice(fst, snd))
+  return None
+
+def _op_h(machine: Machine, word: int) -> Optional[Expression]:
+  data = machine.data
+  if len(data) < 1:
+    machine.thunk_with(word)
+    return None
+  alternatives = split_choice(data[-1])
+  if alternatives is None:
+    machine.thunk_with(word)
+    return None
+  data.pop()
+  data.extend(alternatives)
+  return None
+
+DISPATCH: list[Callable[[Machine, int], Optional[Expression]]] = [
+  _op_nop,    # CONSTANT
+  _op_stuck,  # VARIABLE
+  _op_nop,    # ANNOTATE
+  None,       # QUOTE is handled by the run loop
+  _op_a,
+  _op_b,
+  _op_c,
+  _op_d,
+  _op_e,
+  _op_f,
+  _op_g,
+  _op_h,
+  None,       # CHOICE is handled by the run loop
+]
+
+def normalize(value: Expression) -> Expression:
+  return Program.compile(value).run()
+
+class TestMachine(unittest.TestCase):
+  def test_equivalence(self):
+    sources = [
+      '[foo] a',
+      '[foo] b',
+      '[foo] [bar] c',
+      '[foo] d',
+      '[foo] e',
+      '[foo] [bar] f',
+      '',
+      'a',
+      '[foo] c',
+      '[foo] [bar] baz f',
+      '[foo] [bar] f baz [quux] c',
+      '[[d a] d a] e [[foo] [bar] @x f c b] a a',
+      '[foo] g h [bar] z',
+      '[foo] [bar] g d h f [(baz | quux)] h',
+      '[foo] [bar] g h a (a | b) [bar] a',
+    ]
+    for source in sources:
+      value = Expression.from_string(source)
+      expected = Expression.normalize(value)
+      actual = normalize(value)
+      self.assertEqual(expected, actual)
+      self.assertEqual(f'{expected}', f'{actual}')
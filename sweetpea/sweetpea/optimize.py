@@ -0,0 +1,435 @@
+import array
+import unittest
+import dataclasses
+
+from typing import Union
+
+from .expression import Error
+from .expression import Expression
+from .expression import Packed
+from .expression import Rope
+from .expression import State
+from .expression import OutOfFuel
+from .expression import OPCODE_BITS
+from .expression import OPCODE_MASK
+from .expression import ANNOTATE
+from .expression import QUOTE
+from .expression import CHOICE
+from .expression import OP_A
+from .expression import OP_B
+from .expression import OP_C
+from .expression import OP_D
+from .expression import OP_E
+from .expression import OP_F
+from .expression import OP_G
+from .expression import OP_H
+from .machine import quote_into
+from .machine import quoted
+from .machine import make_choice
+from .machine import split_choice
+
+class Mismatch(Error):
+  expected: Expression
+  actual: Expression
+
+  def __init__(self, expected: Expression, actual: Expression):
+    self.expected = expected
+    self.actual = actual
+
+  def __str__(self) -> str:
+    return f'''
+The optimized program normalizes to {self.actual},
+but the original normalizes to {self.expected}
+'''.strip()
+
+class Unverifiable(Error):
+  fuel: int
+
+  def __init__(self, fuel: int):
+    self.fuel = fuel
+
+  def __str__(self) -> str:
+    return f'''
+The program or its optimized form takes more than {self.fuel} steps
+to normalize, so they could not be compared
+'''.strip()
+
+class _TooLarge(Exception):
+  # Raised inside a pass whose output outgrows the limits, and caught
+  # where the pass started, which then keeps what it was given.
+  pass
+
+@dataclasses.dataclass
+class OptimizeStats:
+  passes: int = 0
+  rewrites: int = 0
+  cancelled: int = 0
+  abandoned: int = 0
+
+class Optimizer:
+  """Rewrites a program with the equations of the calculus before it
+  runs. Each pass reads the program left to right, keeping the literal
+  quotes it has seen on a stack of its own, and performs every step
+  whose arguments are all on that stack, such as `[A] a` or
+  `[A] [B] f`. Anything else, like a variable or a step whose arguments
+  are not known, is written out along with the quotes so far, exactly as
+  a `State` would leave it. Passes repeat until nothing changes, so the
+  result has the same normal form as the program, in fewer steps.
+
+  Rewriting can grow a program as well as shrink it, so a pass gives up
+  and keeps its input once its output would be more than `max_size`
+  words, or any quote in it more than `max_quote` words. `budget` bounds
+  the number of rewrites in each call to `optimize`, so a program that
+  does not terminate is rewritten only so far.
+
+  With `bodies`, the bodies of quotes and alternatives of choices are
+  rewritten too, up to `max_depth` levels of nesting. A body is only
+  replaced if it gets no larger, since a body that grows is usually a
+  loop being unrolled. A rewritten body does the same when it runs, but
+  the normal form of the program changes: `[[foo] a]` is already normal
+  and becomes `[foo]`, so `verify` reports a `Mismatch` for it.
+
+  `assume_data` enables the rewrites `d e`, `f f` and `b a` to nothing
+  wherever they occur. These only hold when the data stack has enough
+  quotes on it, and are wrong otherwise: `d e` on its own is stuck.
+  With `verify`, the normal forms of the program before and after are
+  compared, and `Mismatch` is raised if they differ. Each is given
+  `verify_fuel` steps, and `Unverifiable` is raised if either needs
+  more.
+  """
+  assume_data: bool
+  bodies: bool
+  budget: int
+  max_size: int
+  max_quote: int
+  max_depth: int
+  max_passes: int
+  verify: bool
+  verify_fuel: int
+  stats: OptimizeStats
+
+  def __init__(
+    self,
+    assume_data: bool = False,
+    bodies: bool = False,
+    budget: int = 1 << 16,
+    max_size: int = 1 << 16,
+    max_quote: int = 1 << 12,
+    max_depth: int = 64,
+    max_passes: int = 8,
+    verify: bool = False,
+    verify_fuel: int = 1 << 20,
+  ):
+    self.assume_data = assume_data
+    self.bodies = bodies
+    self.budget = budget
+    self.max_size = max_size
+    self.max_quote = max_quote
+    self.max_depth = max_depth
+    self.max_passes = max_passes
+    self.verify = verify
+    self.verify_fuel = verify_fuel
+    self.stats = OptimizeStats()
+
+  def optimize(self, value: Expression) -> Packed:
+    value = value.pack()
+    result = value
+    # The rewrites left in this call.
+    self._budget = self.budget
+    for _ in range(self.max_passes):
+      self.stats.passes += 1
+      try:
+        rewritten = self._pass(result, 0)
+      except _TooLarge:
+        self.stats.abandoned += 1
+        break
+      if rewritten == result:
+        break
+      result = rewritten
+    if self.verify:
+      self._check(value, result)
+    return result
+
+  def _check(self, value: Packed, result: Packed):
+    try:
+      expected = Expression.normalize(value, fuel=self.verify_fuel)
+      actual = Expression.normalize(result, fuel=self.verify_fuel)
+    except OutOfFuel as error:
+      raise Unverifiable(self.verify_fuel) from error
+    if expected != actual:
+      raise Mismatch(expected, actual)
+
+  def _pass(self, value: Packed, depth: int) -> Packed:
+    out = array.array('q')
+    # The start in `out` and the first word of each term written so
+    # far, for cancelling a step against the one before it.
+    items = []
+    static = []
+    code = [value]
+    while len(code) > 0:
+      frame = code.pop()
+      if isinstance(frame, Rope):
+        code.append(frame.snd)
+        code.append(frame.fst)
+        continue
+      words, pc, stop = frame.words, frame.start, frame.stop
+      while pc < stop:
+        word = words[pc]
+        opcode = word & OPCODE_MASK
+        if opcode == QUOTE:
+          end = pc+1+(word >> OPCODE_BITS)
+          static.append(self._body(Packed(words, pc+1, end), depth))
+          if len(static) > self.max_size:
+            raise _TooLarge()
+          pc = end
+          continue
+        if opcode == CHOICE:
+          end = pc+1+(word >> OPCODE_BITS)
+          self._flush(out, items, static)
+          items.append((len(out), word))
+          self._choice(out, Packed(words, pc, end), depth)
+          pc = end
+          continue
+        pc += 1
+        if opcode == ANNOTATE:
+          # A state skips annotations.
+          self.stats.rewrites += 1
+          continue
+        if self._budget > 0:
+          if opcode == OP_A and len(static) > 0:
+            self._budget -= 1
+            self.stats.rewrites += 1
+            if pc < stop:
+              code.append(Packed(words, pc, stop))
+            code.append(static.pop())
+            break
+          fire = _FIRE.get(opcode)
+          if fire is not None and fire(static):
+            self._budget -= 1
+            self.stats.rewrites += 1
+            if len(static) > 0 and static[-1].size > self.max_quote:
+              raise _TooLarge()
+            continue
+        self._flush(out, items, static)
+        if self.assume_data and len(items) > 0:
+          pair = (items[-1][1] & OPCODE_MASK, opcode)
+          if pair in _CANCEL:
+            start, _ = items.pop()
+            del out[start:]
+            self.stats.cancelled += 1
+            self._reload(out, items, static)
+            continue
+        items.append((len(out), word))
+        out.append(word)
+    self._flush(out, items, static)
+    return Packed(out, 0, len(out))
+
+  def _body(
+    self,
+    body: Packed,
+    depth: int,
+  ) -> Union[Packed, Rope]:
+    if not self.bodies or depth >= self.max_depth:
+      return body
+    try:
+      rewritten = self._pass(body, depth+1)
+    except _TooLarge:
+      self.stats.abandoned += 1
+      return body
+    if rewritten.size > body.size:
+      return body
+    return rewritten
+
+  def _choice(self, out: array.array, choice: Packed, depth: int):
+    words, start = choice.words, choice.start
+    fst = start+1
+    snd = fst+1+(words[fst] >> OPCODE_BITS)
+    index = len(out)
+    out.append(CHOICE)
+    quote_into(out, self._body(Packed(words, fst+1, snd), depth))
+    quote_into(out, self._body(Packed(words, snd+1, choice.stop), depth))
+    out[index] = ((len(out)-index-1) << OPCODE_BITS) | CHOICE
+    if len(out) > self.max_size:
+      raise _TooLarge()
+
+  def _flush(self, out: array.array, items: list, static: list):
+    for body in static:
+      items.append((len(out), QUOTE))
+      quote_into(out, body)
+    static.clear()
+    if len(out) > self.max_size:
+      raise _TooLarge()
+
+  def _reload(self, out: array.array, items: list, static: list):
+    # Cancelling a step can leave quotes at the end of the output that
+    # were only written out because of it; put them back on the stack
+    # so the steps after them can use them.
+    reloaded = []
+    while len(items) > 0 and items[-1][1] == QUOTE:
+      start, _ = items.pop()
+      words = array.array('q', out[start+1:])
+      reloaded.append(Packed(words, 0, len(words)))
+      del out[start:]
+    static.extend(reversed(reloaded))
+
+def optimize(value: Expression, **options) -> Packed:
+  return Optimizer(**options).optimize(value)
+
+# Each of these performs a step on the literal quotes known to a pass,
+# like the step of the same name in `machine`, and returns whether it
+# had the arguments it needed.
+
+def _fire_b(static: list) -> bool:
+  if len(static) < 1:
+    return False
+  static.append(quoted(static.pop()))
+  return True
+
+def _fire_c(static: list) -> bool:
+  if len(static) < 2:
+    return False
+  snd = static.pop()
+  fst = static.pop()
+  static.append(Rope.join(fst, snd))
+  return True
+
+def _fire_d(static: list) -> bool:
+  if len(static) < 1:
+    return False
+  static.append(static[-1])
+  return True
+
+def _fire_e(static: list) -> bool:
+  if len(static) < 1:
+    return False
+  static.pop()
+  return True
+
+def _fire_f(static: list) -> bool:
+  if len(static) < 2:
+    return False
+  static[-1], static[-2] = static[-2], static[-1]
+  return True
+
+def _fire_g(static: list) -> bool:
+  if len(static) < 2:
+    return False
+  snd = static.pop()
+  fst = static.pop()
+  static.append(make_choice(fst, snd))
+  return True
+
+def _fire_h(static: list) -> bool:
+  if len(static) < 1:
+    return False
+  alternatives = split_choice(static[-1])
+  if alternatives is None:
+    return False
+  static.pop()
+  static.extend(alternatives)
+  return True
+
+# `a` is handled by the pass itself, since it moves code rather than
+# data.
+_FIRE = {
+  OP_B: _fire_b,
+  OP_C: _fire_c,
+  OP_D: _fire_d,
+  OP_E: _fire_e,
+  OP_F: _fire_f,
+  OP_G: _fire_g,
+  OP_H: _fire_h,
+}
+
+_CANCEL = {
+  (OP_D, OP_E),
+  (OP_F, OP_F),
+  (OP_B, OP_A),
+}
+
+class TestOptimize(unittest.TestCase):
+  def test_exact(self):
+    cases = [
+      ('[foo] a', 'foo'),
+      ('[foo] [bar] f c', '[bar foo]'),
+      ('[foo] d e b', '[[foo]]'),
+      ('[foo] [bar] g h f', '[bar] [foo]'),
+      ('x [foo] [bar] @y c a', 'x foo bar'),
+      ('[foo] c [bar] a', '[foo] c bar'),
+      ('x d e f f b a', 'x d e f f b a'),
+      ('[[foo] a]', '[[foo] a]'),
+      ('[[foo] a] ([[bar] a] | baz)', '[[foo] a] ([[bar] a] | baz)'),
+    ]
+    for source, expected in cases:
+      value = Expression.from_string(source)
+      actual = optimize(value, verify=True)
+      self.assertEqual(expected, f'{actual}')
+
+  def test_bodies(self):
+    value = Expression.from_string('[[foo] a] ([[bar] a] | baz)')
+    self.assertEqual('[foo] ([bar] | baz)', f'{optimize(value, bodies=True)}')
+    # The normal form of a quote is the quote itself, so rewriting its
+    # body changes it.
+    self.assertRaises(Mismatch, optimize, value, bodies=True, verify=True)
+    # Bodies that grow are loops being unrolled, and are left alone.
+    for source in ['[[d c d a] d a]', '[[d d a] d a]', '[[d a] d a]']:
+      value = Expression.from_string(source)
+      optimizer = Optimizer(bodies=True)
+      self.assertEqual(source, f'{optimizer.optimize(value)}')
+
+  def test_assume_data(self):
+    cases = [
+      ('x d e f f b a', 'x'),
+      ('x f d e f', 'x'),
+      ('[foo] f f a', 'foo'),
+      ('x [foo] d e', 'x [foo]'),
+    ]
+    for source, expected in cases:
+      value = Expression.from_string(source)
+      self.assertEqual(expected, f'{optimize(value, assume_data=True)}')
+    value = Expression.from_string('d e')
+    self.assertRaises(Mismatch, optimize, value, assume_data=True, verify=True)
+
+  def test_budget(self):
+    value = Expression.from_string('[d a] d a')
+    optimizer = Optimizer(budget=100)
+    result = optimizer.optimize(value)
+    self.assertEqual('[d a] d a', f'{result}')
+    self.assertEqual(100, optimizer.stats.rewrites)
+    # Each call gets the whole budget.
+    value = Expression.from_string('[foo] [bar] f c')
+    self.assertEqual('[bar foo]', f'{optimizer.optimize(value)}')
+    self.assertEqual(102, optimizer.stats.rewrites)
+    self.assertEqual(100, optimizer.budget)
+
+  def test_verify(self):
+    value = Expression.from_string('[foo] [d a] d a')
+    with self.assertRaises(Unverifiable) as context:
+      optimize(value, verify=True, verify_fuel=1000)
+    self.assertEqual(1000, context.exception.fuel)
+    value = Expression.from_string('[foo] [bar] f c')
+    self.assertEqual('[bar foo]', f'{optimize(value, verify=True)}')
+
+  def test_size(self):
+    # Each of these doubles a quote for as long as the budget lasts.
+    for source in ['[foo] [d c d a] d a', '[[d c d a] d a] d a']:
+      value = Expression.from_string(source)
+      optimizer = Optimizer(max_size=1 << 10, max_quote=1 << 8)
+      result = optimizer.optimize(value)
+      self.assertLessEqual(result.size, 1 << 10)
+      self.assertGreater(optimizer.stats.abandoned, 0)
+    value = Expression.from_string('[[d d a] d a]')
+    self.assertEqual(value, optimize(value, verify=True))
+
+  def test_steps(self):
+    source = ' '.join(
+      f'[x{index}] [y] f a d e [z] b a' for index in range(100)
+    )
+    value = Expression.from_string(source)
+    result = optimize(value, verify=True)
+    before = State(value)
+    before.run()
+    after = State(result)
+    after.run()
+    self.assertEqual(before.value, after.value)
+    self.assertLess(after.steps, before.steps // 2)
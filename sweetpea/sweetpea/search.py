@@ -0,0 +1,184 @@
+import heapq
+import hashlib
+import unittest
+import itertools
+import collections
+import dataclasses
+import concurrent.futures
+
+from typing import Any
+from typing import Callable
+from typing import Iterator
+from typing import Optional
+
+from .expression import Branch
+from .expression import Expression
+from .expression import State
+
+@dataclasses.dataclass
+class SearchStats:
+  expanded: int = 0
+  results: int = 0
+  duplicates: int = 0
+  dropped: int = 0
+  exhausted: int = 0
+
+class Search:
+  """Enumerate the normal forms of an expression with choices in it.
+  Each state is reduced until it reaches a choice, where it splits into
+  one state per alternative. States are expanded breadth first, or best
+  first by the given `key` (lowest first), and with `workers` greater
+  than zero the expansions run in a process pool.
+
+  Each state reached is remembered by a digest of its value, so states
+  reached along several paths are only expanded once. At most
+  `max_frontier` states wait to be expanded, and at most `max_seen`
+  digests are remembered; states that do not fit in the frontier are
+  dropped. `fuel` bounds the steps along any one path. Iterating over a
+  search yields each distinct normal form as soon as it is found.
+  """
+  init: Expression
+  strategy: str
+  key: Optional[Callable[[State], Any]]
+  workers: int
+  fuel: Optional[int]
+  max_frontier: int
+  max_seen: int
+  stats: SearchStats
+
+  def __init__(
+    self,
+    init: Expression,
+    strategy: str = 'breadth',
+    key: Optional[Callable[[State], Any]] = None,
+    workers: int = 0,
+    fuel: Optional[int] = None,
+    max_frontier: int = 100_000,
+    max_seen: int = 1_000_000,
+  ):
+    if strategy not in ['breadth', 'best']:
+      raise ValueError(f'''
+Unknown search strategy: {strategy}
+'''.strip())
+    if strategy == 'best' and key is None:
+      raise ValueError(f'''
+A best-first search needs a key
+'''.strip())
+    self.init = init
+    self.strategy = strategy
+    self.key = key
+    self.workers = workers
+    self.fuel = fuel
+    self.max_frontier = max_frontier
+    self.max_seen = max_seen
+    self.stats = SearchStats()
+
+  def __iter__(self) -> Iterator[Expression]:
+    self._frontier = collections.deque() if self.strategy == 'breadth' else []
+    self._counter = itertools.count()
+    self._seen = set()
+    self._found = set()
+    self._push(State(self.init, fuel=self.fuel, explore=True))
+    if self.workers <= 0:
+      while len(self._frontier) > 0:
+        yield from self._accept(_expand(self._pop()))
+      return
+    with concurrent.futures.ProcessPoolExecutor(self.workers) as pool:
+      pending = set()
+      while len(self._frontier) > 0 or len(pending) > 0:
+        while len(self._frontier) > 0 and len(pending) < 2*self.workers:
+          pending.add(pool.submit(_expand, self._pop()))
+        done, pending = concurrent.futures.wait(
+          pending,
+          return_when=concurrent.futures.FIRST_COMPLETED,
+        )
+        for future in done:
+          yield from self._accept(future.result())
+
+  def _push(self, state: State):
+    key = _digest(state.value)
+    if key in self._seen:
+      self.stats.duplicates += 1
+      return
+    if len(self._seen) < self.max_seen:
+      self._seen.add(key)
+    if len(self._frontier) >= self.max_frontier:
+      self.stats.dropped += 1
+      return
+    if self.strategy == 'breadth':
+      self._frontier.append(state)
+    else:
+      entry = (self.key(state), next(self._counter), state)
+      heapq.heappush(self._frontier, entry)
+
+  def _pop(self) -> State:
+    if self.strategy == 'breadth':
+      return self._frontier.popleft()
+    _, _, state = heapq.heappop(self._frontier)
+    return state
+
+  def _accept(self, outcome: tuple) -> Iterator[Expression]:
+    self.stats.expanded += 1
+    value, children = outcome
+    if value is not None:
+      key = _digest(value)
+      if key not in self._found:
+        self._found.add(key)
+        self.stats.results += 1
+        yield value
+    elif children is None:
+      self.stats.exhausted += 1
+    else:
+      for child in children:
+        self._push(child)
+
+def _expand(
+  state: State,
+) -> tuple[Optional[Expression], Optional[list[State]]]:
+  # Reduce a state until it is normal, runs out of fuel, or reaches a
+  # choice. The pool pickles it by name, so it lives at the top level
+  # rather than on `Search`.
+  try:
+    if state.run():
+      return (state.value, None)
+    return (None, None)
+  except Branch:
+    return (None, list(state.split()))
+
+def _digest(value: Expression) -> bytes:
+  value = value.pack()
+  data = value.words[value.start:value.stop].tobytes()
+  return hashlib.blake2b(data, digest_size=16).digest()
+
+class TestSearch(unittest.TestCase):
+  def test_search(self):
+    value = Expression.from_string('[foo] [bar] (f | (e | d)) (baz | baz)')
+    expected = {
+      '[bar] [foo] baz',
+      '[foo] baz',
+      '[foo] [bar] [bar] baz',
+    }
+    search = Search(value)
+    actual = {f'{result}' for result in search}
+    self.assertEqual(expected, actual)
+    self.assertEqual(3, search.stats.results)
+    self.assertEqual(3, search.stats.duplicates)
+    search = Search(value, workers=2)
+    actual = {f'{result}' for result in search}
+    self.assertEqual(expected, actual)
+
+  def test_limits(self):
+    value = Expression.from_string('[(d a | foo)] d a')
+    search = Search(value)
+    self.assertEqual(['[(d a | foo)] foo'], [f'{x}' for x in search])
+    value = Expression.from_string('[d a] d a')
+    search = Search(value, fuel=1000)
+    self.assertEqual([], list(search))
+    self.assertEqual(1, search.stats.exhausted)
+    value = Expression.from_string('[(d | e) a] d a')
+    search = Search(value, strategy='best', key=lambda state: state.steps)
+    self.assertEqual(['a'], [f'{result}' for result in search])
+    value = Expression.from_string('(foo | bar) (foo | bar) (foo | bar)')
+    search = Search(value, max_frontier=2)
+    self.assertLess(len(list(search)), 8)
+    self.assertGreater(search.stats.dropped, 0)
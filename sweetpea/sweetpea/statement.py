@@ -1,18 +1,360 @@
-import expression as expr
+import re
+import array
+import unittest
+import dataclasses
 
+from typing import BinaryIO
+from typing import Optional
+
+from . import expression as expr
+from . import binary
+
+@dataclasses.dataclass(frozen=True)
 class Statement:
   pass
 
+@dataclasses.dataclass(frozen=True)
 class Equals(Statement):
   fst: expr.Variable
   snd: expr.Expression
 
+  def __str__(self) -> str:
+    return f'{self.fst} = {self.snd}'
+
+@dataclasses.dataclass(frozen=True)
 class HasType(Statement):
   fst: expr.Variable
   snd: expr.Expression
 
+  def __str__(self) -> str:
+    return f'{self.fst} : {self.snd}'
+
+class MalformedStatement(expr.Error):
+  line: int
+  column: int
+
+  def __init__(self, line: int, column: int):
+    self.line = line
+    self.column = column
+
+  def __str__(self) -> str:
+    where = f'line {self.line}, column {self.column}'
+    return f'''
+Expected `name = body` or `name : type` at {where}
+'''.strip()
+
+class Redefined(expr.Error):
+  name: str
+  line: int
+
+  def __init__(self, name: str, line: int):
+    self.name = name
+    self.line = line
+
+  def __str__(self) -> str:
+    return f'''
+`{self.name}` is declared again at line {self.line}
+'''.strip()
+
+# A statement starts at the beginning of a line with a name and `=` or
+# `:`, and runs until the next line that does not start with
+# whitespace. Any other unindented text is an error.
+_HEAD = re.compile(
+  r'^(?:([a-zA-Z_][a-zA-Z0-9_]*)[ \t]*([=:])|(\S))',
+  re.MULTILINE,
+)
+
+# How a statement is tagged in the compiled form of a module.
+_EQUALS = expr.Annotate('@equals')
+_HAS_TYPE = expr.Annotate('@has_type')
+
 def from_string(string: str) -> Statement:
-  pass
+  module = Module.from_string(string)
+  names = list(module.index)
+  if len(names) != 1 or len(module.index[names[0]]) != 1:
+    raise MalformedStatement(1, 1)
+  (result,) = module.statements(names[0])
+  return result
 
 class Module:
+  """A set of statements indexed by name. Loading a module only finds
+  where each statement is; a statement is parsed the first time its
+  name is asked for, so a program pays for the definitions it uses and
+  not for the rest of the library.
+
+  Given `inline`, a definition whose body is at most that many words
+  is spliced into the bodies that refer to it. A module can be
+  compiled with `dumps` into a sweetpea image of its definitions, which
+  `from_image` loads just as lazily, without parsing any source.
+  """
   body: dict[str, list[Statement]]
+  index: dict[str, list[tuple]]
+  definitions: dict[str, Optional[expr.Packed]]
+  source: str
+  image: Optional[binary.Image]
+  inline: int
+
+  def __init__(self, inline: int = 0):
+    self.body = {}
+    self.index = {}
+    self.definitions = {}
+    self.source = ''
+    self.image = None
+    self.inline = inline
+    self._expanding = set()
+
+  @staticmethod
+  def from_string(source: str, inline: int = 0) -> 'Module':
+    module = Module(inline)
+    module.source = source
+    heads = list(_HEAD.finditer(source))
+    line = 1
+    previous = 0
+    for position, match in enumerate(heads):
+      line += source.count('\n', previous, match.start())
+      previous = match.start()
+      name, kind, other = match.groups()
+      if other is not None or name in expr.OPCODES:
+        raise MalformedStatement(line, 1)
+      entries = module.index.setdefault(name, [])
+      if any(entry[0] == kind for entry in entries):
+        raise Redefined(name, line)
+      if position+1 < len(heads):
+        stop = heads[position+1].start()
+      else:
+        stop = len(source)
+      entries.append((kind, match.start(), match.end(), stop, line))
+    return module
+
+  @staticmethod
+  def from_image(image: binary.Image, inline: int = 0) -> 'Module':
+    module = Module(inline)
+    module.image = image
+    terms = list(image.root)
+    if len(terms) % 3 != 0:
+      raise binary.BadImage('not a module')
+    for position in range(0, len(terms), 3):
+      name, tag, body = terms[position:position+3]
+      if (
+        not isinstance(name, expr.Variable)
+        or not isinstance(body, binary.Block)
+        or body.kind != expr.QUOTE
+        or tag not in (_EQUALS, _HAS_TYPE)
+      ):
+        raise binary.BadImage('not a module')
+      kind = '=' if tag == _EQUALS else ':'
+      module.index.setdefault(name.name, []).append((kind, body))
+    return module
+
+  @staticmethod
+  def from_file(path: str, inline: int = 0) -> 'Module':
+    """Load a module from source, or from its compiled form, which is
+    mapped into memory rather than read.
+    """
+    with open(path, 'rb') as file:
+      compiled = file.read(len(binary.MAGIC)) == binary.MAGIC
+    if compiled:
+      return Module.from_image(binary.Image.open(path), inline)
+    with open(path) as file:
+      return Module.from_string(file.read(), inline)
+
+  def dumps(self) -> bytes:
+    """Compile every statement, with small definitions inlined, into a
+    sweetpea image.
+    """
+    terms = []
+    for name in self.index:
+      for statement in self.statements(name):
+        if isinstance(statement, Equals):
+          terms.append(statement.fst)
+          terms.append(_EQUALS)
+          terms.append(expr.Quote(self.lookup(name)))
+        else:
+          terms.append(statement.fst)
+          terms.append(_HAS_TYPE)
+          terms.append(expr.Quote(statement.snd))
+    return binary.dumps(expr.Expression.from_array(terms))
+
+  def dump(self, file: BinaryIO):
+    file.write(self.dumps())
+
+  def close(self):
+    if self.image is not None:
+      self.image.close()
+
+  def __contains__(self, name: str) -> bool:
+    return name in self.index
+
+  def statements(self, name: str) -> list[Statement]:
+    result = self.body.get(name)
+    if result is None:
+      entries = self.index.get(name, [])
+      result = [self._parse(name, entry) for entry in entries]
+      self.body[name] = result
+    return result
+
+  def type_of(self, name: str) -> Optional[expr.Expression]:
+    for statement in self.statements(name):
+      if isinstance(statement, HasType):
+        return statement.snd
+    return None
+
+  def lookup(self, name: str) -> Optional[expr.Expression]:
+    """The body of the definition of `name`, or `None` if the module
+    does not define it.
+    """
+    try:
+      return self.definitions[name]
+    except KeyError:
+      pass
+    result = None
+    for statement in self.statements(name):
+      if isinstance(statement, Equals):
+        result = statement.snd.pack()
+    if result is not None and self.inline > 0:
+      # A definition is not inlined into itself, so recursion stays a
+      # reference.
+      self._expanding.add(name)
+      try:
+        result = self._inline(result)
+      finally:
+        self._expanding.discard(name)
+    if name not in self._expanding:
+      self.definitions[name] = result
+    return result
+
+  def _parse(self, name: str, entry: tuple) -> Statement:
+    if isinstance(entry[1], binary.Block):
+      kind, block = entry
+      value = block.decode()
+    else:
+      kind, head, start, stop, line = entry
+      parser = expr.Parser()
+      # Number lines and columns as in the module, not the statement.
+      parser.line = line
+      parser.line_start = head-start
+      parser.feed(self.source[start:stop])
+      value = parser.finish()
+    if kind == '=':
+      return Equals(expr.Variable(name), value)
+    return HasType(expr.Variable(name), value)
+
+  def _inline(self, body: expr.Packed) -> expr.Packed:
+    table = {}
+    for word in set(body.words[body.start:body.stop]):
+      if word & expr.OPCODE_MASK != expr.VARIABLE:
+        continue
+      name = expr.symbols.name(word >> expr.OPCODE_BITS)
+      if name in self._expanding or name not in self.index:
+        continue
+      target = self.lookup(name)
+      if target is not None and target.size <= self.inline:
+        table[word] = target
+    if len(table) == 0:
+      return body
+    return _substitute(body, table)
+
+def _substitute(
+  value: expr.Packed,
+  table: dict[int, expr.Packed],
+) -> expr.Packed:
+  # Copy the words of `value`, replacing the variables in `table`
+  # inside quotes and choices too, and patch each header once the copy
+  # of its body is done.
+  words = value.words
+  result = array.array('q')
+  frames = []
+  position = value.start
+  while True:
+    while len(frames) > 0 and frames[-1][1] == position:
+      index, _ = frames.pop()
+      opcode = result[index]
+      result[index] = expr._word(opcode, len(result)-index-1)
+    if position >= value.stop:
+      break
+    word = words[position]
+    position += 1
+    opcode = word & expr.OPCODE_MASK
+    if opcode == expr.QUOTE or opcode == expr.CHOICE:
+      frames.append((len(result), position+(word >> expr.OPCODE_BITS)))
+      result.append(opcode)
+      continue
+    body = table.get(word) if opcode == expr.VARIABLE else None
+    if body is None:
+      result.append(word)
+    else:
+      result.extend(body.words[body.start:body.stop])
+  return expr.Packed(result, 0, len(result))
+
+class TestStatement(unittest.TestCase):
+  source = '''
+swap = f
+dup : quote quote
+dup = d
+pair =
+  dup
+  c
+twice = [pair] a [pair] a
+either = (pair | [dup swap])
+loop = foo loop
+broken = [foo
+'''
+
+  def test_parse(self):
+    self.assertEqual('swap = f', f'{from_string("swap = f")}')
+    self.assertEqual(
+      HasType(expr.Variable('x'), expr.Expression.from_string('y [z]')),
+      from_string('x : y\n  [z]'),
+    )
+    self.assertRaises(MalformedStatement, from_string, 'swap f')
+    self.assertRaises(MalformedStatement, from_string, 'a = b')
+    self.assertRaises(MalformedStatement, from_string, 'x = y\nz = w')
+    self.assertRaises(Redefined, Module.from_string, 'x = y\nx = z')
+    module = Module.from_string(self.source)
+    self.assertEqual(0, len(module.body))
+    self.assertEqual('quote quote', f'{module.type_of("dup")}')
+    self.assertIsNone(module.lookup('nothing'))
+    with self.assertRaises(expr.UnbalancedBrackets) as context:
+      module.lookup('broken')
+    self.assertEqual((11, 10), (
+      context.exception.line,
+      context.exception.column,
+    ))
+
+  def test_reduce(self):
+    cases = [
+      ('[foo] pair', '[foo foo]'),
+      ('[foo] [bar] swap quux', '[bar] [foo] quux'),
+      ('[foo] twice', '[foo foo foo foo]'),
+      ('[foo] bar', '[foo] bar'),
+    ]
+    for inline in [0, 4]:
+      module = Module.from_string(self.source, inline=inline)
+      for source, expected in cases:
+        value = expr.Expression.from_string(source)
+        actual = expr.Expression.normalize(value, module=module)
+        self.assertEqual(expected, f'{actual}')
+      value = expr.Expression.from_string('loop')
+      self.assertRaises(
+        expr.OutOfFuel,
+        expr.Expression.normalize,
+        value,
+        fuel=100,
+        module=module,
+      )
+
+  def test_inline(self):
+    module = Module.from_string(self.source, inline=4)
+    self.assertEqual('d c', f'{module.lookup("pair")}')
+    self.assertEqual('[d c] a [d c] a', f'{module.lookup("twice")}')
+    self.assertEqual('(d c | [d f])', f'{module.lookup("either")}')
+    self.assertEqual('foo loop', f'{module.lookup("loop")}')
+
+  def test_compiled(self):
+    module = Module.from_string(self.source.replace('[foo\n', '[foo]\n'))
+    compiled = Module.from_image(binary.Image(module.dumps()))
+    self.assertEqual(0, len(compiled.body))
+    self.assertEqual('quote quote', f'{compiled.type_of("dup")}')
+    self.assertEqual(1, len(compiled.body))
+    for name in module.index:
+      self.assertEqual(module.lookup(name), compiled.lookup(name))